@@ -1,5 +1,7 @@
 import os
+import re
 import tempfile
+import time
 import pytest
 from unittest.mock import Mock, patch
 from lb_local.server import create_app
@@ -99,6 +101,31 @@ def authenticated_client(client):
     
     yield client
 
+@pytest.fixture
+def generate_lb_radio(authenticated_client):
+    """Post an LB Radio request and return the response once the playlist is generated.
+    The playlist is generated in the test process instead of the sync daemon."""
+    from lb_local.radio import RadioWorker
+
+    worker = RadioWorker(authenticated_client.application.config['DATABASE_FILE'], num_workers=1)
+    sync_client = Mock()
+    sync_client.submit_radio.side_effect = worker.submit
+    sync_client.radio_result.side_effect = worker.result
+
+    def generate(data):
+        response = authenticated_client.post('/lb-radio', data=data)
+        # Follow the polls of the placeholder until the playlist is there
+        while True:
+            job = re.search(r'hx-get="(/lb-radio/job/[0-9a-f-]+)"', response.get_data(as_text=True))
+            if job is None:
+                return response
+            time.sleep(.01)
+            response = authenticated_client.get(job.group(1))
+
+    with patch('lb_local.view.index.get_sync_client', return_value=sync_client):
+        yield generate
+    worker.shutdown()
+
 @pytest.fixture
 def admin_client(client):
     """Create a client with admin user"""
@@ -136,7 +163,7 @@ def admin_client(client):
 @pytest.fixture
 def mock_radio_service():
     """Mock the radio service for testing"""
-    with patch('lb_local.view.index.ListenBrainzRadioLocal') as mock_radio:
+    with patch('lb_local.radio.CachedListenBrainzRadioLocal') as mock_radio:
         # Mock the generate_playlist method
         mock_playlist = Mock()
         mock_playlist.playlists = [Mock()]
@@ -1,6 +1,30 @@
 #!/usr/bin/env python3
 
+import atexit
+import os
+import signal
+import subprocess
+import sys
+
 from lb_local.server import app
 
+
+def stop_sync_daemon(sync_daemon):
+    """ Stop the sync daemon the development server started. It stops on SIGTERM, as it does under uwsgi. """
+
+    sync_daemon.terminate()
+    try:
+        sync_daemon.wait(10)
+    except subprocess.TimeoutExpired:
+        sync_daemon.kill()
+
+
 if __name__ == '__main__':
+    # The development server starts its own sync daemon. With the reloader this script runs again in a child
+    # process on every reload, only the first run starts the daemon so it keeps running across reloads.
+    if not os.environ.get("WERKZEUG_RUN_MAIN"):
+        sync_daemon = subprocess.Popen([sys.executable, "-m", "lb_local.sync_daemon"])
+        # Stop the daemon along with the server, also when the server is terminated rather than interrupted
+        atexit.register(stop_sync_daemon, sync_daemon)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(debug=True, host="127.0.0.1", port=5000)
@@ -0,0 +1,116 @@
+import os
+import sys
+
+from dotenv import dotenv_values
+
+
+# The defaults of the optional settings. They are kept here rather than in the modules they tune, so that
+# loading the config does not import the sync daemon, the scans and LB Radio into every process that reads it.
+
+# Number of sync jobs that can be running at the same time and how many of those may be scanning their service
+# at once. Jobs waiting for a scan slot hold their place in the pool. A scan writes the content database as it
+# goes and SQLite takes one writer at a time, so by default one scan runs while the other job waits its turn.
+DEFAULT_SYNC_WORKERS = 2
+DEFAULT_SYNC_MAX_SCANS = 1
+
+# How many log lines of a sync job are kept in memory
+DEFAULT_SYNC_LOG_MAX_LINES = 10000
+
+# How many albums are fetched from a server at the same time, each over its own pooled connection
+DEFAULT_SCAN_CONCURRENCY = 4
+
+# How many recordings are written to the database in one transaction at least. Readers of the database are
+# never blocked by the writes, but every transaction makes the writer wait for the disk.
+DEFAULT_WRITE_BATCH_SIZE = 1000
+
+# Every how many transactions the scan copies its writes back from the write-ahead log to the database. SQLite
+# does that itself every 1000 pages otherwise, in whichever transaction crosses that. 0 leaves it to SQLite.
+DEFAULT_WAL_CHECKPOINT_BATCHES = 10
+
+# Number of LB Radio playlists generated at the same time and how many may be waiting or generating at once.
+# Requests beyond that are turned away rather than queued.
+DEFAULT_RADIO_WORKERS = 2
+DEFAULT_RADIO_MAX_PENDING = 20
+
+# How many prompts the candidates of the recording searches are cached for and for how long, in seconds
+DEFAULT_RADIO_CACHE_SIZE = 100
+DEFAULT_RADIO_CACHE_TTL = 60 * 60
+
+# Every how many seconds the stored weekly jams are checked for ones to generate again
+DEFAULT_WEEKLY_JAMS_REFRESH_INTERVAL = 60 * 60
+
+# For how many seconds a web worker uses its copy of a logged in user, and of the login of a session, before
+# reading it again
+DEFAULT_USER_CACHE_TTL = 60
+
+env_keys = ["DATABASE_FILE", "SECRET_KEY", "DOMAIN", "PORT", "AUTHORIZED_USERS", "ADMIN_USERS", "SERVICE_USERS",
+            "MUSICBRAINZ_CLIENT_ID", "MUSICBRAINZ_CLIENT_SECRET"]
+
+# Settings that may be defined in .env, with their defaults
+optional_env_keys = {"SYNC_WORKERS": DEFAULT_SYNC_WORKERS,
+                     "SYNC_MAX_SCANS": DEFAULT_SYNC_MAX_SCANS,
+                     "SYNC_LOG_MAX_LINES": DEFAULT_SYNC_LOG_MAX_LINES,
+                     "SYNC_LOG_DIR": "",
+                     "SYNC_SCAN_CONCURRENCY": DEFAULT_SCAN_CONCURRENCY,
+                     "SYNC_WRITE_BATCH_SIZE": DEFAULT_WRITE_BATCH_SIZE,
+                     "SYNC_WAL_CHECKPOINT_BATCHES": DEFAULT_WAL_CHECKPOINT_BATCHES,
+                     "RADIO_WORKERS": DEFAULT_RADIO_WORKERS,
+                     "RADIO_MAX_PENDING": DEFAULT_RADIO_MAX_PENDING,
+                     "RADIO_CACHE_SIZE": DEFAULT_RADIO_CACHE_SIZE,
+                     "RADIO_CACHE_TTL": DEFAULT_RADIO_CACHE_TTL,
+                     "WEEKLY_JAMS_REFRESH_INTERVAL": DEFAULT_WEEKLY_JAMS_REFRESH_INTERVAL,
+                     "USER_CACHE_TTL": DEFAULT_USER_CACHE_TTL}
+
+
+def load_config(logger):
+    """
+        Load the settings from the .env file, with the environment (e.g. the docker-compose file) overriding them.
+        Used by both the web app and the sync daemon, exits if a required setting is missing or invalid.
+    """
+
+    env_config = dotenv_values(".env")
+
+    for k in env_keys:
+        if k in os.environ:
+            env_config[k] = os.environ[k]
+
+        if k not in env_config:
+            logger.error("Setting '%s' must be defined in .env file." % k)
+            sys.exit(-1)
+
+    for k, default in optional_env_keys.items():
+        env_config[k] = type(default)(os.environ.get(k, env_config.get(k, default)))
+
+    for k in ("SYNC_LOG_MAX_LINES", "SYNC_SCAN_CONCURRENCY", "SYNC_WRITE_BATCH_SIZE", "RADIO_WORKERS",
+              "RADIO_MAX_PENDING", "RADIO_CACHE_SIZE", "WEEKLY_JAMS_REFRESH_INTERVAL"):
+        if env_config[k] < 1:
+            logger.error("Setting '%s' must be at least 1." % k)
+            sys.exit(-1)
+
+    for k in ("SYNC_WAL_CHECKPOINT_BATCHES", "RADIO_CACHE_TTL", "USER_CACHE_TTL"):
+        if env_config[k] < 0:
+            logger.error("Setting '%s' must not be negative." % k)
+            sys.exit(-1)
+
+    # Sets, as the role of the current user is checked several times for each page
+    env_config["AUTHORIZED_USERS"] = frozenset(x.strip() for x in env_config["AUTHORIZED_USERS"].split(","))
+    env_config["ADMIN_USERS"] = frozenset(x.strip() for x in env_config["ADMIN_USERS"].split(","))
+    env_config["SERVICE_USERS"] = frozenset(x.strip() for x in env_config["SERVICE_USERS"].split(","))
+
+    return env_config
+
+
+def sync_daemon_files(config):
+    """
+        Return the socket the sync daemon listens on and the status board it publishes to. Both live next to
+        the database, so every web worker of a deployment finds the same daemon.
+    """
+
+    db_file = config["DATABASE_FILE"]
+    return db_file + "-sync.sock", db_file + "-sync-status"
+
+
+def sync_authkey(config):
+    """ The key sync clients authenticate with when connecting to the sync daemon. """
+
+    return config["SECRET_KEY"].encode("utf-8")
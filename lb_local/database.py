@@ -1,16 +1,96 @@
 import logging
 import os
+import sqlite3
 import sys
 
 import peewee
+from playhouse.migrate import SqliteMigrator, migrate
 
+from lb_local.model.cache_generation import CacheGeneration
 from lb_local.model.credential import Credential
-from lb_local.model.database import user_db, setup_db
+from lb_local.model.database import user_db, setup_db, content_pool
 from lb_local.model.service import Service
+from lb_local.model.session import SessionRecord
+from lb_local.model.subsonic_album import SubsonicAlbum
+from lb_local.model.sync_job import SyncJobRecord
+from lb_local.model.top_tag import TopTag
 from lb_local.model.user import User
+from lb_local.model.weekly_jams import WeeklyJams
 
 logger = logging.getLogger(__name__)
 
+# Subsonic song ids are only unique on their own server, the scans key recordings on their file source too
+RECORDING_KEY_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS recording_file_source_file_id_file_id_type " \
+                      "ON recording (file_source, file_id, file_id_type)"
+
+# Indexes on troi's content tables that lb-local's own queries need. tag.name is unique, which indexes it already.
+CONTENT_INDEXES = (
+    # Covers the recordings of a tag, most tagged first, for paging through /tag/<tag>
+    "CREATE INDEX IF NOT EXISTS recording_tag_tag_id_count_recording_id ON recording_tag (tag_id, count, recording_id)",
+    RECORDING_KEY_INDEX,
+)
+
+# Recordings that predate the file_source column are given the slug of the service that lists their song, or of
+# the only service there is. Those of no known service are deleted, the next sync of their service adds them again.
+FILE_SOURCE_MIGRATION = (
+    """UPDATE recording
+          SET file_source = (SELECT service.slug
+                               FROM subsonic_album
+                               JOIN service ON service.id = subsonic_album.service_id
+                                  , json_each(subsonic_album.song_ids) AS song
+                              WHERE song.value = recording.file_id
+                              LIMIT 1)
+        WHERE file_source IS NULL AND file_id_type = 1""",
+    """UPDATE recording
+          SET file_source = (SELECT slug FROM service)
+        WHERE file_source IS NULL AND file_id_type = 1 AND (SELECT count(*) FROM service) = 1""",
+    """DELETE FROM recording_metadata
+        WHERE recording_id IN (SELECT id FROM recording WHERE file_source IS NULL AND file_id_type = 1)""",
+    """DELETE FROM recording_tag
+        WHERE recording_id IN (SELECT id FROM recording WHERE file_source IS NULL AND file_id_type = 1)""",
+    "DELETE FROM recording WHERE file_source IS NULL AND file_id_type = 1",
+)
+
+
+def add_file_source(conn):
+    """
+        Give the recording table the file_source column the scans write the service slug to, unless troi created it
+        already, and drop troi's key on the file id alone, which would make two services share a recording.
+    """
+
+    columns = {row[1] for row in conn.execute('PRAGMA table_info("recording")')}
+    if "file_source" not in columns:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        conn.execute("BEGIN")
+        try:
+            conn.execute("ALTER TABLE recording ADD COLUMN file_source TEXT")
+            if {"service", "subsonic_album", "recording_metadata", "recording_tag"} <= tables:
+                for statement in FILE_SOURCE_MIGRATION:
+                    conn.execute(statement)
+            conn.execute("COMMIT")
+        except sqlite3.OperationalError:
+            conn.execute("ROLLBACK")
+            raise
+    conn.execute("DROP INDEX IF EXISTS recording_file_id_file_id_type")
+
+
+def create_content_indexes():
+    """
+        Create the columns and indexes lb-local needs on the content tables, which must exist. Uses the content
+        pool.
+    """
+
+    with content_pool.connection(read_only=False) as conn:
+        try:
+            add_file_source(conn)
+        except sqlite3.OperationalError as e:
+            logger.warning("Cannot add the file source to the recordings, is troi up to date? %s" % e)
+        for index in CONTENT_INDEXES:
+            try:
+                conn.execute(index)
+            except sqlite3.OperationalError as e:
+                logger.warning("Cannot create content index, is troi up to date? %s" % e)
+
 
 class UserDatabase:
     '''
@@ -31,7 +111,18 @@ class UserDatabase:
             os.makedirs(db_dir, exist_ok=True)
             setup_db(self.db_file)
             user_db.connect()
-            user_db.create_tables((User, Service, Credential))
+            user_db.create_tables((User, Service, Credential, SyncJobRecord, SubsonicAlbum, TopTag,
+                                  WeeklyJams, CacheGeneration, SessionRecord))
+            # The job history is kept: columns added to it since its table was created are added to the table
+            columns = {column.name for column in user_db.get_columns(SyncJobRecord._meta.table_name)}
+            migrator = SqliteMigrator(user_db)
+            migrate(*[migrator.add_column(SyncJobRecord._meta.table_name, field.column_name, field)
+                      for field in SyncJobRecord._meta.sorted_fields if field.column_name not in columns])
+            # Sessions can be thrown away: a session table that lacks columns is created again, logging users out
+            columns = {column.name for column in user_db.get_columns(SessionRecord._meta.table_name)}
+            if columns != set(SessionRecord._meta.columns):
+                SessionRecord.drop_table()
+                SessionRecord.create_table()
         except Exception as e:
             logger.error("Failed to create db file %r: %s" % (self.db_file, e))
 
@@ -1,22 +1,97 @@
 from datetime import datetime, timezone
 from functools import wraps
+from threading import Lock
+from time import monotonic
 
-from flask import redirect, url_for
-from flask_login import current_user, LoginManager
-import peewee
+from flask import redirect, url_for, session
+from flask_login import current_user, LoginManager, user_logged_in, user_logged_out
+from lb_local.config import DEFAULT_USER_CACHE_TTL
 from lb_local.model.user import User
+from lb_local.session import regenerate_session, session_cache
 
-login_manager = LoginManager()
+
+class LazySessionLoginManager(LoginManager):
+    """ LoginManager that leaves the server-side session unloaded on requests that did not use it. """
+
+    def _update_remember_cookie(self, response):
+        # The remember cookie only changes when a user logs in or out, which loads the session
+        if not getattr(session, "loaded", True):
+            return response
+        return LoginManager._update_remember_cookie(self, response)
+
+
+login_manager = LazySessionLoginManager()
+
+# A session gets a new id when a user logs in or out, so an id that was handed out before can't be fixed on a user
+user_logged_in.connect(regenerate_session)
+user_logged_out.connect(regenerate_session)
 login_manager.login_view = "index_bp.welcome"
 
 
 
+class UserCache:
+    """
+        The logged in users by login id, so that authenticating each request of a user, such as the HTMX polls of
+        a page, doesn't query the user. Each web worker keeps its own copies for up to ttl seconds: the worker
+        that changes or deletes a user drops them at once, the other workers read the user again once their
+        copy expired. A ttl of 0 reads the user for every request.
+    """
+
+    def __init__(self, ttl=DEFAULT_USER_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = Lock()
+        # login id -> (user, when the copy expires)
+        self.users = {}
+
+    def configure(self, ttl):
+        with self.lock:
+            self.ttl = ttl
+            self.users = {}
+
+    def get(self, login_id):
+        now = monotonic()
+        with self.lock:
+            entry = self.users.get(login_id)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        user = User.select().where(User.login_id == login_id).get_or_none()
+        with self.lock:
+            if user is not None and self.ttl > 0:
+                self.users[login_id] = (user, now + self.ttl)
+            else:
+                self.users.pop(login_id, None)
+        return user
+
+    def invalidate(self, login_id=None):
+        """ Drop the copy of a user, or of all users if no login id is given. """
+
+        with self.lock:
+            if login_id is None:
+                self.users = {}
+            else:
+                self.users.pop(login_id, None)
+
+
+user_cache = UserCache()
+
+
+def init_user_cache(app):
+    # The session cache answers whom a request is from, the user cache who that is: together they authenticate
+    # requests without reading the database
+    user_cache.configure(app.config["USER_CACHE_TTL"])
+    session_cache.configure(app.config["USER_CACHE_TTL"])
+
+
+def invalidate_users(login_id=None):
+    """ Drop the cached copy of a user, or of all users, after a user was changed or deleted. """
+
+    user_cache.invalidate(login_id)
+
+
 @login_manager.user_loader
 def load_user(login_id):
-    try:
-        return User.select().where(User.login_id == login_id).get()
-    except peewee.DoesNotExist:
-        return None
+    return user_cache.get(login_id)
 
 
 def login_forbidden(f):
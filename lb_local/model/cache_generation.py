@@ -0,0 +1,31 @@
+from peewee import *
+
+from lb_local.model.database import user_db
+
+
+class CacheGeneration(Model):
+    """
+       A counter per cache that the web workers keep in memory. Bumping it when the data the cache holds changes
+       tells the caches of all web workers that their copies are stale, without them having to reread the data.
+    """
+
+    class Meta:
+        database = user_db
+        table_name = "cache_generation"
+
+    name = TextField(null=False, unique=True)
+    generation = IntegerField(null=False, default=0)
+
+    @classmethod
+    def current(cls, name):
+        row = cls.select(cls.generation).where(cls.name == name).get_or_none()
+        return row.generation if row is not None else 0
+
+    @classmethod
+    def bump(cls, name):
+        cls.insert(name=name, generation=1) \
+           .on_conflict(conflict_target=[cls.name], update={cls.generation: cls.generation + 1}) \
+           .execute()
+
+    def __repr__(self):
+        return "<CacheGeneration('%s' %d)>" % (self.name, self.generation)
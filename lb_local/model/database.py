@@ -1,4 +1,10 @@
+from contextlib import contextmanager
+import os
+import sqlite3
+from threading import Lock
+
 from peewee import SqliteDatabase
+from troi.content_resolver.model.database import db as content_db
 
 PRAGMAS = (
     ('foreign_keys', 1),
@@ -9,3 +15,94 @@ user_db = SqliteDatabase(None, pragmas=PRAGMAS)
 
 def setup_db(db_file):
     user_db.init(db_file)
+
+
+# Pragmas of the connections the web workers query the content database with: map up to 256MB of the file and
+# keep up to 32MB of pages in each connection's cache, so they stay warm between requests.
+CONTENT_POOL_PRAGMAS = (
+    ('foreign_keys', 1),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('cache_size', -32 * 1024),
+)
+
+# How many idle connections a web worker keeps open
+CONTENT_POOL_MAX_IDLE = 8
+
+
+class ContentConnectionPool:
+    """
+        A pool of connections to the content database (troi's db), opened once per web worker and lent to troi's
+        database object for the length of a request. The content views thus neither reopen the database file nor
+        redo its setup for every request. Connections are lent read-only unless a view asks for one to write with.
+    """
+
+    def __init__(self, database, max_idle=CONTENT_POOL_MAX_IDLE):
+        self.database = database
+        self.max_idle = max_idle
+        self.db_file = None
+        self.pid = None
+        self.idle = []
+        self.lock = Lock()
+
+    def init(self, db_file):
+        """ Point the pool at the database file, closing the connections to the previous one. """
+
+        self.database.init(db_file)
+        with self.lock:
+            self.db_file = db_file
+            self.pid = os.getpid()
+            idle, self.idle = self.idle, []
+        for conn, read_only in idle:
+            conn.close()
+
+    def open_connection(self):
+        # peewee manages the transactions itself, so the connection must not begin any on its own
+        conn = sqlite3.connect(self.db_file, timeout=5, isolation_level=None, check_same_thread=False)
+        for pragma, value in CONTENT_POOL_PRAGMAS:
+            conn.execute("PRAGMA %s = %s" % (pragma, value))
+        return conn
+
+    def acquire(self):
+        with self.lock:
+            # Connections must not be shared with the worker processes forked after they were opened
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.idle = []
+            if self.idle:
+                return self.idle.pop()
+
+        return self.open_connection(), None
+
+    def release(self, conn, read_only):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append((conn, read_only))
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self, read_only=True):
+        """
+            Lend a connection to the content database to the current thread. troi's queries run in the with
+            block use it, read-only ones fail to write.
+        """
+
+        if self.db_file is None:
+            raise RuntimeError("The content connection pool must be initialized before it is used.")
+
+        conn, conn_read_only = self.acquire()
+        if conn_read_only != read_only:
+            conn.execute("PRAGMA query_only = %d" % read_only)
+
+        # peewee keeps the connection of each thread in its connection state, see peewee's playhouse.pool
+        self.database._state.set_connection(conn)
+        try:
+            yield conn
+        finally:
+            self.database._state.reset()
+            if conn.in_transaction:
+                conn.rollback()
+            self.release(conn, read_only)
+
+
+content_pool = ContentConnectionPool(content_db)
@@ -0,0 +1,24 @@
+from peewee import *
+
+from lb_local.model.database import user_db
+
+
+class SessionRecord(Model):
+    """
+       The data of a browser session, so that the session cookie only has to carry the session id
+    """
+
+    class Meta:
+        database = user_db
+        table_name = "session"
+
+    sid = TextField(null=False, unique=True)
+    # The session data, as Flask's tagged JSON
+    data = TextField(null=False)
+    # When the session expires, as a unix timestamp. Indexed for sweeping the expired sessions.
+    expires = IntegerField(null=False, index=True)
+    # The login id of the user logged in with the session, for revoking the sessions of a user
+    login_id = TextField(null=True, index=True)
+
+    def __repr__(self):
+        return "<SessionRecord(%s %d)>" % (self.sid[:8], self.expires)
@@ -0,0 +1,25 @@
+from peewee import *
+
+from lb_local.model.database import user_db
+from lb_local.model.service import Service
+
+
+class SubsonicAlbum(Model):
+    """
+       Remember the albums of a service seen by the last incremental scan, so the next one can tell which changed
+    """
+
+    class Meta:
+        database = user_db
+        table_name = "subsonic_album"
+        indexes = ((('service', 'album_id'), True),)
+
+    service = ForeignKeyField(Service, on_delete="CASCADE")
+    album_id = TextField(null=False)
+    # Hash of the album's entry in the album list, it changes when the album does
+    fingerprint = TextField(null=False)
+    # JSON list of the subsonic ids of the album's songs
+    song_ids = TextField(null=False)
+
+    def __repr__(self):
+        return "<SubsonicAlbum('%s' '%s')>" % (self.album_id, self.fingerprint)
@@ -0,0 +1,37 @@
+from peewee import *
+
+from lb_local.model.credential import Credential
+from lb_local.model.database import user_db
+from lb_local.model.service import Service
+from lb_local.model.user import User
+
+
+class SyncJobRecord(Model):
+    """
+       Record each run of a sync job, so its outcome survives restarts and interrupted jobs can be resumed
+    """
+
+    class Meta:
+        database = user_db
+        table_name = "sync_job"
+
+    service = ForeignKeyField(Service, on_delete="CASCADE")
+    credential = ForeignKeyField(Credential, null=True, on_delete="SET NULL")
+    user = ForeignKeyField(User, null=True, on_delete="SET NULL")
+    type = TextField(null=False)
+    # queued, scanning, looking_up, complete, failed or interrupted
+    state = TextField(null=False)
+    # The run of an interrupted job that this run picks up
+    resumed_from = ForeignKeyField("self", null=True, on_delete="SET NULL")
+    created = IntegerField(null=False)
+    started = IntegerField(null=True)
+    finished = IntegerField(null=True)
+    # The last stats the job reported, as JSON
+    stats = TextField(null=True)
+    log_lines = IntegerField(null=False, default=0)
+    # The id of the last album the scan of the job wrote, a resumed full scan continues after it
+    scan_progress = TextField(null=True)
+    error = TextField(null=True)
+
+    def __repr__(self):
+        return "<SyncJobRecord(%s '%s' %s)>" % (self.id, self.type, self.state)
@@ -0,0 +1,36 @@
+from peewee import *
+
+from lb_local.model.database import user_db
+
+# How many tags the top tags page shows
+TOP_TAGS_LIMIT = 250
+
+
+class TopTag(Model):
+    """
+       The top tags of the collection, most used first. Rebuilt at the end of each sync so the top tags page
+       doesn't have to count the tags of the whole collection.
+    """
+
+    class Meta:
+        database = user_db
+        table_name = "top_tag"
+
+    tag = TextField(null=False)
+    count = IntegerField(null=False)
+
+    @classmethod
+    def rebuild(cls, top_tags):
+        """ Replace the top tags with the given list of {"tag": ..., "count": ...} dicts, most used first. """
+
+        with user_db.atomic():
+            cls.delete().execute()
+            if top_tags:
+                cls.insert_many([{"tag": t["tag"], "count": t["count"]} for t in top_tags]).execute()
+
+    @classmethod
+    def get_top_tags(cls, limit=TOP_TAGS_LIMIT):
+        return [{"tag": t.tag, "count": t.count} for t in cls.select().order_by(cls.id).limit(limit)]
+
+    def __repr__(self):
+        return "<TopTag('%s' %d)>" % (self.tag, self.count)
@@ -1,35 +1,25 @@
 import uuid
 
-from flask import current_app
+from flask import current_app, has_app_context
 from flask_login import UserMixin
 from peewee import *
 
 from lb_local.model.database import user_db
 
 
+def role_users(role):
+    """ The names of the users that have a role, e.g. "ADMIN_USERS", as the set loaded from the config. """
+
+    if has_app_context():
+        return current_app.config.get(role, frozenset())
+    return frozenset()
+
+
 class User(Model, UserMixin):
     """
        Store user information
     """
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs) 
-        # Try to get config from current app context first
-        try:
-            from flask import has_app_context
-            if has_app_context() and current_app:
-                self.authorized_users = current_app.config.get("AUTHORIZED_USERS", [])
-                self.admin_users = current_app.config.get("ADMIN_USERS", []) 
-                self.service_users = current_app.config.get("SERVICE_USERS", [])
-                return
-        except Exception:
-            pass
-            
-        # Fallback to empty lists if config unavailable
-        self.authorized_users = []
-        self.admin_users = []
-        self.service_users = []
-
     class Meta:
         database = user_db
         table_name = "user"
@@ -57,15 +47,15 @@ class User(Model, UserMixin):
 
     @property
     def is_authorized(self):
-        return self.name in self.authorized_users
+        return self.name in role_users("AUTHORIZED_USERS")
 
     @property
     def is_admin(self):
-        return self.name in self.admin_users
+        return self.name in role_users("ADMIN_USERS")
 
     @property
     def is_service_user(self):
-        return self.name in self.service_users
+        return self.name in role_users("SERVICE_USERS")
 
     def __repr__(self):
         return "<User('%s' '%s')>" % (self.user_id, self.name or "")
\ No newline at end of file
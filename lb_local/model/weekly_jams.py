@@ -0,0 +1,37 @@
+from peewee import *
+
+from lb_local.model.database import user_db
+
+
+class WeeklyJams(Model):
+    """
+       The weekly jams of a ListenBrainz user, resolved against the collection. The sync daemon generates them
+       once per period and the weekly jams page serves them from here.
+    """
+
+    class Meta:
+        database = user_db
+        table_name = "weekly_jams"
+
+    user_name = TextField(null=False, unique=True)
+    # The ISO week the jams were generated in, e.g. 2026-W42
+    period = TextField(null=False)
+    # generating or complete
+    state = TextField(null=False)
+    requested = IntegerField(null=False)
+    generated = IntegerField(null=True)
+    name = TextField(null=True)
+    description = TextField(null=True)
+    # The recordings of the playlist with what the playlist table shows of them, the hints and the JSPF, as JSON
+    recordings = TextField(null=True)
+    hints = TextField(null=True)
+    jspf = TextField(null=True)
+    errors = TextField(null=True)
+
+    def is_current(self, period):
+        """ True if these jams were generated successfully in the given period. """
+
+        return self.state == "complete" and self.period == period and not self.errors
+
+    def __repr__(self):
+        return "<WeeklyJams('%s' %s %s)>" % (self.user_name, self.period, self.state)
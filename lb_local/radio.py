@@ -0,0 +1,271 @@
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+import logging
+from threading import Lock
+from time import monotonic
+import traceback
+import uuid
+
+from troi.content_resolver.artist_search import LocalRecordingSearchByArtistService
+from troi.content_resolver.lb_radio import ListenBrainzRadioLocal
+from troi.content_resolver.subsonic import SubsonicDatabase
+from troi.content_resolver.tag_search import LocalRecordingSearchByTagService
+from troi.patches.lb_radio import LBRadioPatch
+
+from lb_local.config import DEFAULT_RADIO_WORKERS, DEFAULT_RADIO_MAX_PENDING, DEFAULT_RADIO_CACHE_SIZE, \
+    DEFAULT_RADIO_CACHE_TTL
+from lb_local.model.database import content_pool
+
+# How long a generated playlist is kept for its page to fetch, in seconds
+RADIO_RESULT_TTL = 10 * 60
+
+# How well a recording of the collection must match a recording of the playlist to be used, from 0 to 1.0
+MATCH_THRESHOLD = .8
+
+RadioRequest = namedtuple("RadioRequest", ["user_id", "mode", "prompt"])
+RadioJobRequest = namedtuple("RadioJobRequest", ["job_id"])
+RadioStatsRequest = namedtuple("RadioStatsRequest", [])
+# A result that is not complete has only the request fields set. Errors is set if no playlist was generated.
+RadioResult = namedtuple("RadioResult", ["complete",
+                                         "user_id",
+                                         "mode",
+                                         "prompt",
+                                         "errors",
+                                         "name",
+                                         "description",
+                                         "recordings",
+                                         "hints",
+                                         "jspf"], defaults=("", None, None, (), (), None))
+
+
+class CandidatePool:
+    """ The results of the recording searches made for one prompt and mode, by search. """
+
+    def __init__(self):
+        self.created = monotonic()
+        self.searches = {}
+
+
+class CandidateCache:
+    """
+        Cache the candidate recordings the recording searches of LB Radio find, which is the expensive part of
+        generating a playlist. Pools are kept for the max_entries prompts and modes used last, for at most ttl
+        seconds, and belong to a sync generation: when a sync finishes the collection may have changed, so
+        invalidate() starts a new generation and drops all pools. The playlists are still sampled from the
+        candidates afresh every time, so playlists for the same prompt keep varying.
+    """
+
+    def __init__(self, max_entries=DEFAULT_RADIO_CACHE_SIZE, ttl=DEFAULT_RADIO_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = Lock()
+        self.pools = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def pool(self, prompt, mode):
+        """ Return the candidate pool of a prompt and mode in the current sync generation. """
+
+        key = (prompt, mode, self.generation)
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool is not None and monotonic() - pool.created <= self.ttl:
+                self.pools.move_to_end(key)
+                return pool
+
+            pool = self.pools[key] = CandidatePool()
+            self.pools.move_to_end(key)
+            while len(self.pools) > self.max_entries:
+                self.pools.popitem(last=False)
+            return pool
+
+    def search(self, pool, key, search):
+        """
+            Return the result of a search from the pool, running the search if it is not in there yet. The
+            playlist pipeline changes the recordings it is given, so it gets a copy.
+        """
+
+        with self.lock:
+            if key in pool.searches:
+                self.hits += 1
+                return deepcopy(pool.searches[key])
+            self.misses += 1
+
+        result = search()
+        with self.lock:
+            pool.searches[key] = result
+        return deepcopy(result)
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.pools.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "entries": len(self.pools),
+                    "generation": self.generation}
+
+
+class CachedRecordingSearchByTagService(LocalRecordingSearchByTagService):
+
+    def __init__(self, cache, pool):
+        LocalRecordingSearchByTagService.__init__(self)
+        self.cache = cache
+        self.pool = pool
+
+    def search(self, tags, operator, pop_begin, pop_end, num_recordings):
+        key = ("tag", tuple(tags), operator, pop_begin, pop_end, num_recordings)
+        return self.cache.search(self.pool, key, lambda: LocalRecordingSearchByTagService.search(
+            self, tags, operator, pop_begin, pop_end, num_recordings))
+
+
+class CachedRecordingSearchByArtistService(LocalRecordingSearchByArtistService):
+
+    def __init__(self, cache, pool):
+        LocalRecordingSearchByArtistService.__init__(self)
+        self.cache = cache
+        self.pool = pool
+
+    def search(self, mode, artist_mbid, pop_begin, pop_end, max_recordings_per_artist, max_similar_artists):
+        # The similar artists are fetched from ListenBrainz by the search, so they are cached along with it
+        key = ("artist", mode, artist_mbid, pop_begin, pop_end, max_recordings_per_artist, max_similar_artists)
+        return self.cache.search(self.pool, key, lambda: LocalRecordingSearchByArtistService.search(
+            self, mode, artist_mbid, pop_begin, pop_end, max_recordings_per_artist, max_similar_artists))
+
+
+class CachedListenBrainzRadioLocal(ListenBrainzRadioLocal):
+    """ ListenBrainzRadioLocal with the recording searches answered from a candidate cache. """
+
+    def __init__(self, cache, quiet=False):
+        ListenBrainzRadioLocal.__init__(self, quiet)
+        self.cache = cache
+        self.patch = None
+
+    def generate(self, mode, prompt, match_threshold):
+        pool = self.cache.pool(prompt, mode)
+        self.patch = LBRadioPatch({"mode": mode, "prompt": prompt, "quiet": self.quiet, "min_recordings": 1})
+        self.patch.register_service(CachedRecordingSearchByTagService(self.cache, pool))
+        self.patch.register_service(CachedRecordingSearchByArtistService(self.cache, pool))
+
+        try:
+            playlist = self.patch.generate_playlist()
+        except RuntimeError as err:
+            logging.info(f"LB Radio generation failed: {err}")
+            return None
+
+        if playlist is None:
+            return playlist
+
+        self.resolve_playlist(match_threshold, playlist)
+        return playlist
+
+
+class RadioJob:
+
+    def __init__(self, request):
+        self.id = str(uuid.uuid4())
+        self.request = request
+        self.result = RadioResult(False, request.user_id, request.mode, request.prompt)
+        self.finished_at = None
+
+
+class RadioWorker:
+    """
+        Generate LB Radio playlists on a pool of threads, so that generating one does not hold up a web worker.
+        The web workers submit requests and fetch the results by job id, which any of them can do since this
+        runs in the sync daemon. At most max_pending jobs are waiting or generating, further requests are refused.
+    """
+
+    def __init__(self, db_file, num_workers=DEFAULT_RADIO_WORKERS, max_pending=DEFAULT_RADIO_MAX_PENDING,
+                 cache_size=DEFAULT_RADIO_CACHE_SIZE, cache_ttl=DEFAULT_RADIO_CACHE_TTL):
+        self.db_file = db_file
+        self.max_pending = max_pending
+        self.cache = CandidateCache(cache_size, cache_ttl)
+        self.lock = Lock()
+        self.jobs = {}
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="radio-job")
+
+    def submit(self, request):
+        """ Start generating a playlist and return the id of its job, or None if too many jobs are pending. """
+
+        with self.lock:
+            self.expire_jobs()
+            pending = sum(1 for job in self.jobs.values() if job.finished_at is None)
+            if pending >= self.max_pending:
+                return None
+            job = RadioJob(request)
+            self.jobs[job.id] = job
+
+        self.executor.submit(self.run_job, job)
+        return job.id
+
+    def result(self, job_id):
+        """ Return the RadioResult of a job, or None if there is no such job or its result expired. """
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job.result if job is not None else None
+
+    def stats(self):
+        """ Return the hit and miss counts of the candidate cache and the number of pending jobs. """
+
+        stats = self.cache.stats()
+        with self.lock:
+            stats["pending"] = sum(1 for job in self.jobs.values() if job.finished_at is None)
+        return stats
+
+    def expire_jobs(self):
+        now = monotonic()
+        for job_id in [job.id for job in self.jobs.values()
+                       if job.finished_at is not None and now - job.finished_at > RADIO_RESULT_TTL]:
+            del self.jobs[job_id]
+
+    def run_job(self, job):
+        try:
+            result = self.generate(job.request)
+        except BaseException:
+            # troi calls sys.exit() on some database errors, that must not take the pool thread down
+            logging.error(traceback.format_exc())
+            result = job.result._replace(complete=True, errors="An error occurred when generating the playlist.")
+
+        with self.lock:
+            job.result = result
+            job.finished_at = monotonic()
+
+    def generate(self, request):
+        """ Generate the playlist of a request and return its RadioResult. """
+
+        result = RadioResult(True, request.user_id, request.mode, request.prompt)
+
+        # Resolving the playlist records the recordings it could not find, so this needs a connection to write with
+        db = SubsonicDatabase(self.db_file, {}, quiet=True)
+        r = CachedListenBrainzRadioLocal(self.cache, quiet=True)
+        with content_pool.connection(read_only=False):
+            try:
+                playlist = r.generate(request.mode, request.prompt, MATCH_THRESHOLD)
+            except RuntimeError as err:
+                return result._replace(errors=str(err))
+
+            try:
+                recordings = playlist.playlists[0].recordings
+            except (IndexError, KeyError, AttributeError):
+                msgs = db.metadata_sanity_check(include_subsonic=True, return_as_array=True)
+                return result._replace(errors="\n".join(msgs))
+
+        hints = r.patch.user_feedback()
+        if not recordings:
+            hints.append("No recorings were available for playback. Have you sync'ed your service?")
+
+        return result._replace(name=playlist.playlists[0].name,
+                               description=playlist.playlists[0].description,
+                               recordings=recordings,
+                               hints=hints,
+                               jspf=playlist.get_jspf())
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
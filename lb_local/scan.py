@@ -0,0 +1,377 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+import hashlib
+import json
+import logging
+from time import time
+import uuid
+
+from peewee import SQL
+import requests
+from requests.adapters import HTTPAdapter
+from troi.content_resolver.model.database import db
+from troi.content_resolver.model.recording import Recording, RecordingMetadata, FileIdType
+from troi.content_resolver.model.tag import RecordingTag
+
+from lb_local.config import DEFAULT_SCAN_CONCURRENCY, DEFAULT_WRITE_BATCH_SIZE, DEFAULT_WAL_CHECKPOINT_BATCHES
+from lb_local.model.service import Service
+from lb_local.model.subsonic_album import SubsonicAlbum
+
+# Log through the same logger as troi's scans, so the lines end up in the log of the sync job
+logger = logging.getLogger("troi_subsonic_scan")
+
+API_VERSION = "1.16.1"
+CLIENT_NAME = "lb-local"
+
+# How many albums to ask for per album list request, the most that Subsonic servers hand out at once
+ALBUM_LIST_SIZE = 500
+REQUEST_TIMEOUT = 30
+
+# The columns of the recording table the scan writes, the first three identify a recording: song ids are only
+# unique on their own server, so the file source, the slug of the service, is part of the key
+RECORDING_COLUMNS = ("file_source", "file_id", "file_id_type", "mtime", "artist_name", "release_name",
+                     "recording_name", "artist_mbid", "release_mbid", "recording_mbid", "duration", "track_num",
+                     "disc_num")
+UPSERT_RECORDING = 'INSERT INTO "recording" (%s) VALUES (%s) ON CONFLICT ("file_source", "file_id", "file_id_type") ' \
+                   'DO UPDATE SET %s' % \
+    (", ".join('"%s"' % c for c in RECORDING_COLUMNS),
+     ", ".join("?" for c in RECORDING_COLUMNS),
+     ", ".join('"%s" = excluded."%s"' % (c, c) for c in RECORDING_COLUMNS[3:]))
+
+# The fields of an album list entry that make up its fingerprint. Any of them changing means the album changed.
+FINGERPRINT_FIELDS = ("name", "artist", "artistId", "songCount", "duration", "created", "changed", "year", "genre",
+                      "musicBrainzId", "coverArt")
+
+
+class SubsonicError(Exception):
+    pass
+
+
+class SubsonicClient:
+    """
+        A small client for the Subsonic API that keeps its connections to the server alive between requests.
+        It may be shared by as many threads as it has pooled connections.
+    """
+
+    def __init__(self, url, username, password, pool_size=1):
+        self.url = url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def call(self, method, **params):
+        """ Call an API method and return the subsonic-response of the server. """
+
+        salt = uuid.uuid4().hex
+        params.update({"u": self.username,
+                       "t": hashlib.md5((self.password + salt).encode("utf-8")).hexdigest(),
+                       "s": salt,
+                       "v": API_VERSION,
+                       "c": CLIENT_NAME,
+                       "f": "json"})
+        r = self.session.get("%s/rest/%s" % (self.url, method), params=params, timeout=REQUEST_TIMEOUT)
+        r.raise_for_status()
+
+        response = r.json()["subsonic-response"]
+        if response["status"] != "ok":
+            raise SubsonicError("%s failed: %s" % (method, response.get("error", {}).get("message", "unknown error")))
+        return response
+
+    def albums(self):
+        """ Return the album list entries of all albums on the server, newest first. """
+
+        albums = []
+        while True:
+            response = self.call("getAlbumList2", type="newest", size=ALBUM_LIST_SIZE, offset=len(albums))
+            page = response["albumList2"].get("album", [])
+            albums.extend(page)
+            if len(page) < ALBUM_LIST_SIZE:
+                return albums
+
+    def album(self, album_id):
+        return self.call("getAlbum", id=album_id)["album"]
+
+    def artist_mbid(self, artist_id):
+        return self.call("getArtistInfo2", id=artist_id)["artistInfo2"].get("musicBrainzId")
+
+    def close(self):
+        self.session.close()
+
+
+def fingerprint(album):
+    """ Hash the fields of an album list entry that change when the album does. """
+
+    fields = [album.get(field) for field in FINGERPRINT_FIELDS]
+    return hashlib.blake2b(json.dumps(fields).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class IncrementalScan:
+    """
+        Bring the recordings of one service up to date, fetching only the albums that were added or changed
+        since the last incremental scan and removing the recordings of albums that are gone. Albums are told
+        apart by the fingerprint of their album list entry, which is stored in the subsonic_album table.
+
+        Up to concurrency albums are fetched at the same time, through a client with as many pooled connections.
+        The fetched albums are written in the order of the album list, in transactions of at least batch_size
+        recordings. Every checkpoint_batches transactions the write-ahead log is checkpointed.
+
+        The first incremental scan of a service fetches every album, like a full sync does. A full scan fetches
+        every album whatever its fingerprint, in album list order. After each transaction on_progress, if given, is
+        called with the id of the last album written; a full scan given that id as resume_after skips the albums up
+        to it that are unchanged since, so an interrupted full scan picks up where it stopped. An interrupted
+        incremental scan needs no such help: the fingerprints of the albums it wrote are stored already.
+    """
+
+    def __init__(self, service_id, client, concurrency=DEFAULT_SCAN_CONCURRENCY, batch_size=DEFAULT_WRITE_BATCH_SIZE,
+                 checkpoint_batches=DEFAULT_WAL_CHECKPOINT_BATCHES, full=False, resume_after=None, on_progress=None):
+        self.service_id = service_id
+        # The recordings of the service are told apart from those of other services by its slug
+        self.file_source = Service.get_by_id(service_id).slug
+        self.client = client
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.checkpoint_batches = checkpoint_batches
+        self.full = full
+        self.resume_after = resume_after
+        self.on_progress = on_progress
+        self.batches = 0
+        self.artist_mbids = {}
+        self.albums = 0
+        self.added = 0
+        self.changed = 0
+        self.deleted = 0
+        self.errors = 0
+
+    def run(self):
+        """ Scan the service. The content database must be open. """
+
+        logger.info("[ load album list ]")
+        albums = self.client.albums()
+        known = {a.album_id: a for a in SubsonicAlbum.select().where(SubsonicAlbum.service == self.service_id)}
+        self.albums = len(albums)
+
+        # A full scan that is resumed skips the albums it wrote before it was interrupted
+        resuming = self.full and self.resume_after in {album["id"] for album in albums}
+        if resuming:
+            logger.info("[ resume full scan after album %s ]" % self.resume_after)
+
+        updates = []
+        for album in albums:
+            stored = known.pop(album["id"], None)
+            unchanged = stored is not None and stored.fingerprint == fingerprint(album)
+            if not unchanged or (self.full and not resuming):
+                updates.append((album, stored))
+            if album["id"] == self.resume_after:
+                resuming = False
+        logger.info("[ %d albums, %d to fetch, %d removed ]" % (len(albums), len(updates), len(known)))
+
+        # Checkpoint at the end of batches instead of in the middle of whichever one fills the log
+        if self.checkpoint_batches:
+            autocheckpoint = db.execute_sql("PRAGMA wal_autocheckpoint").fetchone()[0]
+            db.execute_sql("PRAGMA wal_autocheckpoint = 0")
+        try:
+            self.write_updates(updates)
+            self.delete_albums(list(known.values()))
+        finally:
+            if self.checkpoint_batches:
+                self.checkpoint()
+                db.execute_sql("PRAGMA wal_autocheckpoint = %d" % autocheckpoint)
+
+        logger.info("Checked %d albums:" % self.albums)
+        logger.info("  %5d albums added" % self.added)
+        logger.info("  %5d albums changed" % self.changed)
+        logger.info("  %5d albums removed" % self.deleted)
+        logger.info("  %5d albums with errors" % self.errors)
+
+    def write_updates(self, updates):
+        """
+            Fetch the new and changed albums and write them in batches. An album that cannot be fetched is
+            skipped and its fingerprint not stored, so the next scan tries it again.
+        """
+
+        # Keep a few albums more in flight than there are connections, so no connection waits for the writes
+        done = 0
+        batch = []
+        batch_rows = 0
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="scan") as executor:
+            for album, stored in updates:
+                # Run in a copy of this thread's context, so the log lines of the fetch go to the sync job
+                in_flight.append((album, executor.submit(copy_context().run, self.fetch_album, album, stored)))
+                if len(in_flight) < 2 * self.concurrency:
+                    continue
+                fetched = self.fetched(*in_flight.popleft())
+                if fetched is None:
+                    done += 1
+                    continue
+                batch.append(fetched)
+                batch_rows += len(fetched[2] or ())
+                if batch_rows >= self.batch_size:
+                    done += self.write_albums(batch)
+                    self.report(done, len(updates))
+                    batch = []
+                    batch_rows = 0
+
+            while in_flight:
+                fetched = self.fetched(*in_flight.popleft())
+                if fetched is None:
+                    done += 1
+                else:
+                    batch.append(fetched)
+        done += self.write_albums(batch)
+        self.report(done, len(updates))
+
+    def fetched(self, album, future):
+        """ Return the result of fetching an album, or None if that failed. """
+
+        try:
+            return future.result()
+        except Exception as err:
+            logger.info("FAIL: cannot fetch subsonic album %s '%s': %s" % (album["id"], album["name"], err))
+            self.errors += 1
+            return None
+
+    def report(self, done, total):
+        """ Log the stats of the scan for the sync job status. """
+
+        stats = [["Albums", self.albums],
+                 ["Added", self.added],
+                 ["Changed", self.changed],
+                 ["Removed", self.deleted],
+                 ["Errors", self.errors],
+                 ["Progress", int(done * 100 / total) if total else 100]]
+        logger.info("json-" + json.dumps(stats))
+
+    def fetch_album(self, album, stored):
+        """
+            Fetch a new or changed album and return it with its stored row and the recordings of its songs,
+            or None for the recordings if the album cannot be resolved. Runs on the threads of the scan.
+        """
+
+        album_info = self.client.album(album["id"])
+        album_mbid = album_info.get("musicBrainzId", album.get("musicBrainzId"))
+        if not album_mbid:
+            logger.info("FAIL: subsonic album '%s' by '%s' has no MBID" % (album["name"], album.get("artist", "")))
+            return album, stored, None
+
+        return album, stored, self.album_recordings(album_info, album_mbid)
+
+    def write_albums(self, batch):
+        """ Write the recordings of fetched albums in one transaction, then remember their fingerprints. """
+
+        if not batch:
+            return 0
+
+        rows = []
+        recordings = []
+        removed = set()
+        mtime = int(time())
+        for album, stored, album_recordings in batch:
+            song_ids = [r["file_id"] for r in album_recordings or []]
+            if stored is not None:
+                removed.update(set(json.loads(stored.song_ids)) - set(song_ids))
+            recordings.extend([self.file_source, r["file_id"], FileIdType.SUBSONIC_ID.value, mtime] +
+                              [r[c] for c in RECORDING_COLUMNS[4:]] for r in album_recordings or [])
+            rows.append({"service": self.service_id,
+                         "album_id": album["id"],
+                         "fingerprint": fingerprint(album),
+                         "song_ids": json.dumps(song_ids)})
+
+        with db.atomic():
+            db.cursor().executemany(UPSERT_RECORDING, recordings)
+            delete_recordings(self.file_source, removed)
+        self.batch_written()
+
+        # Only remember the albums once their recordings are written, an interrupted scan fetches them again
+        if rows:
+            SubsonicAlbum.insert_many(rows) \
+                         .on_conflict(conflict_target=[SubsonicAlbum.service, SubsonicAlbum.album_id],
+                                      preserve=[SubsonicAlbum.fingerprint, SubsonicAlbum.song_ids]) \
+                         .execute()
+        if self.on_progress is not None:
+            self.on_progress(batch[-1][0]["id"])
+
+        for album, stored, recordings in batch:
+            if recordings is None:
+                self.errors += 1
+            elif stored is None:
+                self.added += 1
+            else:
+                self.changed += 1
+            logger.info("album %-50s %-50s" % (album["name"][:49], album.get("artist", "")[:49]))
+
+        return len(batch)
+
+    def album_recordings(self, album_info, album_mbid):
+        """ Return the recordings of the songs of an album that have the MBIDs needed to resolve them. """
+
+        recordings = []
+        for song in album_info.get("song", []):
+            artist_id = song.get("artistId", album_info.get("artistId"))
+            # Two threads may look up the same artist at once, that costs a request but does no harm
+            if artist_id not in self.artist_mbids:
+                self.artist_mbids[artist_id] = self.client.artist_mbid(artist_id)
+            if not self.artist_mbids[artist_id] or not song.get("musicBrainzId"):
+                logger.info("FAIL: recording '%s' by '%s' has no MBIDs" % (song["title"], song.get("artist", "")))
+                continue
+
+            recordings.append({"file_id": song["id"],
+                               "artist_name": song.get("artist"),
+                               "release_name": song.get("album"),
+                               "recording_name": song["title"],
+                               "artist_mbid": self.artist_mbids[artist_id],
+                               "release_mbid": album_mbid,
+                               "recording_mbid": song["musicBrainzId"],
+                               "duration": song.get("duration", 0) * 1000,
+                               # Neither track number nor disc number are guaranteed for subsonic
+                               "track_num": song.get("track", 1),
+                               "disc_num": song.get("discNumber", 1)})
+        return recordings
+
+    def delete_albums(self, albums):
+        """ Delete the recordings of albums that are gone, in batches like the writes. """
+
+        batch = []
+        song_ids = []
+        for i, stored in enumerate(albums):
+            batch.append(stored.id)
+            song_ids.extend(json.loads(stored.song_ids))
+            if len(song_ids) < self.batch_size and i < len(albums) - 1:
+                continue
+
+            with db.atomic():
+                delete_recordings(self.file_source, song_ids)
+            SubsonicAlbum.delete().where(SubsonicAlbum.id.in_(batch)).execute()
+            self.batch_written()
+            self.deleted += len(batch)
+            batch = []
+            song_ids = []
+
+    def batch_written(self):
+        self.batches += 1
+        if self.checkpoint_batches and self.batches % self.checkpoint_batches == 0:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """ Copy what is in the write-ahead log to the database, without waiting for readers. """
+
+        db.execute_sql("PRAGMA wal_checkpoint(PASSIVE)")
+
+
+def delete_recordings(file_source, song_ids):
+    """ Delete the recordings of the given subsonic songs of a service, along with their metadata and tags. """
+
+    if not song_ids:
+        return
+
+    recording_ids = Recording.select(Recording.id) \
+                             .where(Recording.file_id.in_(list(song_ids)),
+                                    Recording.file_id_type == FileIdType.SUBSONIC_ID,
+                                    SQL('"file_source" = ?', (file_source,)))
+    RecordingMetadata.delete().where(RecordingMetadata.recording.in_(recording_ids)).execute()
+    RecordingTag.delete().where(RecordingTag.recording.in_(recording_ids)).execute()
+    Recording.delete().where(Recording.id.in_(recording_ids)).execute()
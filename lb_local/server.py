@@ -3,9 +3,6 @@ import os
 import sys
 from time import sleep
 from datetime import datetime
-import multiprocessing
-from threading import get_ident
-import signal
 
 import peewee
 from authlib.integrations.flask_client import OAuth
@@ -14,18 +11,20 @@ from flask_admin import Admin
 from flask_admin.contrib.peewee import ModelView
 from flask_cors import CORS
 from flask_login import login_user, logout_user
-from dotenv import dotenv_values
 
-from lb_local.database import UserDatabase
-from lb_local.login import fetch_token, login_manager
+from lb_local.config import load_config, sync_daemon_files, sync_authkey
+from lb_local.database import UserDatabase, create_content_indexes
+from lb_local.login import fetch_token, login_manager, init_user_cache, invalidate_users
 from lb_local.model.credential import Credential
+from lb_local.model.database import content_pool
 from lb_local.model.service import Service
 from lb_local.model.user import User
+from lb_local.session import ServerSideSessionInterface
 from lb_local.view.admin import UserModelView, ServiceCredentialModelView
 from lb_local.view.credential import credential_bp, load_credentials
 from lb_local.view.index import index_bp
 from lb_local.view.service import service_bp
-from lb_local.sync import SyncManager
+from lb_local.status_board import StatusBoard
 from troi.content_resolver.subsonic import SubsonicDatabase
 
 # TODO:
@@ -40,53 +39,17 @@ STATIC_PATH = "/static"
 STATIC_FOLDER = "static"
 TEMPLATE_FOLDER = "templates"
 
-env_keys = ["DATABASE_FILE", "SECRET_KEY", "DOMAIN", "PORT", "AUTHORIZED_USERS", "SERVICE_USERS",
-            "MUSICBRAINZ_CLIENT_ID", "MUSICBRAINZ_CLIENT_SECRET"]
-
-submit_queue = multiprocessing.Queue()
-stats_req_queue = multiprocessing.Queue()
-stats_queue = multiprocessing.Queue()
-stop_event = multiprocessing.Event()
-sync_manager = None
-manager_owner_tid = None
-
 class Config:
     def __init__(self, **entries):
         self.__dict__.update(entries)
 
 
-def signal_handler(signum, frame):
-    if sync_manager is not None and get_ident() == manager_owner_tid:
-        stop_event.set()
-        sync_manager.join()
-        os._exit(0)
-    raise KeyboardInterrupt
-
-signal.signal(signal.SIGTERM, signal_handler)
-signal.signal(signal.SIGINT, signal_handler)
-
 def create_app():
     
-    global sync_manager
-    
     app = Flask(__name__, static_url_path=STATIC_PATH, static_folder=STATIC_FOLDER, template_folder=TEMPLATE_FOLDER)
 
-    # Load the .env file config    
-    env_config = dotenv_values(".env")
-    
-    # Have the docker-compose file override any settings from .env
-    for k in env_keys:
-        if k in os.environ:
-            env_config[k] = os.environ[k]
-            
-        if k not in env_config:
-            app.logger.error("Setting '%s' must be defined in .env file." % k)
-            sys.exit(-1)
-            
-    env_config["AUTHORIZED_USERS"] = [ x.strip() for x in env_config["AUTHORIZED_USERS"].split(",") ]
-    env_config["ADMIN_USERS"] = [ x.strip() for x in env_config["ADMIN_USERS"].split(",") ]
-    env_config["SERVICE_USERS"] = [ x.strip() for x in env_config["SERVICE_USERS"].split(",") ]
-    app.config.from_mapping(env_config)
+    # Load the .env file config, the docker-compose file may override any settings from it
+    app.config.from_mapping(load_config(app.logger))
 
     db_file = app.config["DATABASE_FILE"]
     exists = os.path.exists(db_file)
@@ -97,8 +60,16 @@ def create_app():
         db = SubsonicDatabase(app.config["DATABASE_FILE"], Config(**{}), quiet=False)
         db.create()
     else:
+        # Opening it creates the tables that were added since the database was created
         print("Database exists, opening...")
-        udb.open()
+        udb.create()
+
+    # The content views query the database over the connections of this pool
+    content_pool.init(db_file)
+    create_content_indexes()
+
+    # The session cookie only carries the session id, the session data is kept in the database
+    app.session_interface = ServerSideSessionInterface()
 
     # UPdate with credentials from config
     CORS(app)
@@ -133,16 +104,18 @@ def create_app():
     admin.add_view(ServiceCredentialModelView(Credential, "Credential"))
 
     login_manager.init_app(app)
-
-    if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN'):
-        manager_owner_tid = get_ident()
-        sync_manager = SyncManager(submit_queue, stats_req_queue, stats_queue, stop_event, db_file)
-        sync_manager.start()
-
-    app.config["STATS_QUEUE"] = stats_queue
-    app.config["STATS_REQ_QUEUE"] = stats_req_queue
-    app.config["SUBMIT_QUEUE"] = submit_queue
-    app.config["STOP_EVENT"] = stop_event
+    init_user_cache(app)
+
+    # Syncs are run by the sync daemon (lb_local/sync_daemon.py), which all web workers share. It publishes the
+    # status of sync jobs to the status board and takes jobs and log requests on its socket.
+    sync_address, status_board_file = sync_daemon_files(app.config)
+    if not os.path.exists(status_board_file):
+        StatusBoard.create(status_board_file)
+    status_board = StatusBoard(status_board_file)
+    status_board.open()
+    app.config["STATUS_BOARD"] = status_board
+    app.config["SYNC_ADDRESS"] = sync_address
+    app.config["SYNC_AUTHKEY"] = sync_authkey(app.config)
     
     # Add basic error handler for 500 errors
     @app.errorhandler(500)
@@ -186,6 +159,7 @@ def auth():
             return redirect("/welcome")
 
     user.save()
+    invalidate_users(user.login_id)
 
     login_user(user)
 
@@ -0,0 +1,251 @@
+import logging
+import secrets
+from threading import Lock
+from time import monotonic, time
+
+from flask import session as current_session
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+
+from lb_local.config import DEFAULT_USER_CACHE_TTL
+from lb_local.model.session import SessionRecord
+
+logger = logging.getLogger(__name__)
+
+# Every how many seconds a web worker deletes the expired sessions
+SESSION_SWEEP_INTERVAL = 60 * 60
+
+# The keys flask-login reads from the session on every request
+AUTH_KEYS = ("_user_id", "_fresh", "_id")
+
+
+class SessionCache:
+    """
+        The auth keys of the sessions a web worker served lately, by session id, so that flask-login can
+        authenticate a request without reading its session. Other keys, such as flashed messages, are always
+        read from the session table. A copy is used for up to ttl seconds and never past the expiry of its
+        session; the worker that rotates or deletes a session drops its copy at once, the other workers only hold
+        copies of ids the browser no longer sends. A ttl of 0 reads the session for every request.
+    """
+
+    def __init__(self, ttl=DEFAULT_USER_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = Lock()
+        # sid -> (auth keys, when the session expires, when the copy expires)
+        self.sessions = {}
+
+    def configure(self, ttl):
+        with self.lock:
+            self.ttl = ttl
+            self.sessions = {}
+
+    def get(self, sid):
+        with self.lock:
+            entry = self.sessions.get(sid)
+        if entry is None:
+            return None
+
+        auth, expires, cached_until = entry
+        if cached_until <= monotonic() or expires <= time():
+            return None
+        return auth
+
+    def put(self, sid, data, expires):
+        with self.lock:
+            if self.ttl > 0:
+                auth = {key: data[key] for key in AUTH_KEYS if key in data}
+                self.sessions[sid] = (auth, expires, monotonic() + self.ttl)
+
+    def drop(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+
+session_cache = SessionCache()
+
+
+class ServerSideSession(SessionMixin):
+    """
+        A session whose data is kept in the session table. The data is only read the first time a view uses the
+        session, so requests that don't, such as the HTMX polls of anonymous pages, don't query the database. The
+        auth keys are answered from the session cache while it has them, so authenticating doesn't either.
+    """
+
+    def __init__(self, sid=None):
+        self.sid = sid
+        self.modified = False
+        self.accessed = False
+        # When the stored session expires, known once the session is loaded
+        self.expires = None
+        # The id the session had before it was regenerated, which is deleted when the session is saved
+        self.previous_sid = None
+        # Whether auth keys were answered from the session cache
+        self.auth_used = False
+        self._data = None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = {}
+            if self.sid is not None:
+                row = SessionRecord.select(SessionRecord.data, SessionRecord.expires) \
+                                   .where((SessionRecord.sid == self.sid) & (SessionRecord.expires > int(time()))) \
+                                   .get_or_none()
+                if row is None:
+                    # Never take on an id the server did not hand out, or one that expired: a new one is minted
+                    self.sid = None
+                else:
+                    self._data = session_json_serializer.loads(row.data)
+                    self.expires = row.expires
+                    session_cache.put(self.sid, self._data, self.expires)
+        return self._data
+
+    def cached_auth(self):
+        """ Return the auth keys of the session from the session cache, or None if the session must be read. """
+
+        if self._data is not None or self.sid is None:
+            return None
+        auth = session_cache.get(self.sid)
+        if auth is not None:
+            self.auth_used = True
+        return auth
+
+    def regenerate(self):
+        """ Move the session to a new id, so that an id handed out before a user logged in or out is of no use. """
+
+        self.data
+        if self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = None
+        self.expires = None
+        self.modified = True
+
+    def __getitem__(self, key):
+        if key in AUTH_KEYS:
+            auth = self.cached_auth()
+            if auth is not None:
+                return auth[key]
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __bool__(self):
+        # flask-login checks whether the session is empty on every request
+        if self.cached_auth():
+            return True
+        return len(self.data) > 0
+
+    def __repr__(self):
+        return "<ServerSideSession(%s %s)>" % (self.sid[:8] if self.sid else None,
+                                               self._data if self.loaded else "not loaded")
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+        Keep the session data in the session table and only its id in the cookie, instead of signing all of the
+        data into the cookie that each request sends. Stored sessions expire after the app's
+        PERMANENT_SESSION_LIFETIME; using a session renews its expiry once half of it has passed.
+    """
+
+    def __init__(self, sweep_interval=SESSION_SWEEP_INTERVAL):
+        self.sweep_interval = sweep_interval
+        self.lock = Lock()
+        self.next_sweep = 0
+
+    def open_session(self, app, request):
+        return ServerSideSession(request.cookies.get(self.get_cookie_name(app)) or None)
+
+    def save_session(self, app, session, response):
+        now = int(time())
+        self.sweep(now)
+
+        # Flask marks the session accessed whenever the session proxy is used, only these sessions were read
+        if session.loaded or session.auth_used:
+            response.vary.add("Cookie")
+        if not session.loaded:
+            return
+
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.previous_sid is not None:
+            SessionRecord.delete().where(SessionRecord.sid == session.previous_sid).execute()
+            session_cache.drop(session.previous_sid)
+
+        if not session:
+            if session.sid is not None:
+                SessionRecord.delete().where(SessionRecord.sid == session.sid).execute()
+                session_cache.drop(session.sid)
+            if session.sid is not None or session.previous_sid is not None:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        lifetime = int(app.permanent_session_lifetime.total_seconds())
+        renew = session.expires is None or session.expires - now < lifetime // 2
+        if not session.modified and not renew:
+            return
+
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        session.expires = now + lifetime
+        SessionRecord.insert(sid=session.sid, data=session_json_serializer.dumps(dict(session)),
+                             expires=session.expires, login_id=session.get("_user_id")) \
+                     .on_conflict(conflict_target=[SessionRecord.sid],
+                                  preserve=[SessionRecord.data, SessionRecord.expires, SessionRecord.login_id]) \
+                     .execute()
+        session_cache.put(session.sid, session.data, session.expires)
+
+        response.set_cookie(name,
+                            session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain,
+                            path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+    def sweep(self, now):
+        """ Delete the expired sessions, at most once every sweep_interval seconds per web worker. """
+
+        with self.lock:
+            if now < self.next_sweep:
+                return
+            self.next_sweep = now + self.sweep_interval
+
+        try:
+            SessionRecord.delete().where(SessionRecord.expires <= now).execute()
+        except Exception as err:
+            logger.warning("Cannot delete the expired sessions: %s" % err)
+
+
+def regenerate_session(*args, **kwargs):
+    """ Move the current session to a new id. Takes the arguments of flask-login's login and logout signals. """
+
+    regenerate = getattr(current_session, "regenerate", None)
+    if regenerate is not None:
+        regenerate()
+
+
+def revoke_sessions(login_id):
+    """ Delete the sessions a user is logged in with, e.g. after the user was deleted. """
+
+    sessions = SessionRecord.select(SessionRecord.sid).where(SessionRecord.login_id == login_id)
+    for record in sessions:
+        session_cache.drop(record.sid)
+    SessionRecord.delete().where(SessionRecord.login_id == login_id).execute()
@@ -302,3 +302,34 @@ function clear_playing_now_row(index) {
     element.classList.remove("table-active");
   }
 }
+
+// How long ago a sync was, in the largest unit that fits
+const TIME_AGO_UNITS = [
+  ["year", 365 * 24 * 60 * 60],
+  ["month", 30 * 24 * 60 * 60],
+  ["week", 7 * 24 * 60 * 60],
+  ["day", 24 * 60 * 60],
+  ["hour", 60 * 60],
+  ["minute", 60],
+  ["second", 1],
+];
+
+function time_ago(timestamp) {
+  var seconds = Math.round(Date.now() / 1000 - timestamp);
+  var format = new Intl.RelativeTimeFormat(undefined, { numeric: "auto" });
+  for (const [unit, length] of TIME_AGO_UNITS) {
+    if (seconds >= length || unit == "second")
+      return format.format(-Math.floor(seconds / length), unit);
+  }
+}
+
+// Render the <time data-timestamp="..."> elements of content htmx loaded as how long ago they were
+function format_times(element) {
+  for (const time of element.querySelectorAll("time[data-timestamp]")) {
+    var timestamp = parseInt(time.dataset.timestamp);
+    time.textContent = time_ago(timestamp);
+    time.title = new Date(timestamp * 1000).toLocaleString();
+  }
+}
+
+htmx.onLoad(format_times);
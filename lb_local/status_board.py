@@ -0,0 +1,149 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+from collections import OrderedDict
+from threading import Lock
+from time import sleep
+
+# The board is a file of fixed size slots, one per service. Each slot starts with a header holding a sequence
+# number, the length of the payload and a key derived from the service slug, followed by the JSON payload.
+NUM_SLOTS = 256
+SLOT_SIZE = 4096
+SLOT_HEADER = struct.Struct("<QI16s")
+SEQ = struct.Struct("<Q")
+KEY_OFFSET = 12
+MAX_PAYLOAD = SLOT_SIZE - SLOT_HEADER.size
+BOARD_SIZE = NUM_SLOTS * SLOT_SIZE
+EMPTY_KEY = bytes(16)
+# How often a reader retries a slot that is being written before it gives up
+MAX_READ_RETRIES = 100
+
+
+class StatusBoard:
+    '''
+       Share the status of sync jobs between the sync process, which writes it, and the web workers, which
+       read it without having to ask the sync process. The board lives in a memory mapped file.
+
+       A service's slot is found by hashing its key to a home slot and probing the following slots until the key
+       or an empty slot turns up, so looking up a service that has no status stops at the first empty slot.
+
+       Writers update a slot under a sequence lock: the sequence number is odd while a slot is being written.
+       Readers copy the slot and retry if the sequence number was odd or changed while they read it, giving up
+       after MAX_READ_RETRIES attempts.
+    '''
+
+    def __init__(self, board_file):
+        self.board_file = board_file
+        self.mm = None
+        self.lock = Lock()
+        # key -> offset of the slot last seen holding that key
+        self.slots = {}
+        # key -> offset of the slots this board has published to, least recently published first
+        self.published = OrderedDict()
+
+    @staticmethod
+    def create(board_file):
+        """ Create an empty board file, wiping the contents of any existing board. """
+
+        # Never shrink the file: another process may still have it mapped
+        fd = os.open(board_file, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, "r+b") as f:
+            f.write(bytes(BOARD_SIZE))
+            f.truncate(BOARD_SIZE)
+
+    @staticmethod
+    def key(slug):
+        return hashlib.blake2b(slug.encode("utf-8"), digest_size=16).digest()
+
+    def open(self):
+        with open(self.board_file, "r+b") as f:
+            self.mm = mmap.mmap(f.fileno(), BOARD_SIZE)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def slot_key(self, offset):
+        return self.mm[offset + KEY_OFFSET:offset + KEY_OFFSET + len(EMPTY_KEY)]
+
+    def probe(self, key):
+        """ Return the offset of the slot holding the given key, or of the first empty slot on the way to it. """
+
+        home = int.from_bytes(key[:4], "little") % NUM_SLOTS
+        for i in range(NUM_SLOTS):
+            offset = (home + i) % NUM_SLOTS * SLOT_SIZE
+            slot_key = self.slot_key(offset)
+            if slot_key == key or slot_key == EMPTY_KEY:
+                return offset
+        return None
+
+    def find_slot(self, key):
+        """ Return the offset of the slot for the given key, or None if the key has no slot. """
+
+        offset = self.slots.get(key)
+        if offset is not None and self.slot_key(offset) == key:
+            return offset
+
+        offset = self.probe(key)
+        if offset is None or self.slot_key(offset) != key:
+            return None
+        self.slots[key] = offset
+        return offset
+
+    def publish(self, slug, status):
+        """ Write the status (a JSON serializable dict) of the given service to its slot. """
+
+        key = self.key(slug)
+        payload = json.dumps(status).encode("utf-8")
+        if len(payload) > MAX_PAYLOAD:
+            raise ValueError("status for '%s' is too large for the status board" % slug)
+
+        with self.lock:
+            offset = self.published.get(key)
+            if offset is None:
+                offset = self.probe(key)
+            if offset is None:
+                # The board is full: reuse the slot of the service that was published least recently
+                _, offset = self.published.popitem(last=False)
+            self.published[key] = offset
+            self.published.move_to_end(key)
+
+            seq, = SEQ.unpack_from(self.mm, offset)
+            SEQ.pack_into(self.mm, offset, seq + 1)
+            self.mm[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + len(payload)] = payload
+            SLOT_HEADER.pack_into(self.mm, offset, seq + 1, len(payload), key)
+            SEQ.pack_into(self.mm, offset, seq + 2)
+
+    def sequence(self, slug):
+        """
+            Return the sequence number of the slot of the given service, which grows with every status published
+            to it, or 0 if the service has no slot. Cheap enough to check often for a new status.
+        """
+
+        offset = self.find_slot(self.key(slug))
+        if offset is None:
+            return 0
+        seq, = SEQ.unpack_from(self.mm, offset)
+        return seq
+
+    def read(self, slug):
+        """ Return the last published status of the given service, or None if it has none. """
+
+        key = self.key(slug)
+        for _ in range(MAX_READ_RETRIES):
+            offset = self.find_slot(key)
+            if offset is None:
+                return None
+
+            seq, length, slot_key = SLOT_HEADER.unpack_from(self.mm, offset)
+            if not seq & 1:
+                payload = self.mm[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + length]
+                seq_after, = SEQ.unpack_from(self.mm, offset)
+                if seq_after == seq and slot_key == key:
+                    return json.loads(payload)
+            # Let the writer finish the slot
+            sleep(0)
+        return None
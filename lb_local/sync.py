@@ -1,22 +1,38 @@
-from collections import namedtuple
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
 import os
 import json
 import logging
-from logging.handlers import QueueHandler
+from itertools import count
 import multiprocessing
-from queue import Queue, Empty, Full
-from time import sleep
-from threading import Thread, Lock
+from multiprocessing.connection import Listener, Client, AuthenticationError
+from queue import Queue
+from threading import Thread, Lock, BoundedSemaphore, local
+from time import monotonic, time
 import traceback
 from urllib.parse import urlparse
 import uuid
 import hashlib
 
+import peewee
+from playhouse.shortcuts import model_to_dict
 from troi.content_resolver.subsonic import SubsonicDatabase
 from troi.content_resolver.metadata_lookup import MetadataLookup
+from troi.content_resolver.top_tags import TopTags
 
+from lb_local.config import DEFAULT_SYNC_WORKERS, DEFAULT_SYNC_MAX_SCANS, DEFAULT_SYNC_LOG_MAX_LINES, \
+    DEFAULT_SCAN_CONCURRENCY, DEFAULT_WRITE_BATCH_SIZE, DEFAULT_WAL_CHECKPOINT_BATCHES, DEFAULT_RADIO_WORKERS, \
+    DEFAULT_RADIO_MAX_PENDING, DEFAULT_RADIO_CACHE_SIZE, DEFAULT_RADIO_CACHE_TTL, DEFAULT_WEEKLY_JAMS_REFRESH_INTERVAL
 from lb_local.view.credential import load_credentials
+from lb_local.model.database import content_pool
 from lb_local.model.service import Service
+from lb_local.model.sync_job import SyncJobRecord
+from lb_local.model.top_tag import TopTag, TOP_TAGS_LIMIT
+from lb_local.scan import IncrementalScan, SubsonicClient
+from lb_local.radio import RadioWorker, RadioRequest, RadioJobRequest, RadioStatsRequest
+from lb_local.status_board import StatusBoard, MAX_PAYLOAD
+from lb_local.weekly_jams import WeeklyJamsWorker, WeeklyJamsRequest
 
 # TODO:
 # - Progress bar 100%
@@ -24,36 +40,183 @@ from lb_local.model.service import Service
 
 APP_LOG_LEVEL_NUM = 19
 
-logging_queue = Queue()
+# How many lines make up a chunk of the log of a sync job at most
+LOG_CHUNK_LINES = 500
+
+# How often a running job publishes its log offset to the status board and how much of an error is published
+STATUS_PUBLISH_INTERVAL = .5
+MAX_PUBLISHED_ERROR_LENGTH = 2000
+
+# How often a running job saves its stats and log offset to its sync_job record
+RECORD_SAVE_INTERVAL = 5
+
+# States of the sync_job records of jobs that have not finished. A job whose scan was done only needs its
+# metadata looked up when it is resumed.
+UNFINISHED_STATES = ("queued", "scanning", "looking_up")
+
+# How long a client waits for the sync manager to answer a request, in seconds
+REPLY_TIMEOUT = 3.0
+
+# The sync job running in the current thread, if any
+current_job = ContextVar("current_job", default=None)
+
+# Each thread talks to the sync manager over its own connection, so a reply can only ever reach the caller
+# that asked for it. Connections are kept per process too: a forked process must not share its parent's.
+client_connections = local()
+
+
+class JobLogHandler(logging.Handler):
+    """
+        Hand each log record to the sync job that logged it. Records logged outside of a sync job are dropped.
+    """
+
+    def emit(self, record):
+        job = current_job.get()
+        if job is None:
+            return
+
+        try:
+            job.add_log_message(record.getMessage())
+        except Exception:
+            self.handleError(record)
+
+
 logger = logging.getLogger("troi_subsonic_scan")
-logger.addHandler(QueueHandler(logging_queue))
+logger.addHandler(JobLogHandler())
 logger.setLevel(APP_LOG_LEVEL_NUM)
 
 class Config:
     def __init__(self, **entries):
         self.__dict__.update(entries)
         
+# record_id is the id of the job's sync_job record, set by the worker if it records jobs
 SubmitMessage = namedtuple("SubmitMessage", ["service",
                                              "credential",
                                              "user_id",
                                              "expire_at",
-                                             "type"])
+                                             "type",
+                                             "record_id"], defaults=(None,))
 StatusMessage = namedtuple("StatusMessage", ["complete",
                                              "error_msg",
                                              "stats",
-                                             "logs"])
+                                             "log_offset"])
+# A job_id of None asks for the log of the latest job, a job id for the log of that job only
+LogRequest = namedtuple("LogRequest", ["slug", "job_id", "chunk"])
+LogChunk = namedtuple("LogChunk", ["text", "next_chunk", "job_id"])
+
+
+def published_status(status):
+    """
+        Return a StatusMessage as a dict for the status board, with as much of the end of its error message as
+        fits in a slot next to the rest of the status: that is where the traceback ends. The slot holds
+        MAX_PAYLOAD bytes of JSON, in which a character that is not ASCII takes up to 12 bytes.
+    """
+
+    status = status._asdict()
+    error_msg = status["error_msg"][-MAX_PUBLISHED_ERROR_LENGTH:]
+    status["error_msg"] = ""
+    room = MAX_PAYLOAD - len(json.dumps(status).encode("utf-8"))
+
+    # Find the longest end of the message that fits, the quotes around it are counted with the rest
+    keep = len(error_msg)
+    if len(json.dumps(error_msg)) - 2 > room:
+        low, keep = 0, 0
+        high = len(error_msg)
+        while low <= high:
+            mid = (low + high) // 2
+            if len(json.dumps(error_msg[len(error_msg) - mid:])) - 2 <= room:
+                keep, low = mid, mid + 1
+            else:
+                high = mid - 1
+    status["error_msg"] = error_msg[len(error_msg) - keep:]
+    return status
+
+
+class SyncLog:
+    """
+        The log of one sync job, kept as a ring of fixed size chunks. Once more than max_lines lines are
+        in memory the oldest chunk is dropped or, if a spill file is given, appended to that file. Chunks hold
+        LOG_CHUNK_LINES lines, or max_lines if that is less, so max_lines is rounded up to whole chunks.
+    """
+
+    def __init__(self, max_lines=DEFAULT_SYNC_LOG_MAX_LINES, spill_file=None):
+        if max_lines < 1:
+            raise ValueError("a sync log must keep at least one line")
+        self.chunk_lines = min(LOG_CHUNK_LINES, max_lines)
+        self.max_chunks = -(-max_lines // self.chunk_lines)
+        self.spill_file = spill_file
+        # id of the job this is the log of, handed out with each chunk
+        self.job_id = None
+        self.closed = False
+        self.chunks = deque()
+        # index of the first chunk still in memory
+        self.first_chunk = 0
+        # (offset, length) in the spill file of each spilled chunk
+        self.spilled = []
+        self.lines = 0
+
+    def append(self, line):
+        if not self.chunks or len(self.chunks[-1]) >= self.chunk_lines:
+            if len(self.chunks) == self.max_chunks:
+                self.evict()
+            self.chunks.append([])
+
+        self.chunks[-1].append(line)
+        self.lines += 1
+
+    def evict(self):
+        text = "\n".join(self.chunks.popleft()) + "\n"
+        self.first_chunk += 1
+        if not self.spill_file:
+            return
 
-class SyncClient:
-    def __init__(self, submit_queue, stats_req_queue, stats_queue):
-        self.submit_queue = submit_queue
-        self.stats_req_queue = stats_req_queue
-        self.stats_queue = stats_queue
-        
+        data = text.encode("utf-8")
+        with open(self.spill_file, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+        self.spilled.append((offset, len(data)))
 
-        # TODO: Update the entry on disk  for both functions below
-#        if complete:
-#            query = Service.update({ "last_synched": time(), "status": "synced ok" }).where(Service.slug == service)
- #           query.execute()
+    def chunk(self, index):
+        """ Return the given chunk of the log as a LogChunk, or None if there is no such chunk. """
+
+        if self.closed:
+            return None
+
+        if index < len(self.spilled):
+            offset, length = self.spilled[index]
+            with open(self.spill_file, "rb") as f:
+                f.seek(offset)
+                return LogChunk(f.read(length).decode("utf-8"), index + 1, self.job_id)
+
+        if index < self.first_chunk:
+            dropped = (self.first_chunk - index) * self.chunk_lines
+            return LogChunk("[ %d earlier log lines were dropped ]\n" % dropped, self.first_chunk, self.job_id)
+
+        try:
+            return LogChunk("\n".join(self.chunks[index - self.first_chunk]) + "\n", index + 1, self.job_id)
+        except IndexError:
+            return None
+
+    def close(self):
+        """ Remove the spill file, if any. A closed log has no chunks left to read. """
+
+        self.closed = True
+        if self.spilled:
+            os.unlink(self.spill_file)
+            self.spilled = []
+
+class SyncClient:
+    """
+        Talk to the sync manager, which may run in another process: every web worker of a deployment
+        reaches the same manager through its socket.
+    """
+
+    def __init__(self, address, authkey, status_board=None):
+        # The local socket the sync manager takes jobs and answers status and log requests on
+        self.address = address
+        self.authkey = authkey
+        # If given, statuses are read from the status board instead of asking the sync manager
+        self.status_board = status_board
 
     def request_sync(self, message: SubmitMessage):
         """ This function is called from the initiating process!"""
@@ -63,79 +226,536 @@ class SyncClient:
         if err_msg:
             return err_msg
 
-        self.submit_queue.put(message)
+        if not self.submit(message):
+            return "The sync service is not running, please try again later."
         return ""
-    
-    def sync_status(self, slug):
-        self.stats_req_queue.put(slug)
+
+    def submit(self, message: SubmitMessage):
+        """ Hand a job to the sync manager. Returns False if the manager could not be reached. """
+
+        return bool(self.call(message))
+
+    def call(self, request):
+        """
+            Send a request to the sync manager and return its reply, or None if no reply arrived in time.
+            Every request carries an id that the manager sends back with the reply, so a late reply to an
+            earlier request is never taken for the reply to this one.
+        """
+
+        connections = getattr(client_connections, "connections", None)
+        if connections is None:
+            connections = client_connections.connections = {}
+
+        key = (os.getpid(), self.address)
         try:
-            s = self.stats_queue.get(True, 3.0)
-            return s
-        except Empty:
-            return None
+            if key not in connections:
+                connections[key] = (Client(self.address, authkey=self.authkey), count())
+            conn, request_ids = connections[key]
+
+            request_id = next(request_ids)
+            conn.send((request_id, request))
+            while conn.poll(REPLY_TIMEOUT):
+                reply_id, reply = conn.recv()
+                if reply_id == request_id:
+                    return reply
+        except (OSError, EOFError, AuthenticationError) as err:
+            logging.error("Cannot reach the sync manager: %s" % err)
+
+        # Start over with a new connection next time, rather than reading the replies this one may still get
+        conn, _ = connections.pop(key, (None, None))
+        if conn is not None:
+            conn.close()
+        return None
+
+    def sync_status(self, slug):
+        if self.status_board is not None:
+            status = self.status_board.read(slug)
+            return StatusMessage(**status) if status is not None else None
+
+        return self.call(slug)
+
+    def sync_log(self, slug):
+        """
+            Generate the log of the last sync of a service one chunk at a time. The log stays that of the job
+            the first chunk came from: if a new sync starts while the log is read, the log simply ends.
+        """
+
+        index = 0
+        job_id = None
+        while True:
+            chunk = self.call(LogRequest(slug, job_id, index))
+            if chunk is None:
+                return
+
+            yield chunk.text
+            index = chunk.next_chunk
+            job_id = chunk.job_id
+
+    def log_tail(self, slug, position=None):
+        """
+            Return the lines the log of the last sync of a service got since position, and the position to
+            continue from. A position of None starts at the beginning of the log of the latest job; later
+            positions stay with that job, so once a new sync started no more lines are returned.
+        """
+
+        job_id, index, skip = position or (None, 0, 0)
+        lines = []
+        while True:
+            chunk = self.call(LogRequest(slug, job_id, index))
+            if chunk is None:
+                break
+
+            chunk_lines = chunk.text.splitlines(keepends=True)
+            lines.extend(chunk_lines[skip:])
+            job_id = chunk.job_id
+            # The last chunk may still grow: continue from its end, unless a next chunk turns up
+            position = (job_id, index, len(chunk_lines))
+            index, skip = chunk.next_chunk, 0
+
+        return "".join(lines), position
+
+    def submit_radio(self, request: RadioRequest):
+        """
+            Have an LB Radio playlist generated. Returns the id of the generating job, False if too many playlists
+            are being generated or None if the sync manager could not be reached.
+        """
+
+        return self.call(request)
+
+    def radio_result(self, job_id):
+        """ Return the RadioResult of an LB Radio job, or None if the job is not known (any more). """
+
+        return self.call(RadioJobRequest(job_id))
+
+    def radio_stats(self):
+        """ Return the counters of the LB Radio candidate cache, or None if the sync manager could not be reached. """
+
+        return self.call(RadioStatsRequest())
+
+    def refresh_weekly_jams(self, user_name):
+        """ Have the weekly jams of a ListenBrainz user generated, returns None if the manager is unreachable. """
+
+        return self.call(WeeklyJamsRequest(user_name))
 
 
 class SyncManager(multiprocessing.Process):
 
-    def __init__(self, submit_queue, stats_req_queue, stats_queue, stop_event, db_file):
+    def __init__(self, address, authkey, stop_event, db_file,
+                 num_workers=DEFAULT_SYNC_WORKERS, max_scans=DEFAULT_SYNC_MAX_SCANS,
+                 log_max_lines=DEFAULT_SYNC_LOG_MAX_LINES, log_dir=None, status_board_file=None, record_jobs=False,
+                 scan_concurrency=DEFAULT_SCAN_CONCURRENCY, write_batch_size=DEFAULT_WRITE_BATCH_SIZE,
+                 wal_checkpoint_batches=DEFAULT_WAL_CHECKPOINT_BATCHES, radio_workers=DEFAULT_RADIO_WORKERS,
+                 radio_max_pending=DEFAULT_RADIO_MAX_PENDING, radio_cache_size=DEFAULT_RADIO_CACHE_SIZE,
+                 radio_cache_ttl=DEFAULT_RADIO_CACHE_TTL,
+                 weekly_jams_refresh_interval=DEFAULT_WEEKLY_JAMS_REFRESH_INTERVAL):
         multiprocessing.Process.__init__(self)
-        self.submit_queue = submit_queue
-        self.stats_req_queue = stats_req_queue
-        self.stats_queue = stats_queue
+        self.address = address
+        self.authkey = authkey
         self.stop_event = stop_event
         self.db_file = db_file
+        self.num_workers = num_workers
+        self.max_scans = max_scans
+        self.log_max_lines = log_max_lines
+        self.log_dir = log_dir
+        self.status_board_file = status_board_file
+        self.record_jobs = record_jobs
+        self.scan_concurrency = scan_concurrency
+        self.write_batch_size = write_batch_size
+        self.wal_checkpoint_batches = wal_checkpoint_batches
+        self.radio_workers = radio_workers
+        self.radio_max_pending = radio_max_pending
+        self.radio_cache_size = radio_cache_size
+        self.radio_cache_ttl = radio_cache_ttl
+        self.weekly_jams_refresh_interval = weekly_jams_refresh_interval
         self.worker = None
+        self.radio = None
+        self.weekly_jams = None
 
     def run(self):
 
-        self.worker = SyncWorker(self.db_file)
+        status_board = None
+        if self.status_board_file:
+            status_board = StatusBoard(self.status_board_file)
+            status_board.open()
+
+        # LB Radio playlists are generated here too, so they are capped for all web workers together and the
+        # candidates cached for them are dropped as soon as a sync changes the collection
+        content_pool.init(self.db_file)
+        self.radio = RadioWorker(self.db_file, self.radio_workers, self.radio_max_pending, self.radio_cache_size,
+                                 self.radio_cache_ttl)
+
+        self.worker = SyncWorker(self.db_file, self.num_workers, self.max_scans,
+                                 self.log_max_lines, self.log_dir, status_board, self.record_jobs,
+                                 self.scan_concurrency, self.write_batch_size, self.wal_checkpoint_batches,
+                                 self.radio.cache.invalidate)
         self.worker.start()
+        if self.record_jobs:
+            self.worker.restore_statuses()
+            self.worker.resume_interrupted_jobs()
+
+        self.weekly_jams = WeeklyJamsWorker(self.db_file, self.weekly_jams_refresh_interval)
+        self.weekly_jams.start()
 
+        # A socket left behind by a manager that did not shut down cleanly would stop the listener from binding
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+
+        # Clients are accepted on a thread that blocks until one connects and each client is served on a
+        # thread of its own, so the process sleeps when there is nothing to do.
+        thread = Thread(target=self.accept_clients, args=(listener,))
         try:
-            while not self.stop_event.is_set():
-                self.worker.process_log_messages()
-                try:
-                    job = self.submit_queue.get_nowait()
-                    self.worker.job_queue.put(job)
-                except Empty:
-                    pass
+            thread.start()
 
-                try:
-                    slug = self.stats_req_queue.get_nowait()
-                    while True:
-                        try:
-                            s = self.worker.current_status(slug)
-                            self.stats_queue.put(self.worker.current_status(slug))
-                            break
-                        except Full:
-                            sleep(1)
-                            continue
-                except Empty:
-                    pass
-
-                sleep(1)
+            self.stop_event.wait()
+
+            # Wake up the blocked thread so it can exit
+            Client(self.address, authkey=self.authkey).close()
+            thread.join()
+            listener.close()
 
             self.worker.exit()
             self.worker.join()
+            self.radio.shutdown()
+            self.weekly_jams.exit()
+            self.weekly_jams.join()
+            if status_board is not None:
+                status_board.close()
         except Exception:
             traceback_str = traceback.format_exc()
             logging.error(traceback_str)
 
+    def accept_clients(self, listener):
+        """ Serve each client that connects on a thread of its own until the stop event is set. """
+
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, AuthenticationError) as err:
+                if self.stop_event.is_set():
+                    return
+                logging.error("Rejected sync client connection: %s" % err)
+                continue
+
+            if self.stop_event.is_set():
+                conn.close()
+                return
+            Thread(target=self.answer_requests, args=(conn,), daemon=True).start()
+
+    def answer_requests(self, conn):
+        """ Take the jobs and answer the status, log and playlist requests of one client until it disconnects. """
+
+        with conn:
+            while True:
+                try:
+                    request_id, req = conn.recv()
+                except (EOFError, OSError):
+                    return
+
+                if isinstance(req, SubmitMessage):
+                    self.worker.job_queue.put(req)
+                    reply = True
+                elif isinstance(req, LogRequest):
+                    reply = self.worker.log_chunk(req.slug, req.chunk, req.job_id)
+                elif isinstance(req, RadioRequest):
+                    reply = self.radio.submit(req) or False
+                elif isinstance(req, RadioJobRequest):
+                    reply = self.radio.result(req.job_id)
+                elif isinstance(req, RadioStatsRequest):
+                    reply = self.radio.stats()
+                elif isinstance(req, WeeklyJamsRequest):
+                    reply = self.weekly_jams.refresh(req.user_name)
+                else:
+                    reply = self.worker.current_status(req)
+
+                try:
+                    conn.send((request_id, reply))
+                except OSError:
+                    return
+
+
+class SyncJob:
+    """
+        The status, stats and logs of one sync job. If a status board is given, every change to the status is
+        published to it; changes to the log offset at most every STATUS_PUBLISH_INTERVAL seconds.
+
+        If the job has a sync_job record, state changes are saved to it at once, while stats and log offset are
+        saved at most every RECORD_SAVE_INTERVAL seconds, so a busy job writes to the database once per interval.
+    """
+
+    def __init__(self, submit_msg, log=None, status_board=None):
+        self.lock = Lock()
+        self.id = str(uuid.uuid4())
+        self.slug = submit_msg.service["slug"]
+        self.type = submit_msg.type
+        self.user_id = submit_msg.user_id
+        self.expire_at = submit_msg.expire_at
+        self.stats = None
+        self.log = log or SyncLog()
+        self.log.job_id = self.id
+        self.complete = False
+        self.error_msg = ""
+        self.status_board = status_board
+        self.last_published = 0
+        self.record = None
+        if submit_msg.record_id is not None:
+            self.record = SyncJobRecord.get_or_none(SyncJobRecord.id == submit_msg.record_id)
+        self.last_saved = 0
+        # The album a resumed scan continues after
+        self.resume_after = self.record.scan_progress if self.record is not None else None
+
+    def add_log_message(self, message):
+        """ Messages that start with json- carry the current stats, all others are log lines. """
+
+        if message.startswith("json-"):
+            try:
+                stats = json.loads(message[5:])
+            except ValueError as err:
+                logging.error(message)
+                logging.error(err)
+                return
+
+            with self.lock:
+                self.stats = stats
+                self._publish()
+            return
+
+        with self.lock:
+            self.log.append(message)
+            if monotonic() - self.last_published > STATUS_PUBLISH_INTERVAL:
+                self._publish()
+
+    def set_state(self, state):
+        """ Record that the job moved on to the given state: scanning or looking_up. """
+
+        with self.lock:
+            if self.record is None:
+                return
+            self.record.state = state
+            if self.record.started is None:
+                self.record.started = int(time())
+            self._save()
+
+    def set_scan_progress(self, album_id):
+        """ Record the last album the scan wrote, saved with the stats at most every RECORD_SAVE_INTERVAL seconds. """
+
+        with self.lock:
+            if self.record is None:
+                return
+            self.record.scan_progress = album_id
+            if monotonic() - self.last_saved > RECORD_SAVE_INTERVAL:
+                self._save()
+
+    def finish(self, error_msg=""):
+        with self.lock:
+            self.complete = True
+            self.error_msg = error_msg
+            if self.record is not None:
+                self.record.state = "failed" if error_msg else "complete"
+                self.record.finished = int(time())
+                self.record.error = error_msg or None
+            self._publish(save=True)
+
+        if self.record is not None:
+            try:
+                Service.update({"last_synched": self.record.finished,
+                                "status": "sync failed" if error_msg else "synced ok"}) \
+                       .where(Service.slug == self.slug).execute()
+            except peewee.PeeweeException as err:
+                logging.error("Cannot update the sync status of service %s: %s" % (self.slug, err))
+
+    def publish(self):
+        with self.lock:
+            self._publish()
+
+    def _publish(self, save=False):
+        if self.status_board is not None:
+            self.status_board.publish(self.slug, published_status(self._status()))
+            self.last_published = monotonic()
+
+        if self.record is not None and (save or monotonic() - self.last_saved > RECORD_SAVE_INTERVAL):
+            self._save()
+
+    def _save(self):
+        self.record.stats = json.dumps(self.stats) if self.stats is not None else None
+        self.record.log_lines = self.log.lines
+        try:
+            self.record.save()
+        except peewee.PeeweeException as err:
+            # Losing an update of the job history must not fail the sync
+            logging.error("Cannot save sync job record %s: %s" % (self.record.id, err))
+        self.last_saved = monotonic()
+
+    def _status(self):
+        return StatusMessage(complete=self.complete,
+                             stats=self.stats,
+                             log_offset=self.log.lines,
+                             error_msg=self.error_msg)
+
+    def status(self):
+        with self.lock:
+            return self._status()
+
+    def log_chunk(self, index):
+        with self.lock:
+            return self.log.chunk(index)
+
 
 class SyncWorker(Thread):
-    
-    def __init__(self, db_file):
+    """
+        Receive sync jobs and run them on a pool of threads. Jobs for different services run in parallel,
+        jobs for the same service run one after the other. If record_jobs is set, each job is recorded in the
+        sync_job table. If on_sync_finished is set, it is called after each job, when the collection may have
+        changed.
+    """
+
+    def __init__(self, db_file, num_workers=DEFAULT_SYNC_WORKERS, max_scans=DEFAULT_SYNC_MAX_SCANS,
+                 log_max_lines=DEFAULT_SYNC_LOG_MAX_LINES, log_dir=None, status_board=None, record_jobs=False,
+                 scan_concurrency=DEFAULT_SCAN_CONCURRENCY, write_batch_size=DEFAULT_WRITE_BATCH_SIZE,
+                 wal_checkpoint_batches=DEFAULT_WAL_CHECKPOINT_BATCHES, on_sync_finished=None):
         Thread.__init__(self)
         self.job_queue = Queue()
         self.lock = Lock()
         self.job_data = {}
-        self.current_slug = None
+        # slug -> jobs waiting for the running job of that slug. A slug is present while it has a job running.
+        self.slug_queues = {}
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="sync-job")
+        self.scan_slots = BoundedSemaphore(max_scans)
         self._exit = False
         self.db_file = db_file
+        self.log_max_lines = log_max_lines
+        self.log_dir = log_dir
+        self.status_board = status_board
+        self.record_jobs = record_jobs
+        self.scan_concurrency = scan_concurrency
+        self.write_batch_size = write_batch_size
+        self.wal_checkpoint_batches = wal_checkpoint_batches
+        self.on_sync_finished = on_sync_finished
         
     def exit(self):
         self._exit = True
-        
+        self.job_queue.put(None)
+
+    def schedule(self, submit_msg):
+        """ Start a job on the pool, unless a job for the same service is running. Then queue it behind that one. """
+
+        slug = submit_msg.service["slug"]
+        if self.record_jobs and submit_msg.record_id is None:
+            submit_msg = self.record_job(submit_msg)
+
+        with self.lock:
+            if slug in self.slug_queues:
+                self.slug_queues[slug].append(submit_msg)
+                return
+            self.slug_queues[slug] = deque()
+
+        self.executor.submit(self.run_jobs, submit_msg)
+
+    def record_job(self, submit_msg):
+        """ Create the sync_job record of a newly submitted job and return the message with its record id. """
+
+        try:
+            record = SyncJobRecord.create(service=submit_msg.service.get("id"),
+                                          credential=submit_msg.credential.get("id"),
+                                          user=submit_msg.user_id,
+                                          type=submit_msg.type,
+                                          state="queued",
+                                          created=int(time()))
+        except peewee.PeeweeException as err:
+            logging.error("Cannot record sync job for %s: %s" % (submit_msg.service["slug"], err))
+            return submit_msg
+
+        return submit_msg._replace(record_id=record.id)
+
+    def resume_interrupted_jobs(self):
+        """
+            Queue the jobs that were queued or running when the sync daemon stopped. A job whose scan was done
+            is resumed with just the metadata lookup, a full scan continues after the last album it saved as its
+            progress. Returns the number of jobs queued.
+        """
+
+        resumed = 0
+        # Load them all first, the records created below are unfinished as well
+        interrupted = list(SyncJobRecord.select()
+                                        .where(SyncJobRecord.state.in_(UNFINISHED_STATES))
+                                        .order_by(SyncJobRecord.id))
+        for old in interrupted:
+            type = "metadata_only" if old.state == "looking_up" else old.type
+            old.state = "interrupted"
+            old.save()
+            if old.credential is None:
+                logging.error("Cannot resume sync job %s, its credential was deleted" % old.id)
+                continue
+
+            record = SyncJobRecord.create(service=old.service,
+                                          credential=old.credential,
+                                          user=old.user_id,
+                                          type=type,
+                                          state="queued",
+                                          resumed_from=old,
+                                          scan_progress=old.scan_progress if type == "full" else None,
+                                          created=int(time()))
+            self.job_queue.put(SubmitMessage(service=model_to_dict(old.service),
+                                             credential=model_to_dict(old.credential),
+                                             user_id=old.user_id,
+                                             expire_at=monotonic() + 60 * 60,
+                                             type=type,
+                                             record_id=record.id))
+            resumed += 1
+
+        return resumed
+
+    def recorded_status(self, slug):
+        """ Return the status saved in the latest sync_job record of a service, or None if there is none. """
+
+        try:
+            record = SyncJobRecord.select() \
+                                  .join(Service) \
+                                  .where(Service.slug == slug) \
+                                  .order_by(SyncJobRecord.id.desc()) \
+                                  .first()
+        except peewee.PeeweeException as err:
+            logging.error("Cannot load the sync history of %s: %s" % (slug, err))
+            return None
+        if record is None:
+            return None
+
+        return StatusMessage(complete=record.state not in UNFINISHED_STATES,
+                             error_msg=record.error or "",
+                             stats=json.loads(record.stats) if record.stats else None,
+                             log_offset=record.log_lines)
+
+    def restore_statuses(self):
+        """ Publish the statuses saved in the sync_job table to the status board, which starts out empty. """
+
+        if self.status_board is None:
+            return
+
+        for service in Service.select():
+            status = self.recorded_status(service.slug)
+            if status is not None:
+                self.status_board.publish(service.slug, published_status(status))
+
+    def run_jobs(self, submit_msg):
+        """ Run the given job and then any jobs for the same service that were queued while it ran. """
+
+        slug = submit_msg.service["slug"]
+        while submit_msg is not None:
+            try:
+                self.sync_service(submit_msg)
+            except BaseException:
+                # troi calls sys.exit() on some database errors, that must not stop the queued jobs
+                logging.error(traceback.format_exc())
+            finally:
+                if self.on_sync_finished is not None:
+                    self.on_sync_finished()
+                with self.lock:
+                    if self.slug_queues[slug] and not self._exit:
+                        submit_msg = self.slug_queues[slug].popleft()
+                    else:
+                        del self.slug_queues[slug]
+                        submit_msg = None
+
     def sync_service(self, submit_msg):
         slug = submit_msg.service["slug"]
 
@@ -157,89 +777,68 @@ class SyncWorker(Thread):
             "token": token
         }
         conf = { "SUBSONIC_SERVERS" : config}
+        spill_file = os.path.join(self.log_dir, "sync-%s-%s.log" % (slug, uuid.uuid4())) if self.log_dir else None
+        job = SyncJob(submit_msg, SyncLog(self.log_max_lines, spill_file), self.status_board)
+        job.publish()
         self.lock.acquire()
-        self.job_data[slug] = { "stats": None,
-                                "logs": None,
-                                "type": submit_msg.type,
-                                "user_id": submit_msg.user_id,
-                                "expire_at": submit_msg.expire_at,
-                                "complete": False,
-                                "error_msg": ""
-                              }        
+        old_job = self.job_data.get(slug)
+        self.job_data[slug] = job
         self.lock.release()
-        self.current_slug = slug
+        if old_job is not None:
+            with old_job.lock:
+                old_job.log.close()
 
+        # Send everything this thread logs to this job until it is done
+        context_token = current_job.set(job)
         db = SubsonicDatabase(self.db_file, Config(**conf), quiet=False)
         try:
-            db.open()
-
-            if submit_msg.type == "full":
-                db.sync(slug)
-
-            lookup = MetadataLookup(False)
-            lookup.lookup(slug)
-
-        except Exception as err:
-            while True:
-                try:
-                    logging_queue.get_nowait()
-                except Empty:
-                    break
+            # Limit the number of jobs scanning a service (and writing what they find) at the same time
+            with self.scan_slots:
+                db.open()
+
+                # Full scans run through the incremental scanner too, which saves how far it got so that an
+                # interrupted scan can be resumed
+                if submit_msg.type in ("full", "incremental"):
+                    job.set_state("scanning")
+                    client = SubsonicClient(submit_msg.service["url"], submit_msg.credential["user_name"],
+                                            submit_msg.credential["password"], self.scan_concurrency)
+                    try:
+                        IncrementalScan(submit_msg.service["id"], client, self.scan_concurrency,
+                                        self.write_batch_size, self.wal_checkpoint_batches,
+                                        full=submit_msg.type == "full", resume_after=job.resume_after,
+                                        on_progress=job.set_scan_progress).run()
+                    finally:
+                        client.close()
+
+                job.set_state("looking_up")
+                lookup = MetadataLookup(False)
+                lookup.lookup(slug)
+
+                # The tags of the collection changed, count them for the top tags page once now
+                TopTag.rebuild(TopTags().get_top_tags(TOP_TAGS_LIMIT))
+
+            job.finish()
+        except BaseException:
             traceback_str = traceback.format_exc()
             logging.error(traceback_str)
-            self.lock.acquire()
-            self.job_data[slug]["error"] = "An error occurred when syncing the collection:\n" + str(traceback_str) + "\n"
-            self.lock.release()
-            
-        self.process_log_messages()
-        self.lock.acquire()
-        self.job_data[slug]["complete"] = True
-        self.lock.release()
-        self.current_slug = None
-        
-    def process_log_messages(self):
-        """ Read log messages, process them as needed, then return them """
-        
-        
-        slug = self.current_slug
-        if slug is None:
-            return
-        
-        loaded_rows = False
-        self.lock.acquire()
-        logs = self.job_data[slug]["logs"]
-        self.lock.release()
-        error_msg = ""
-        while True:
-            try:
-                rec = logging_queue.get_nowait()
-                if rec.message.startswith("json-"):
-                    try:
-                        stats = json.loads(rec.message[5:])
-                    except Exception as err:
-                        error_msg = err
-                        logging.error(rec.message)
-                        logging.error(err)
-                        continue
-
-                    self.lock.acquire()
-                    self.job_data[slug]["stats"] = stats
-                    self.lock.release()
-                    continue
+            job.finish("An error occurred when syncing the collection:\n" + str(traceback_str) + "\n")
+        finally:
+            current_job.reset(context_token)
 
-                if logs is None:
-                    logs = ""
-                logs += rec.message + "\n"
-                loaded_rows = True
-            except Empty:
-                break
-            
-        self.lock.acquire()
-        self.job_data[slug]["logs"] = logs
-        self.lock.release()
-        
     def current_status(self, slug):
 
+        with self.lock:
+            job = self.job_data.get(slug)
+
+        if job is None:
+            # No job ran since the sync daemon started, the job history may know how the last one went
+            return self.recorded_status(slug) if self.record_jobs else None
+
+        return job.status()
+
+    def log_chunk(self, slug, index, job_id=None):
+        """ Return a chunk of the log of the latest job of a service, or None if job_id is not that job. """
+
         self.lock.acquire()
         try:
             job = self.job_data[slug]
@@ -248,23 +847,23 @@ class SyncWorker(Thread):
         finally:
             self.lock.release()
 
-        return StatusMessage(complete=job["complete"],
-                             stats=job["stats"],
-                             logs=job["logs"],
-                             error_msg=job["error_msg"])
+        if job_id is not None and job.id != job_id:
+            return None
+        return job.log_chunk(index)
 
     def run(self):
 
         try:
             while not self._exit:
-                try:
-                    submit_msg = self.job_queue.get_nowait()
-                except Empty:
-                    # TODO: Speed this up
-                    sleep(1)
+                submit_msg = self.job_queue.get()
+                if submit_msg is None:
                     continue
 
-                self.sync_service(submit_msg)
+                self.schedule(submit_msg)
         except Exception:
             traceback_str = traceback.format_exc()
             logging.error(traceback_str)
+
+        self.executor.shutdown(wait=True)
+        for job in self.job_data.values():
+            job.log.close()
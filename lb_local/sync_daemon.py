@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import logging
+import signal
+from threading import Event
+
+from lb_local.config import load_config, sync_daemon_files, sync_authkey
+from lb_local.database import UserDatabase, create_content_indexes
+from lb_local.model.database import content_pool
+from lb_local.status_board import StatusBoard
+from lb_local.sync import SyncManager
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """
+        Run the sync manager of a deployment. All web workers hand their sync jobs to this one process and ask it
+        for their status, so it must be started once next to the web app: uwsgi attaches it as a daemon (see the
+        Dockerfile) and lb_local.py starts it for the development server.
+    """
+
+    logging.basicConfig(level=logging.INFO)
+    config = load_config(logger)
+    address, status_board_file = sync_daemon_files(config)
+    StatusBoard.create(status_board_file)
+
+    # Make sure the sync_job table exists, the daemon records every job in it
+    UserDatabase(config["DATABASE_FILE"], False).create()
+    # The scans write the file source of each recording, which lb-local adds to troi's recording table
+    content_pool.init(config["DATABASE_FILE"])
+    create_content_indexes()
+
+    stop_event = Event()
+    manager = SyncManager(address, sync_authkey(config), stop_event, config["DATABASE_FILE"],
+                          config["SYNC_WORKERS"], config["SYNC_MAX_SCANS"],
+                          config["SYNC_LOG_MAX_LINES"], config["SYNC_LOG_DIR"] or None,
+                          status_board_file, record_jobs=True,
+                          scan_concurrency=config["SYNC_SCAN_CONCURRENCY"],
+                          write_batch_size=config["SYNC_WRITE_BATCH_SIZE"],
+                          wal_checkpoint_batches=config["SYNC_WAL_CHECKPOINT_BATCHES"],
+                          radio_workers=config["RADIO_WORKERS"],
+                          radio_max_pending=config["RADIO_MAX_PENDING"],
+                          radio_cache_size=config["RADIO_CACHE_SIZE"],
+                          radio_cache_ttl=config["RADIO_CACHE_TTL"],
+                          weekly_jams_refresh_interval=config["WEEKLY_JAMS_REFRESH_INTERVAL"])
+
+    def stop(signum, frame):
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logger.info("Sync daemon listening on %s" % address)
+    manager.run()
+
+
+if __name__ == '__main__':
+    main()
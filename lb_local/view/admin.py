@@ -1,6 +1,10 @@
 from flask import request, redirect, url_for
 from flask_admin.contrib.peewee import ModelView
-from flask_login import current_user, logout_user
+from flask_login import current_user
+
+from lb_local.login import invalidate_users
+from lb_local.session import revoke_sessions
+from lb_local.view.credential import invalidate_credentials
 
 
 class UserModelView(ModelView):
@@ -16,10 +20,12 @@ class UserModelView(ModelView):
     def inaccessible_callback(self, name, **kwargs):
         return redirect(url_for("index_bp.index", next=request.url))
 
+    def after_model_change(self, form, model, is_created):
+        invalidate_users(model.login_id)
+
     def after_model_delete(self, model):
-        # TODO: Revoke session for user
-        logout_user()
-        pass
+        revoke_sessions(model.login_id)
+        invalidate_users(model.login_id)
 
 
 class ServiceCredentialModelView(ModelView):
@@ -35,3 +41,9 @@ class ServiceCredentialModelView(ModelView):
 
     def inaccessible_callback(self, name, **kwargs):
         return redirect(url_for('index_bp.index', next=request.url))
+
+    def after_model_change(self, form, model, is_created):
+        invalidate_credentials()
+
+    def after_model_delete(self, model):
+        invalidate_credentials()
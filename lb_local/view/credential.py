@@ -1,36 +1,72 @@
 import hashlib
+from threading import Lock
 import uuid
 from urllib.parse import urlparse
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session
+from flask import Blueprint, render_template, request, redirect, url_for, flash
 import peewee
 from flask_login import login_required, current_user
 from werkzeug.exceptions import Forbidden, NotFound
 
+from lb_local.model.cache_generation import CacheGeneration
 from lb_local.model.credential import Credential
 from lb_local.model.service import Service
+from lb_local.model.user import User
 
 credential_bp = Blueprint("credential_bp", __name__)
 
-def load_credentials(user_id, credentials=None):
+# The name of the generation of the cached credential configs
+CREDENTIAL_CACHE = "credentials"
 
-    msg = ""
-    
-    if credentials is None:
-        credentials = Credential.select().where((Credential.owner == user_id) | (Credential.shared == True))
-        if not credentials:
-            msg = "There are no credentials available. Please add your own credential."
+
+class CredentialCache:
+    """
+        The Subsonic config of each user, as built from the credentials the user may use, so the pages that need
+        it don't query the credentials and their services every time. Each web worker keeps its own copies, which
+        are dropped when the "credentials" generation is bumped after a credential or service changes.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.generation = None
+        self.configs = {}
+
+    def get(self, user_id):
+        generation = CacheGeneration.current(CREDENTIAL_CACHE)
+        with self.lock:
+            if generation != self.generation:
+                self.configs = {}
+                self.generation = generation
+            config = self.configs.get(user_id)
+        if config is not None:
+            return config
+
+        credentials = Credential.select(Credential, Service) \
+                                .join(Service) \
+                                .where((Credential.owner == user_id) | (Credential.shared == True)) \
+                                .order_by(Credential.id)
+        config = build_config(credentials)
+        with self.lock:
+            if generation == self.generation:
+                self.configs[user_id] = config
+        return config
+
+
+credential_cache = CredentialCache()
+
+
+def invalidate_credentials():
+    """ Drop the cached configs of all users in all web workers, after a credential or service changed. """
+
+    CacheGeneration.bump(CREDENTIAL_CACHE)
+
+
+def build_config(credentials):
+    """ Build the Subsonic config of the given credentials, which must have their services joined. """
 
     config = {}
-    service_count = 0
     for credential in credentials:
         url = urlparse(credential.service.url)
-        salt = str(uuid.uuid4())
-        h = hashlib.new('md5')
-        h.update(bytes(credential.password, "utf-8"))
-        h.update(bytes(salt, "utf-8"))
-        token = h.hexdigest()
-
         config[credential.service.slug] = {
             "host": "%s://%s" % (url.scheme, url.hostname),
             "url": credential.service.url,
@@ -38,23 +74,45 @@ def load_credentials(user_id, credentials=None):
             "username": credential.user_name,
             "password": credential.password,
             "shared": credential.shared,
-            "owner_id": credential.owner.user_id,
-            "salt": salt,
-            "token": token
+            "owner_id": credential.owner_id
         }
-        service_count += 1
+    return config
 
-    # This function could be called outside the app context, then don't update the session
-    try:
-        session["subsonic"] = config
-        if service_count == 1: 
-            session["cors_url"] = "%s://%s" % (url.scheme, url.hostname)
-        else:
-            session["cors_url"] = "*"
-    except RuntimeError:
-        pass
-        
-    return { "SUBSONIC_SERVERS" : config}, msg
+
+def load_credentials(user_id):
+    """
+        Return the Subsonic config of the credentials a user may use and a message if there are none. The config
+        is shared between requests and must not be changed. It has no salted tokens, use player_config() to
+        hand it to a Subsonic client.
+    """
+
+    msg = ""
+    config = credential_cache.get(user_id)
+    if not config:
+        msg = "There are no credentials available. Please add your own credential."
+
+    return {"SUBSONIC_SERVERS": dict(config)}, msg
+
+
+def player_config(servers):
+    """ Mint a salted token for each server of a config, for the Subsonic client of the player. """
+
+    config = {}
+    for slug, server in servers.items():
+        salt = str(uuid.uuid4())
+        h = hashlib.new('md5')
+        h.update(bytes(server["password"], "utf-8"))
+        h.update(bytes(salt, "utf-8"))
+        config[slug] = {**server, "salt": salt, "token": h.hexdigest()}
+    return config
+
+
+def cors_origin(servers):
+    """ The origin the player may fetch from: the one server's, or any if there are more. """
+
+    if len(servers) == 1:
+        return next(iter(servers.values()))["host"]
+    return "*"
 
 
 @credential_bp.route("/", methods=["GET"])  
@@ -70,12 +128,17 @@ def credential_list():
     if not current_user.is_service_user and not current_user.is_admin:
         raise NotFound
 
-    if current_user.is_admin:
-        credentials = Credential.select()
-    else:
-        credentials = Credential.select().where(Credential.owner == current_user.user_id)
-    return render_template("component/credential-list.html", 
-                           credentials=credentials)
+    # The credentials with their services and owners in one query, leaving out the passwords
+    credentials = Credential.select(Credential.id, Credential.user_name, Credential.shared,
+                                    Service.id, Service.slug, User.user_id, User.name) \
+                            .join(Service) \
+                            .switch(Credential) \
+                            .join(User) \
+                            .order_by(Credential.id)
+    if not current_user.is_admin:
+        credentials = credentials.where(Credential.owner == current_user.user_id)
+    return render_template("component/credential-list.html",
+                           credentials=list(credentials))
 
 
 @credential_bp.route("/add", methods=["GET"])
@@ -129,7 +192,7 @@ def credential_delete(id):
     except peewee.IntegrityError:
         flash("Credential still in use and cannot be deleted.")
 
-    load_credentials(current_user.user_id)
+    invalidate_credentials()
 
     return redirect(url_for("credential_bp.credential_index"))
 
@@ -184,7 +247,7 @@ def credential_add_post():
             flash("Database error. (%s)" % err)
         return render_template("credential-add.html", user_name=user_name, service=service, password=password)
 
-    load_credentials(current_user.user_id)
+    invalidate_credentials()
 
     from lb_local.view.service import service_bp
     return redirect(url_for("service_bp.service_index"))
@@ -1,17 +1,16 @@
 import json
 from copy import copy
+from time import time
 from urllib.parse import urlparse
 
-from flask import Blueprint, render_template, request, current_app, make_response, session
+from flask import Blueprint, render_template, stream_template, request, current_app, make_response, url_for, Response
 from flask_login import login_required, current_user
-from werkzeug.exceptions import BadRequest, ServiceUnavailable, Forbidden
+from werkzeug.exceptions import BadRequest, ServiceUnavailable, Forbidden, NotFound
 from libsonic.errors import CredentialError
 
-from troi.content_resolver.lb_radio import ListenBrainzRadioLocal
-from troi.content_resolver.subsonic import SubsonicDatabase, Database
+from troi.content_resolver.subsonic import SubsonicDatabase
 from troi.content_resolver.top_tags import TopTags
 from troi.content_resolver.unresolved_recording import UnresolvedRecordingTracker
-from troi.local.periodic_jams_local import PeriodicJamsLocal
 from troi.playlist import _deserialize_from_jspf, PlaylistElement
 
 try:
@@ -23,12 +22,21 @@ except ImportError:
             pass
         def get_jams(self):
             return []
-from lb_local.database import user_db
-from lb_local.view.credential import load_credentials
+from lb_local.model.database import content_pool
+from lb_local.model.top_tag import TopTag, TOP_TAGS_LIMIT
+from lb_local.model.weekly_jams import WeeklyJams
+from lb_local.radio import RadioRequest
+from lb_local.weekly_jams import current_period, deserialize_recordings, WEEKLY_JAMS_GENERATE_TIMEOUT
+from lb_local.view.credential import load_credentials, player_config, cors_origin
+from lb_local.view.service import get_sync_client
 from lb_local.login import login_forbidden
 
 index_bp = Blueprint("index_bp", __name__)
 
+# How many recordings a page of /tag/<tag> shows and how often a recording must have been tagged to be shown
+TAG_PAGE_SIZE = 100
+MINIMUM_TAG_COUNT = 5
+
 
 @index_bp.route("/")
 @login_required
@@ -47,23 +55,25 @@ def welcome():
 def lb_radio_get():
     prompt = request.args.get("prompt", "")
     title = request.args.get("title", "");
-    load_credentials(current_user.user_id)
+    config, msg = load_credentials(current_user.user_id)
     t = render_template('lb-radio.html', 
                         prompt=prompt, 
                         title=title, 
                         page="lb-radio",
-                        subsonic=json.dumps(session["subsonic"]))
+                        subsonic=json.dumps(player_config(config["SUBSONIC_SERVERS"])))
     r = make_response(t)
-    if session["cors_url"]:
-        r.headers.set('Access-Control-Allow-Origin', session["cors_url"])
+    r.headers.set('Access-Control-Allow-Origin', cors_origin(config["SUBSONIC_SERVERS"]))
     return r
 
 
 @index_bp.route("/lb-radio", methods=["POST"])
 @login_required
 def lb_radio_post():
+    """
+        Hand the prompt to the sync daemon, which generates the playlist in the background, and return a
+        placeholder that polls for the playlist until it is done.
+    """
 
-    credential, msg = load_credentials(current_user.user_id)
     try:
         prompt = request.form["prompt"]
     except KeyError:
@@ -74,20 +84,35 @@ def lb_radio_post():
     except KeyError:
         raise BadRequest("argument 'mode' is required.")
 
-    db = SubsonicDatabase(current_app.config["DATABASE_FILE"], current_app.config, quiet=True)
-    db.open()
-    r = ListenBrainzRadioLocal(quiet=True)
-    try:
-        playlist = r.generate(mode, prompt, .8)
-    except RuntimeError as err:
-        return render_template('component/playlist-table.html', errors=str(err))
+    job_id = get_sync_client().submit_radio(RadioRequest(current_user.user_id, mode, prompt))
+    if job_id is None:
+        return render_template('component/playlist-table.html',
+                               errors="The playlist service is not running, please try again later.")
+    if not job_id:
+        return render_template('component/playlist-table.html',
+                               errors="Too many playlists are being generated right now, please try again shortly.")
 
-    try:
-        recordings = playlist.playlists[0].recordings
-    except (IndexError, KeyError, AttributeError):
-        msgs = db.metadata_sanity_check(include_subsonic=True, return_as_array=True)
-        return render_template('component/playlist-table.html', errors="\n".join(msgs))
-    
+    return render_template('component/playlist-job.html', poll_url=url_for('index_bp.lb_radio_job', job_id=job_id))
+
+
+@index_bp.route("/lb-radio/job/<job_id>", methods=["GET"])
+@login_required
+def lb_radio_job(job_id):
+    """ Return the playlist of an LB Radio job once it is generated, or the placeholder that polls again. """
+
+    result = get_sync_client().radio_result(job_id)
+    # Answered with the error rather than a 404, htmx would not show that
+    if result is None or result.user_id != current_user.user_id:
+        return render_template('component/playlist-table.html',
+                               errors="This playlist is not available any more, please create it again.")
+
+    if not result.complete:
+        return render_template('component/playlist-job.html', poll_url=url_for('index_bp.lb_radio_job', job_id=job_id))
+
+    if result.errors:
+        return render_template('component/playlist-table.html', errors=result.errors)
+
+    credential, msg = load_credentials(current_user.user_id)
     avail_services = []
     services = credential["SUBSONIC_SERVERS"]
     for service in services:
@@ -95,26 +120,50 @@ def lb_radio_post():
             avail_services.append(service)
 
     services = set() 
-    for rec in recordings:
+    for rec in result.recordings:
         try:
             services.add(rec.listenbrainz["file_source"])
         except KeyError:
             services.add("???")
-            
-    hints = r.patch.user_feedback()
-    if not recordings:
-        hints.append("No recorings were available for playback. Have you sync'ed your service?") 
 
-    return render_template('component/playlist-table.html',
+    # Streamed, so that the first rows go out before the last ones are rendered. The JSPF is fetched on its own.
+    return stream_template('component/playlist-table.html',
                            num_services=len(services),
-                           recordings=recordings,
-                           playlist_name=playlist.playlists[0].name,
-                           playlist_desc=playlist.playlists[0].description,
-                           hints=hints,
-                           jspf=json.dumps(playlist.get_jspf()),
+                           recordings=result.recordings,
+                           playlist_name=result.name,
+                           playlist_desc=result.description,
+                           hints=result.hints,
+                           jspf_url=url_for('index_bp.lb_radio_jspf', job_id=job_id),
                            services=avail_services,
-                           prompt=prompt,
-                           mode=mode)
+                           prompt=result.prompt,
+                           mode=result.mode)
+
+
+@index_bp.route("/lb-radio/job/<job_id>/jspf", methods=["GET"])
+@login_required
+def lb_radio_jspf(job_id):
+    """ Return the JSPF of a generated LB Radio playlist, for saving it. """
+
+    result = get_sync_client().radio_result(job_id)
+    if result is None or result.user_id != current_user.user_id or result.jspf is None:
+        raise NotFound
+
+    return Response(json.dumps(result.jspf, separators=(",", ":")), mimetype="application/json")
+
+
+@index_bp.route("/lb-radio/stats", methods=["GET"])
+@login_required
+def lb_radio_stats():
+    """ Return the hit and miss counts of the LB Radio candidate cache, for admins. """
+
+    if not current_user.is_admin:
+        raise Forbidden
+
+    stats = get_sync_client().radio_stats()
+    if stats is None:
+        raise ServiceUnavailable("The playlist service is not running.")
+
+    return stats
 
 
 class Config:
@@ -162,105 +211,174 @@ def playlist_create():
 @index_bp.route("/weekly-jams", methods=["GET"])
 @login_required
 def weekly_jams_get():
-    load_credentials(current_user.user_id)
+    config, msg = load_credentials(current_user.user_id)
 
-    t = render_template('weekly-jams.html', page="weekly-jams", subsonic=session["subsonic"])
+    t = render_template('weekly-jams.html', page="weekly-jams",
+                        subsonic=json.dumps(player_config(config["SUBSONIC_SERVERS"])))
     r = make_response(t)
-    if session["cors_url"]:
-        r.headers.set('Access-Control-Allow-Origin', session["cors_url"])
+    r.headers.set('Access-Control-Allow-Origin', cors_origin(config["SUBSONIC_SERVERS"]))
     return r
 
 
 @index_bp.route("/weekly-jams", methods=["POST"])
 @login_required
 def weekly_jams_post():
+    """
+        Return the stored weekly jams of a ListenBrainz user. If there are none for this week yet, or refresh is
+        set, have the sync daemon generate them and return a placeholder that polls until they are done.
+    """
+
     try:
         user_name = request.form["user_name"]
     except KeyError:
         raise BadRequest("argument 'user_name' is required.")
 
-    db = SubsonicDatabase(current_app.config["DATABASE_FILE"], current_app.config, quiet=True)
-    db.open()
-    r = PeriodicJamsLocal(user_name, .8, quiet=True)
-    try:
-        playlist = r.generate()
-    except RuntimeError as err:
-        return render_template('component/playlist-table.html', errors=str(err))
-    try:
-        recordings = playlist.playlists[0].recordings
-    except (IndexError, KeyError, AttributeError):
-        msgs = db.metadata_sanity_check(include_subsonic=True, return_as_array=True)
-        return render_template('component/playlist-table.html', errors="\n".join(msgs))
+    jams = WeeklyJams.get_or_none(WeeklyJams.user_name == user_name)
+    if jams is not None and jams.is_current(current_period()) and not request.form.get("refresh"):
+        return render_weekly_jams(jams)
 
-    services = set() 
+    if get_sync_client().refresh_weekly_jams(user_name) is None:
+        return render_template('component/playlist-table.html',
+                               errors="The playlist service is not running, please try again later.")
+
+    return render_template('component/playlist-job.html',
+                           poll_url=url_for('index_bp.weekly_jams_playlist', user_name=user_name))
+
+
+@index_bp.route("/weekly-jams/<user_name>/playlist", methods=["GET"])
+@login_required
+def weekly_jams_playlist(user_name):
+    """ Return the weekly jams of a user once they are generated, or the placeholder that polls again. """
+
+    jams = WeeklyJams.get_or_none(WeeklyJams.user_name == user_name)
+    # Answered with the error rather than a 404, htmx would not show that
+    if jams is None:
+        return render_template('component/playlist-table.html',
+                               errors="These weekly jams are not available, please generate them again.")
+
+    if jams.state == "generating":
+        # Jams whose generation was lost, e.g. with a restart of the sync daemon, are not waited for forever
+        if time() - jams.requested > WEEKLY_JAMS_GENERATE_TIMEOUT:
+            return render_template('component/playlist-table.html',
+                                   errors="Generating these weekly jams took too long, please generate them again.")
+        return render_template('component/playlist-job.html',
+                               poll_url=url_for('index_bp.weekly_jams_playlist', user_name=user_name))
+
+    return render_weekly_jams(jams)
+
+
+def render_weekly_jams(jams):
+    if jams.errors:
+        return render_template('component/playlist-table.html', errors=jams.errors)
+
+    config, msg = load_credentials(current_user.user_id)
+    recordings = deserialize_recordings(jams.recordings)
+    services = set()
     for rec in recordings:
         try:
             services.add(rec.listenbrainz["file_source"])
         except KeyError:
             services.add("???")
-            
-
-    hints = r.patch.user_feedback()
-    if not recordings:
-        hints.append("No recordings were available for playback. Have you sync'ed your service?") 
 
-    return render_template('component/playlist-table.html',
+    return stream_template('component/playlist-table.html',
                            num_services=len(services),
                            recordings=recordings,
-                           playlist_name=playlist.playlists[0].name,
-                           playlist_desc=playlist.playlists[0].description,
-                           hints=hints,
-                           services=session["subsonic"].keys(),
-                           jspf=json.dumps(playlist.get_jspf()))
+                           playlist_name=jams.name,
+                           playlist_desc=jams.description,
+                           hints=json.loads(jams.hints),
+                           services=config["SUBSONIC_SERVERS"].keys(),
+                           jspf_url=url_for('index_bp.weekly_jams_jspf', user_name=jams.user_name))
+
+
+@index_bp.route("/weekly-jams/<user_name>/jspf", methods=["GET"])
+@login_required
+def weekly_jams_jspf(user_name):
+    """ Return the JSPF of the stored weekly jams of a user, for saving them. """
+
+    jams = WeeklyJams.select(WeeklyJams.jspf).where(WeeklyJams.user_name == user_name).get_or_none()
+    if jams is None or jams.jspf is None:
+        raise NotFound
+
+    return Response(jams.jspf, mimetype="application/json")
 
 
 @index_bp.route("/top-tags", methods=["GET"])
 @login_required
 def tags():
-    db = Database(current_app.config["DATABASE_FILE"], quiet=True)
-    db.open()
-    tt = TopTags()
-    ts = tt.get_top_tags(250)
+    # The top tags are counted at the end of each sync, only count them here if no sync ran since
+    ts = TopTag.get_top_tags()
+    if not ts:
+        with content_pool.connection():
+            ts = TopTags().get_top_tags(TOP_TAGS_LIMIT)
     for tag in ts:
         tag["count"] = f"{tag['count']:,}"
     return render_template("top-tags.html", tags=ts, page="top-tags")
 
+def load_tag_page(conn, tag, after=None, minimum_count=MINIMUM_TAG_COUNT, page_size=TAG_PAGE_SIZE):
+    """
+        Return up to page_size recordings with a tag, most tagged first, starting after the (count, recording_id)
+        of the last recording of the previous page.
+    """
+
+    cursor = conn.execute("""SELECT DISTINCT recording_id
+                                   , count AS tag_count
+                                   , artist_name
+                                   , release_name
+                                   , recording_name
+                                   , artist_mbid
+                                   , release_mbid
+                                   , recording_mbid
+                                FROM recording_tag
+                                JOIN recording
+                                  ON recording.id = recording_tag.recording_id
+                                JOIN tag
+                                  ON tag.id = recording_tag.tag_id
+                               WHERE tag.name = ?
+                                 AND count >= ?
+                                 %s
+                            ORDER BY count DESC, recording_id DESC
+                               LIMIT ?""" % ("AND (count, recording_id) < (?, ?)" if after else ""),
+                          (tag, minimum_count, *(after or ()), page_size))
+    col_names = [desc[0] for desc in cursor.description]
+    return [dict(zip(col_names, row)) for row in cursor.fetchall()]
+
+
 @index_bp.route("/tag/<tag>", methods=["GET"])
 @login_required
 def tag(tag):
-    db = Database(current_app.config["DATABASE_FILE"], quiet=True)
-    db.open()
-    
-    MINIMUM_TAG_COUNT = 5  # TODO: move this
-
-    cursor = user_db.execute_sql("""SELECT DISTINCT recording_id
-                                         , count AS tag_count
-                                         , artist_name
-                                         , release_name
-                                         , recording_name
-                                         , release_mbid
-                                         , recording_mbid
-                                      FROM recording_tag
-                                      JOIN recording
-                                        ON recording.id = recording_tag.recording_id
-                                      JOIN tag
-                                        ON tag.id = recording_tag.tag_id
-                                     WHERE tag.name = ?
-                                       AND count >= ?
-                                  ORDER BY count DESC""", (tag, MINIMUM_TAG_COUNT))
-    col_names = [desc[0] for desc in cursor.description]
-    rows = []
-    for row in cursor.fetchall():
-        tmp = dict(zip(col_names, row))
-        tmp["tag_count"] = f"{int(tmp['tag_count']):,}"
-        rows.append(tmp)
-        
-    return render_template("tag.html", recordings=rows, tag=tag)
+    """
+        Show the recordings with a tag, most tagged first, a page at a time. The next page is fetched when the
+        last row of a page is scrolled into view and starts after the count and recording id of that row, so
+        every page costs the same to fetch.
+    """
+
+    try:
+        after = (int(request.args["count"]), int(request.args["recording_id"]))
+    except KeyError:
+        after = None
+    except ValueError:
+        raise BadRequest("arguments 'count' and 'recording_id' must be integers.")
+
+    # Fetch one more than a page to find out whether there is a next page
+    with content_pool.connection() as conn:
+        rows = load_tag_page(conn, tag, after, page_size=TAG_PAGE_SIZE + 1)
+
+    next_page = None
+    if len(rows) > TAG_PAGE_SIZE:
+        rows = rows[:TAG_PAGE_SIZE]
+        next_page = url_for("index_bp.tag", tag=tag, count=rows[-1]["tag_count"], recording_id=rows[-1]["recording_id"])
+    for row in rows:
+        row["tag_count"] = f"{int(row['tag_count']):,}"
+
+    if after:
+        return render_template("component/tag-rows.html", recordings=rows, next_page=next_page)
+    return render_template("tag.html", recordings=rows, next_page=next_page, tag=tag)
 
 @index_bp.route("/unresolved", methods=["GET"])
 @login_required
 def unresolved():
-    db = Database(current_app.config["DATABASE_FILE"], quiet=True)
-    db.open()
+    # Listing the unresolved recordings first removes those that have been synced since
     urt = UnresolvedRecordingTracker()
-    return render_template("unresolved.html", unresolved=urt.get_releases(), page="unresolved")
+    with content_pool.connection(read_only=False):
+        releases = urt.get_releases()
+    return render_template("unresolved.html", unresolved=releases, page="unresolved")
@@ -1,18 +1,20 @@
-import datetime
-import timeago
-from time import time, monotonic
+from html import escape
+from time import time, monotonic, sleep
 from urllib.parse import urlparse
 
 import peewee
 from playhouse.shortcuts import model_to_dict
 import validators
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, Response, make_response
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, Response, make_response, \
+    stream_with_context
 from flask_login import login_required, current_user
 from werkzeug.exceptions import BadRequest, NotFound, Forbidden
 
+from lb_local.model.database import content_pool
 from lb_local.model.service import Service
 from lb_local.model.credential import Credential
-from lb_local.view.credential import load_credentials
+from lb_local.model.user import User
+from lb_local.view.credential import invalidate_credentials
 from lb_local.sync import SyncClient, SubmitMessage
 
 try:
@@ -29,6 +31,22 @@ service_bp = Blueprint("service_bp", __name__)
 
 LOG_EXPIRY_DURATION = 60 * 60  # in s
 
+# How often a sync event stream looks at the status board for a new status of its service, in s
+SYNC_EVENTS_POLL_INTERVAL = .25
+# How often a sync event stream that has nothing to send sends a comment, so proxies keep it open, in s
+SYNC_EVENTS_KEEPALIVE = 15
+# For how long a sync event stream runs at most, in s. A stream holds a thread of its web worker, of which uwsgi
+# runs --threads=4 (see the Dockerfile), so the open sync pages of a worker are limited to as many streams. Ending
+# streams now and then frees the threads of pages that were left open; the browser reconnects to a page that is
+# still open and the stream goes on after the last event the page got.
+SYNC_EVENTS_MAX_AGE = 5 * 60
+
+
+def get_sync_client():
+    return SyncClient(current_app.config["SYNC_ADDRESS"],
+                      current_app.config["SYNC_AUTHKEY"],
+                      current_app.config["STATUS_BOARD"])
+
 
 @service_bp.route("/", methods=["GET"])
 @login_required
@@ -43,17 +61,15 @@ def service_index():
 def service_list():
     if not current_user.is_service_user and not current_user.is_admin:
         raise NotFound
-    if current_user.is_admin:
-        services = Service.select()
-    else:
-        services = Service.select().where(Service.owner == current_user)
-    for service in services:
-        if service.last_synched:
-            sync_date = datetime.datetime.fromtimestamp(service.last_synched)
-            service.last_synched_text = timeago.format(sync_date, datetime.datetime.now())
-        else:
-            service.last_synched_text = ""
-    return render_template("component/service-list.html", services=services)
+    # The services with their owners in one query, leaving out the scan logs. The page shows how long ago the
+    # services were synced from last_synched.
+    services = Service.select(Service.id, Service.slug, Service.url, Service.status, Service.last_synched,
+                              User.user_id, User.name) \
+                      .join(User) \
+                      .order_by(Service.id)
+    if not current_user.is_admin:
+        services = services.where(Service.owner == current_user.user_id)
+    return render_template("component/service-list.html", services=list(services))
 
 
 @service_bp.route("/add", methods=["GET"])
@@ -88,6 +104,7 @@ def service_delete(slug):
         if not current_user.is_admin and service.owner.user_id != current_user.user_id:
             raise Forbidden
         service.delete_instance()
+        invalidate_credentials()
         flash("Service deleted")
     except peewee.DoesNotExist:
         raise NotFound
@@ -140,8 +157,12 @@ def service_add_post():
             flash("Service does not exist. Internal error.")
             return render_template("service-add.html", slug=slug, url=url, mode=mode)
         service.save()
+        if slug != old_slug:
+            # The recordings of a service carry its slug as their file source
+            with content_pool.connection(read_only=False) as conn:
+                conn.execute("UPDATE recording SET file_source = ? WHERE file_source = ?", (slug, old_slug))
 
-    load_credentials(current_user.user_id)
+    invalidate_credentials()
 
     return redirect(url_for("service_bp.service_index"))
 
@@ -158,17 +179,17 @@ def service_sync(slug):
     if not current_user.is_admin and current_user.user_id != service.owner.user_id:
         raise NotFound
         
-    client = SyncClient(current_app.config["SUBMIT_QUEUE"],
-                        current_app.config["STATS_REQ_QUEUE"],
-                        current_app.config["STATS_QUEUE"])
+    client = get_sync_client()
     current_status = client.sync_status(slug)
     return render_template("service-sync.html",
                            page="service",
                            slug=slug,
-                           complete=(current_status and current_status.complete) or True)
+                           complete=current_status is None or current_status.complete,
+                           events_url=url_for("service_bp.service_sync_events", slug=slug))
 
 @service_bp.route("/<slug>/sync/start", methods=["POST"])
 @service_bp.route("/<slug>/sync/start/metadata-only", methods=["POST"])
+@service_bp.route("/<slug>/sync/start/incremental", methods=["POST"])
 @login_required
 def service_sync_start(slug):
     if not current_user.is_service_user and not current_user.is_admin:
@@ -176,6 +197,8 @@ def service_sync_start(slug):
     
     if request.path.endswith("metadata-only"):
         type = "metadata_only"
+    elif request.path.endswith("incremental"):
+        type = "incremental"
     else:
         type = "full"
 
@@ -200,14 +223,15 @@ def service_sync_start(slug):
                                type=type,
                                expire_at=expire_at)
 
-    client = SyncClient(current_app.config["SUBMIT_QUEUE"],
-                        current_app.config["STATS_REQ_QUEUE"],
-                        current_app.config["STATS_QUEUE"])
+    client = get_sync_client()
+    # The events of this sync are the statuses published after the current one
+    after = client.status_board.sequence(slug)
     msg = client.request_sync(submit_msg)
     if msg:
         return render_template("component/sync-status.html", logs=msg, update=True, slug=slug)
 
-    return render_template("component/sync-status.html", update=True, slug=slug)
+    return render_template("component/sync-events.html",
+                           events_url=url_for("service_bp.service_sync_events", slug=slug, after=after))
 
 @service_bp.route("/<slug>/sync/log")
 @login_required
@@ -219,9 +243,7 @@ def service_sync_log(slug):
     if not current_user.is_admin and current_user.user_id != service.owner.user_id:
         raise NotFound
 
-    client = SyncClient(current_app.config["SUBMIT_QUEUE"],
-                        current_app.config["STATS_REQ_QUEUE"],
-                        current_app.config["STATS_QUEUE"])
+    client = get_sync_client()
     current_status = client.sync_status(slug)
     if current_status is None:
         return "", 204
@@ -237,6 +259,99 @@ def service_sync_log(slug):
                         headers=headers)
     return response
 
+def sync_event(event, data, event_id=None):
+    """ Format a server-sent event, the data may span several lines. """
+
+    event_id = "id: %s\n" % event_id if event_id is not None else ""
+    return "event: %s\n%sdata: %s\n\n" % (event, event_id, "\ndata: ".join(data.replace("\r", "").split("\n")))
+
+
+def sync_event_id(seq, log_lines, log_position):
+    """ Return the id of a sync event: how far the stream got, for continuing after it when the browser reconnects. """
+
+    return "/".join(str(field) for field in (seq, log_lines) + (log_position or ()))
+
+
+def parse_sync_event_id(event_id):
+    """ Return the status sequence, log lines and log position of a sync event id, or None if it is not one. """
+
+    try:
+        fields = event_id.split("/")
+        if len(fields) == 2:
+            return int(fields[0]), int(fields[1]), None
+        if len(fields) == 5:
+            return int(fields[0]), int(fields[1]), (fields[2], int(fields[3]), int(fields[4]))
+    except ValueError:
+        pass
+    return None
+
+
+@service_bp.route("/<slug>/sync/events")
+@login_required
+def service_sync_events(slug):
+    """
+        Stream the sync of a service to its sync page as server-sent events: "status" with the rendered stats,
+        "log" with the lines logged since the last event and "complete" once the sync finished, after which the
+        stream ends. The stream watches the status board the sync daemon publishes to, which costs a look at
+        the shared memory of the board per SYNC_EVENTS_POLL_INTERVAL, and only asks the daemon for the log when
+        the status says that it grew. An after argument skips the statuses published before a sync started.
+
+        Each stream takes a thread of the web worker for as long as it runs, so it ends after SYNC_EVENTS_MAX_AGE
+        seconds. The browser then connects again with the id of the last event it got, which the new stream
+        goes on from.
+    """
+
+    if not current_user.is_service_user and not current_user.is_admin:
+        raise NotFound
+
+    service = Service.get_or_none(Service.slug == slug)
+    if service is None:
+        raise NotFound
+    if not current_user.is_admin and current_user.user_id != service.owner_id:
+        raise NotFound
+
+    after = request.args.get("after", -1, type=int)
+    # The log of a sync that is over when the stream starts is left to the full log
+    seq, log_lines, log_position = after, 0, None
+    resumed = parse_sync_event_id(request.headers.get("Last-Event-ID", ""))
+    if resumed is not None:
+        seq, log_lines, log_position = resumed
+    client = get_sync_client()
+
+    def generate():
+        nonlocal seq, log_lines, log_position
+        started = sent = monotonic()
+        while monotonic() - started < SYNC_EVENTS_MAX_AGE:
+            current_seq = client.status_board.sequence(slug)
+            status = client.sync_status(slug) if current_seq > seq else None
+            # A service that has no status was not synced since the status board was created. One that has
+            # a sequence may not be readable for a moment, while the daemon writes it: that is no news.
+            if current_seq > seq and (status is not None or current_seq == 0):
+                seq = current_seq
+                yield sync_event("status", render_template("component/sync-status.html",
+                                                           stats=status.stats if status else None),
+                                 sync_event_id(seq, log_lines, log_position))
+                if status is not None and status.log_offset > log_lines and \
+                        (after >= 0 or log_position is not None or not status.complete):
+                    text, log_position = client.log_tail(slug, log_position)
+                    log_lines = status.log_offset
+                    if text:
+                        yield sync_event("log", escape(text), sync_event_id(seq, log_lines, log_position))
+                if status is None or status.complete:
+                    yield sync_event("complete", "")
+                    return
+                sent = monotonic()
+            elif monotonic() - sent > SYNC_EVENTS_KEEPALIVE:
+                yield ": keepalive\n\n"
+                sent = monotonic()
+
+            sleep(SYNC_EVENTS_POLL_INTERVAL)
+
+    return Response(stream_with_context(generate()),
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @service_bp.route("/<slug>/sync/full-log")
 @login_required
 def service_sync_full_log(slug):
@@ -247,15 +362,14 @@ def service_sync_full_log(slug):
     if not current_user.is_admin and current_user.user_id != service.owner.user_id:
         raise NotFound
 
-    client = SyncClient(current_app.config["SUBMIT_QUEUE"],
-                        current_app.config["STATS_REQ_QUEUE"],
-                        current_app.config["STATS_QUEUE"])
-    current_status = client.sync_status(slug)
-    if current_status is None or current_status.logs is None:
-        logs = "No log file available."
-    else:
-        logs = current_status.logs
-    
-    response = make_response(logs, 200)
-    response.mimetype = "text/plain"
-    return response
+    client = get_sync_client()
+
+    def generate():
+        empty = True
+        for chunk in client.sync_log(slug):
+            empty = False
+            yield chunk
+        if empty:
+            yield "No log file available."
+
+    return Response(generate(), mimetype="text/plain")
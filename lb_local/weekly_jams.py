@@ -0,0 +1,209 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import logging
+from threading import Event, Lock, Thread
+from time import time
+import traceback
+
+from troi import Recording, Release, ArtistCredit, Artist
+from troi.content_resolver.subsonic import SubsonicDatabase
+from troi.local.periodic_jams_local import PeriodicJamsLocal
+from troi.patches.periodic_jams_local import PeriodicJamsLocalPatch
+
+from lb_local.config import DEFAULT_WEEKLY_JAMS_REFRESH_INTERVAL
+from lb_local.model.database import content_pool
+from lb_local.model.weekly_jams import WeeklyJams
+
+# Only the jams of user names the page asked for in the last four weeks are generated again, the others are
+# generated when the page asks for them next
+WEEKLY_JAMS_REFRESH_MAX_AGE = 4 * 7 * 24 * 60 * 60
+
+# How many seconds the page waits for jams to be generated before it gives up on them
+WEEKLY_JAMS_GENERATE_TIMEOUT = 10 * 60
+
+# How well a recording of the collection must match a recommended recording to be used, from 0 to 1.0
+MATCH_THRESHOLD = .8
+
+WeeklyJamsRequest = namedtuple("WeeklyJamsRequest", ["user_name"])
+
+
+def current_period(today=None):
+    """ The period weekly jams are generated for: ListenBrainz updates the recommendations each monday. """
+
+    year, week, day = (today or datetime.date.today()).isocalendar()
+    return "%d-W%02d" % (year, week)
+
+
+def serialize_recordings(recordings):
+    """ Serialize the recordings of a playlist to JSON, with what the playlist table shows of them. """
+
+    data = []
+    for rec in recordings:
+        item = {"mbid": rec.mbid, "name": rec.name, "duration": rec.duration,
+                "musicbrainz": rec.musicbrainz, "listenbrainz": rec.listenbrainz}
+        if rec.release is not None:
+            item["release"] = {"mbid": rec.release.mbid, "name": rec.release.name}
+        if rec.artist_credit is not None:
+            item["artist_credit"] = {"name": rec.artist_credit.name,
+                                     "artists": [{"mbid": a.mbid, "name": a.name, "join_phrase": a.join_phrase}
+                                                 for a in rec.artist_credit.artists or []]}
+        data.append(item)
+
+    return json.dumps(data, default=str)
+
+
+def deserialize_recordings(text):
+    """ Turn the JSON written by serialize_recordings back into troi recordings. """
+
+    recordings = []
+    for item in json.loads(text):
+        release = Release(**item["release"]) if "release" in item else None
+        artist_credit = None
+        if "artist_credit" in item:
+            artist_credit = ArtistCredit(name=item["artist_credit"]["name"],
+                                         artists=[Artist(**a) for a in item["artist_credit"]["artists"]])
+        recordings.append(Recording(name=item["name"], mbid=item["mbid"], duration=item["duration"],
+                                    release=release, artist_credit=artist_credit,
+                                    musicbrainz=item["musicbrainz"], listenbrainz=item["listenbrainz"]))
+    return recordings
+
+
+class WeeklyJamsLocal(PeriodicJamsLocal):
+    """ PeriodicJamsLocal that keeps its patch, for the hints it has for the user. """
+
+    def __init__(self, user_name, match_threshold, quiet=False):
+        PeriodicJamsLocal.__init__(self, user_name, match_threshold, quiet)
+        self.patch = None
+
+    def generate(self):
+        self.patch = PeriodicJamsLocalPatch({"user_name": self.user_name, "quiet": self.quiet, "min_recordings": 1})
+
+        try:
+            playlist = self.patch.generate_playlist()
+        except RuntimeError as err:
+            logging.info(f"Weekly jams generation failed: {err}")
+            return None
+
+        if playlist is None:
+            return playlist
+
+        self.resolve_playlist(self.match_threshold, playlist)
+        return playlist
+
+
+class WeeklyJamsWorker(Thread):
+    """
+        Generate the weekly jams of ListenBrainz users in the background and store them, so the weekly jams page
+        only reads them. Runs in the sync daemon: jams are generated when the page asks for jams that are not
+        stored yet or when a user asks to refresh them, and every refresh_interval seconds the thread generates
+        the stored jams of a past period again. Jams are generated one at a time, as they fetch the
+        recommendations from ListenBrainz.
+    """
+
+    def __init__(self, db_file, refresh_interval=DEFAULT_WEEKLY_JAMS_REFRESH_INTERVAL):
+        Thread.__init__(self)
+        self.db_file = db_file
+        self.refresh_interval = refresh_interval
+        self.lock = Lock()
+        # The user names whose jams are waiting or being generated
+        self.pending = set()
+        self._exit = Event()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="weekly-jams")
+
+    def exit(self):
+        self._exit.set()
+
+    def run(self):
+        while True:
+            try:
+                self.refresh_stale()
+            except Exception:
+                logging.error(traceback.format_exc())
+            if self._exit.wait(self.refresh_interval):
+                break
+
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def refresh_stale(self):
+        """
+            Generate the jams of a past period again, and the ones whose generation was interrupted, of the user
+            names the page asked for in the last WEEKLY_JAMS_REFRESH_MAX_AGE seconds.
+        """
+
+        period = current_period()
+        stale = WeeklyJams.select(WeeklyJams.user_name) \
+                          .where((WeeklyJams.period != period) | (WeeklyJams.state == "generating"),
+                                 WeeklyJams.requested > int(time()) - WEEKLY_JAMS_REFRESH_MAX_AGE)
+        for jams in stale:
+            self.refresh(jams.user_name, requested=False)
+
+    def refresh(self, user_name, requested=True):
+        """
+            Generate the weekly jams of a user, unless they are being generated already. Returns True. requested
+            is set when the page asked for them: the jams are marked as generating, for the page to poll.
+        """
+
+        # Mark the jams before replying, so that the page polls until they are generated
+        if requested:
+            WeeklyJams.insert(user_name=user_name, period=current_period(), state="generating",
+                              requested=int(time())) \
+                      .on_conflict(conflict_target=[WeeklyJams.user_name],
+                                   preserve=[WeeklyJams.state, WeeklyJams.requested]) \
+                      .execute()
+
+        with self.lock:
+            if user_name in self.pending:
+                return True
+            self.pending.add(user_name)
+
+        self.executor.submit(self.run_job, user_name)
+        return True
+
+    def run_job(self, user_name):
+        period = current_period()
+        try:
+            fields = self.generate(user_name)
+        except BaseException:
+            # troi calls sys.exit() on some database errors, that must not take the pool thread down
+            logging.error(traceback.format_exc())
+            fields = {"errors": "An error occurred when generating the playlist."}
+
+        try:
+            defaults = {"name": None, "description": None, "recordings": None, "hints": None, "jspf": None,
+                        "errors": None}
+            WeeklyJams.update(**{**defaults, **fields}, period=period, state="complete", generated=int(time())) \
+                      .where(WeeklyJams.user_name == user_name) \
+                      .execute()
+        finally:
+            with self.lock:
+                self.pending.discard(user_name)
+
+    def generate(self, user_name):
+        """ Generate the weekly jams of a user and return the WeeklyJams fields to store. """
+
+        # Resolving the playlist records the recordings it could not find, so this needs a connection to write with
+        db = SubsonicDatabase(self.db_file, {}, quiet=True)
+        r = WeeklyJamsLocal(user_name, MATCH_THRESHOLD, quiet=True)
+        with content_pool.connection(read_only=False):
+            try:
+                playlist = r.generate()
+            except RuntimeError as err:
+                return {"errors": str(err)}
+
+            try:
+                recordings = playlist.playlists[0].recordings
+            except (IndexError, KeyError, AttributeError):
+                msgs = db.metadata_sanity_check(include_subsonic=True, return_as_array=True)
+                return {"errors": "\n".join(msgs)}
+
+        hints = r.patch.user_feedback()
+        if not recordings:
+            hints.append("No recordings were available for playback. Have you sync'ed your service?")
+
+        return {"name": playlist.playlists[0].name,
+                "description": playlist.playlists[0].description,
+                "recordings": serialize_recordings(recordings),
+                "hints": json.dumps(hints),
+                "jspf": json.dumps(playlist.get_jspf(), separators=(",", ":"))}
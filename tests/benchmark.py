@@ -0,0 +1,388 @@
+"""
+    Benchmark the content views against synthetic collections of growing size. For every size a collection is
+    generated, the app is created on top of it and each endpoint is requested through the Flask test client, first
+    to warm up the caches and then to measure. The database queries behind the views are also timed on their own.
+    The throughput and latency percentiles of every endpoint and query are written as JSON, so runs can be
+    compared over time:
+
+        python -m tests.benchmark --sizes 10000 100000 1000000 --output benchmark.json
+
+    The ListenBrainz and MusicBrainz lookups of the views are answered locally with synthetic data, so the benchmark
+    measures the work done by the app and the database rather than the network.
+"""
+from argparse import ArgumentParser
+from contextlib import contextmanager, ExitStack
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from time import monotonic, sleep
+from unittest.mock import Mock, patch
+
+from tests.synthetic_collection import build_collection, artist_mbid, tag_name
+
+# The app reads its configuration from the environment when lb_local.server is imported
+BENCHMARK_ENV = {
+    'SECRET_KEY': 'benchmark-secret-key',
+    'DOMAIN': 'http://localhost',
+    'PORT': '5000',
+    'AUTHORIZED_USERS': 'benchmark',
+    'ADMIN_USERS': 'benchmark',
+    'SERVICE_USERS': 'benchmark',
+    'MUSICBRAINZ_CLIENT_ID': 'benchmark-client-id',
+    'MUSICBRAINZ_CLIENT_SECRET': 'benchmark-client-secret',
+}
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+DEFAULT_WARMUP = 3
+DEFAULT_REQUESTS = 20
+
+# How many of the recordings of the collection the Weekly Jams recommendations contain
+NUM_RECOMMENDATIONS = 100
+
+# Tags on about 1% of the recordings each. LB Radio searches return all matching recordings, so they are timed
+# for rarer tags.
+RARE_TAGS = [tag_name(20), tag_name(30)]
+
+# Artists with about 2% of the collection between them, the most popular ones have a lot more
+SIMILAR_ARTISTS = [{"artist_mbid": artist_mbid(i), "score": 100 - i} for i in range(50, 60)]
+
+PERCENTILES = (50, 90, 99)
+
+# The placeholder returned while a playlist is generated polls this
+PLAYLIST_JOB_URL = re.compile(r'hx-get="(/lb-radio/job/[0-9a-f-]+|/weekly-jams/[^/"]+/playlist)"')
+
+
+class FakeResponse:
+
+    def __init__(self, data):
+        self.status_code = 200
+        self.text = json.dumps(data)
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def recording_metadata(recording_mbids):
+    """ Make up ListenBrainz metadata for recordings, ten recordings to a release. """
+
+    data = {}
+    for mbid in recording_mbids:
+        release = "release-%s" % mbid[:7]
+        data[mbid] = {
+            "artist": {"name": "Artist %s" % mbid[:2], "artist_credit_id": 1,
+                       "artists": [{"artist_mbid": mbid, "name": "Artist %s" % mbid[:2], "join_phrase": ""}]},
+            "release": {"name": "Release %s" % mbid[:7], "mbid": release, "release_group_mbid": release},
+            "recording": {"name": "Recording %s" % mbid},
+        }
+    return data
+
+
+def lookup_get(url, params=None, **kwargs):
+    """ Answer the recording metadata lookups of /unresolved. """
+
+    return FakeResponse(recording_metadata(params["recording_mbids"].split(",")))
+
+
+def lookup_post(url, json=None, **kwargs):
+    """ Answer the recording metadata lookups of LB Radio. """
+
+    return FakeResponse(recording_metadata(json["recording_mbids"]))
+
+
+def load_recommendations(db_file, count=NUM_RECOMMENDATIONS):
+    """ Pick recordings spread over the collection for the Weekly Jams recommendations. """
+
+    conn = sqlite3.connect(db_file)
+    try:
+        num_recordings = conn.execute("SELECT count(*) FROM recording").fetchone()[0]
+        step = max(1, num_recordings // count)
+        return conn.execute("""SELECT artist_name, recording_name, recording_mbid
+                                 FROM recording
+                                WHERE id % ? = 0
+                                LIMIT ?""", (step, count)).fetchall()
+    finally:
+        conn.close()
+
+
+@contextmanager
+def stubbed_remote_lookups(recommendations):
+    """ Answer the lookups the views make to ListenBrainz and MusicBrainz with synthetic data. """
+
+    from troi import Element, Recording, ArtistCredit
+    from troi.local.recording_resolver import RecordingResolverElement
+    from troi.patches.lb_radio_classes.tag import LBRadioTagRecordingElement
+    from troi.patches.periodic_jams_local import PeriodicJamsLocalPatch
+    from troi.playlist import PlaylistMakerElement
+    from troi.plist import plist
+
+    class Recommendations(Element):
+
+        def outputs(self):
+            return [Recording]
+
+        def read(self, inputs):
+            return [Recording(name=name, mbid=mbid, artist_credit=ArtistCredit(name=artist))
+                    for artist, name, mbid in recommendations]
+
+    def weekly_jams(patch, inputs):
+        # The recommendations, listens and feedback come from ListenBrainz, resolving them is the local work
+        resolve = RecordingResolverElement(.8, patch.quiet)
+        resolve.set_sources(Recommendations())
+        pl_maker = PlaylistMakerElement(name="Weekly Jams for %s" % inputs["user_name"],
+                                        desc="benchmark playlist",
+                                        patch_slug="periodic-jams",
+                                        max_num_recordings=50,
+                                        max_artist_occurrence=2,
+                                        shuffle=True)
+        pl_maker.set_sources(resolve)
+        return pl_maker
+
+    with ExitStack() as stack:
+        stack.enter_context(patch("troi.content_resolver.unresolved_recording.http_get", lookup_get))
+        stack.enter_context(patch("troi.http_request.http_post", lookup_post))
+        stack.enter_context(patch.object(LBRadioTagRecordingElement, "fetch_similar_tags", lambda self, tag: plist()))
+        stack.enter_context(patch.object(PeriodicJamsLocalPatch, "create", weekly_jams))
+        yield
+
+
+@contextmanager
+def benchmark_client(db_file):
+    """ Create the app on top of a collection and yield a test client logged in as the benchmark user. """
+
+    with patch('lb_local.sync.SyncManager'), patch.dict('os.environ', {**BENCHMARK_ENV, 'DATABASE_FILE': db_file}), \
+            playlist_workers(db_file):
+        from lb_local.server import create_app
+        from lb_local.view.index import index_bp
+        from lb_local.model.user import User
+        from lb_local.model.database import content_pool
+        from lb_local.model.top_tag import TopTag, TOP_TAGS_LIMIT
+        from troi.content_resolver.top_tags import TopTags
+
+        app, oauth = create_app()
+        app.register_blueprint(index_bp)
+
+        # Count the top tags, as the end of a sync does
+        with content_pool.connection():
+            TopTag.rebuild(TopTags().get_top_tags(TOP_TAGS_LIMIT))
+
+        with app.test_client() as client, app.app_context():
+            user, created = User.get_or_create(name="benchmark")
+            with client.session_transaction() as sess:
+                sess['_user_id'] = user.login_id
+                sess['_fresh'] = True
+                sess['subsonic'] = {}
+                sess['cors_url'] = ''
+            yield client
+
+
+@contextmanager
+def playlist_workers(db_file):
+    """ Generate LB Radio playlists and weekly jams in this process, as the sync daemon would. """
+
+    from lb_local.radio import RadioWorker
+    from lb_local.weekly_jams import WeeklyJamsWorker
+
+    radio = RadioWorker(db_file)
+    weekly_jams = WeeklyJamsWorker(db_file)
+    sync_client = Mock()
+    sync_client.submit_radio.side_effect = radio.submit
+    sync_client.radio_result.side_effect = radio.result
+    sync_client.refresh_weekly_jams.side_effect = weekly_jams.refresh
+    try:
+        with patch('lb_local.view.index.get_sync_client', return_value=sync_client):
+            yield
+    finally:
+        radio.shutdown()
+        weekly_jams.executor.shutdown(wait=True)
+
+
+def percentile(timings, p):
+    """ The p-th percentile of the sorted timings, by the nearest rank. """
+
+    rank = max(1, -(-len(timings) * p // 100))
+    return timings[rank - 1]
+
+
+def measure(client, method, path, data=None, warmup=DEFAULT_WARMUP, requests=DEFAULT_REQUESTS):
+    """
+        Request an endpoint warmup times, then time requests more requests of it. A request that returns a
+        placeholder for a playlist that is being generated lasts until the playlist is there.
+    """
+
+    def request():
+        response = client.open(path, method=method, data=data)
+        while response.status_code < 400:
+            job = PLAYLIST_JOB_URL.search(response.get_data(as_text=True))
+            if job is None:
+                break
+            sleep(.005)
+            response = client.get(job.group(1))
+        # Playlists that could not be generated come back with the errors in the page
+        return response.status_code < 400 and b'id="errors"' not in response.data
+
+    return time_calls(request, warmup, requests)
+
+
+def time_calls(call, warmup=DEFAULT_WARMUP, requests=DEFAULT_REQUESTS):
+    """ Make warmup calls, then time requests more calls. A call that returns False counts as an error. """
+
+    for i in range(warmup):
+        call()
+
+    timings = []
+    errors = 0
+    start = monotonic()
+    for i in range(requests):
+        request_start = monotonic()
+        if call() is False:
+            errors += 1
+        timings.append(monotonic() - request_start)
+    elapsed = monotonic() - start
+
+    timings.sort()
+    result = {
+        "requests": requests,
+        "errors": errors,
+        "throughput": requests / elapsed,
+        "mean_ms": sum(timings) / len(timings) * 1000,
+    }
+    for p in PERCENTILES:
+        result["p%d_ms" % p] = percentile(timings, p) * 1000
+    return result
+
+
+def endpoints(collection):
+    """ The requests to benchmark as (name, method, path, form data). """
+
+    # Start a page of the most used tag half way through its recordings
+    deep_cursor = "count=10&recording_id=%d" % (collection.num_recordings // 2)
+    return [
+        ("top-tags", "GET", "/top-tags", None),
+        ("tag", "GET", "/tag/%s" % tag_name(0), None),
+        ("tag-next-page", "GET", "/tag/%s?%s" % (tag_name(0), deep_cursor), None),
+        ("unresolved", "GET", "/unresolved", None),
+        ("lb-radio-tag", "POST", "/lb-radio", {"prompt": "tag:(%s)" % tag_name(20), "mode": "easy"}),
+        ("lb-radio-popular-tag", "POST", "/lb-radio", {"prompt": "tag:(%s)" % tag_name(0), "mode": "easy"}),
+        # The first request generates the jams, the ones after that read the stored jams
+        ("weekly-jams", "POST", "/weekly-jams", {"user_name": "benchmark"}),
+        ("weekly-jams-refresh", "POST", "/weekly-jams", {"user_name": "benchmark", "refresh": "1"}),
+    ]
+
+
+def queries(collection):
+    """ The database queries of the content views to time on their own, as (name, query of a connection). """
+
+    from troi.content_resolver.artist_search import LocalRecordingSearchByArtistService
+    from troi.content_resolver.tag_search import LocalRecordingSearchByTagService
+    from lb_local.model.top_tag import TopTag
+    from lb_local.view.index import load_tag_page
+
+    deep_cursor = (10, collection.num_recordings // 2)
+    tag_search = LocalRecordingSearchByTagService()
+    artist_search = LocalRecordingSearchByArtistService()
+    return [
+        ("top-tags", lambda conn: TopTag.get_top_tags()),
+        ("tag-page", lambda conn: load_tag_page(conn, tag_name(0))),
+        ("tag-next-page", lambda conn: load_tag_page(conn, tag_name(0), deep_cursor)),
+        ("lb-radio-tag-or", lambda conn: tag_search.search(RARE_TAGS, "or", 0, 100, 50)),
+        ("lb-radio-tag-and", lambda conn: tag_search.search(RARE_TAGS, "and", 0, 100, 50)),
+        ("lb-radio-artist", lambda conn: artist_search.search("easy", SIMILAR_ARTISTS[0]["artist_mbid"], 0, 100,
+                                                              20, 10)),
+    ]
+
+
+def measure_queries(collection, warmup=DEFAULT_WARMUP, requests=DEFAULT_REQUESTS):
+    """ Time the queries of the content views on a pooled connection, without the rest of the request. """
+
+    from troi.content_resolver.artist_search import LocalRecordingSearchByArtistService
+    from lb_local.model.database import content_pool
+
+    results = {}
+    with patch.object(LocalRecordingSearchByArtistService, "get_similar_artists",
+                      lambda self, mbid: SIMILAR_ARTISTS), content_pool.connection() as conn:
+        for name, query in queries(collection):
+            results[name] = time_calls(lambda: query(conn), warmup, requests)
+    return results
+
+
+def benchmark_collection(num_recordings, workdir, warmup=DEFAULT_WARMUP, requests=DEFAULT_REQUESTS, log=print):
+    """ Generate a collection of num_recordings recordings and benchmark the endpoints against it. """
+
+    db_file = os.path.join(workdir, "lb-local-%d.db" % num_recordings)
+    start = monotonic()
+    collection = build_collection(db_file, num_recordings)
+    log("%d recordings: collection generated in %.1fs" % (num_recordings, monotonic() - start))
+
+    result = {"recordings": num_recordings, "artists": collection.num_artists, "tags": collection.num_tags,
+              "unresolved": collection.num_unresolved, "endpoints": {}, "queries": {}}
+    with stubbed_remote_lookups(load_recommendations(db_file)), benchmark_client(db_file) as client:
+        for name, method, path, data in endpoints(collection):
+            stats = measure(client, method, path, data, warmup, requests)
+            result["endpoints"][name] = stats
+            log("%d recordings: %-22s %7.1f req/s  p50 %7.1fms  p99 %7.1fms  %d errors" %
+                (num_recordings, name, stats["throughput"], stats["p50_ms"], stats["p99_ms"], stats["errors"]))
+
+        result["queries"] = measure_queries(collection, warmup, requests)
+        for name, stats in result["queries"].items():
+            log("%d recordings: query %-16s %7.1f q/s    p50 %7.1fms  p99 %7.1fms" %
+                (num_recordings, name, stats["throughput"], stats["p50_ms"], stats["p99_ms"]))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes=DEFAULT_SIZES, warmup=DEFAULT_WARMUP, requests=DEFAULT_REQUESTS, workdir=None, log=print):
+    """ Benchmark the endpoints for every collection size and return the results with the details of the run. """
+
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "warmup": warmup,
+        "requests": requests,
+        "collections": [],
+    }
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp_dir:
+        for num_recordings in sizes:
+            results["collections"].append(benchmark_collection(num_recordings, tmp_dir, warmup, requests, log))
+    return results
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Benchmark the content views against synthetic collections.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="number of recordings of each collection")
+    parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP, help="requests per endpoint before measuring")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS, help="measured requests per endpoint")
+    parser.add_argument("--workdir", help="directory for the generated collections, they can be large")
+    parser.add_argument("--output", help="write the results as JSON to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    # lb_local.server creates an app when imported, which needs a configuration
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+    os.environ.setdefault("DATABASE_FILE", os.path.join(tempfile.mkdtemp(dir=args.workdir), "lb-local.db"))
+
+    results = run(args.sizes, args.warmup, args.requests, args.workdir, log=lambda msg: print(msg, file=sys.stderr))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import json
+from threading import Thread, Lock
+from time import sleep
+from urllib.parse import urlparse, parse_qs
+import uuid
+
+
+def make_album(index, songs=3):
+    """ Make an album for the fake server, with MBIDs for it, its artist and its songs. """
+
+    album_id = "al-%d" % index
+    return {"entry": {"id": album_id,
+                      "name": "Album %d" % index,
+                      "artist": "Artist %d" % (index % 10),
+                      "artistId": "ar-%d" % (index % 10),
+                      "songCount": songs,
+                      "musicBrainzId": str(uuid.uuid5(uuid.NAMESPACE_URL, album_id))},
+            "songs": [{"id": "%s-%d" % (album_id, i),
+                       "title": "Song %d of album %d" % (i, index),
+                       "album": "Album %d" % index,
+                       "artist": "Artist %d" % (index % 10),
+                       "artistId": "ar-%d" % (index % 10),
+                       "duration": 180,
+                       "track": i + 1,
+                       "musicBrainzId": str(uuid.uuid5(uuid.NAMESPACE_URL, "%s-%d" % (album_id, i)))}
+                      for i in range(songs)]}
+
+
+class FakeSubsonic:
+    """
+        A Subsonic server that serves an in-memory library, for testing scans without a real server. Tests
+        change the library between scans and check which API methods the scan called.
+    """
+
+    def __init__(self, albums=(), latency=0):
+        self.albums = {album["entry"]["id"]: album for album in albums}
+        self.latency = latency
+        # Ids of the albums that are listed but cannot be fetched
+        self.failing = set()
+        self.calls = []
+        self.lock = Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def methods(self, method):
+        with self.lock:
+            return [params for name, params in self.calls if name == method]
+
+    def answer(self, method, params):
+        if method == "getAlbumList2":
+            entries = [album["entry"] for album in self.albums.values()]
+            offset, size = int(params["offset"]), int(params["size"])
+            return {"albumList2": {"album": entries[offset:offset + size]}}
+        if method == "getAlbum":
+            album = self.albums.get(params["id"])
+            if album is None or params["id"] in self.failing:
+                return None
+            return {"album": dict(album["entry"], song=album["songs"])}
+        if method == "getArtistInfo2":
+            return {"artistInfo2": {"musicBrainzId": str(uuid.uuid5(uuid.NAMESPACE_URL, params["id"]))}}
+        return None
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, don't let the client's delayed ack hold up the body
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                method = url.path.rsplit("/", 1)[-1]
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                with fake.lock:
+                    fake.calls.append((method, params))
+                if fake.latency:
+                    sleep(fake.latency)
+
+                result = fake.answer(method, params)
+                if result is None:
+                    response = {"status": "failed", "error": {"code": 70, "message": "not found"}}
+                else:
+                    response = dict(result, status="ok")
+                body = json.dumps({"subsonic-response": response}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
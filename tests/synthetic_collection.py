@@ -0,0 +1,135 @@
+"""
+    Generate synthetic music collections for benchmarks and query plan tests. A few artists have most of the
+    recordings and a few tags are on most of them, like in real collections.
+"""
+from collections import namedtuple
+import random
+import sqlite3
+import uuid
+
+from troi.content_resolver.model.database import db as content_db, setup_db as setup_content_db
+from troi.content_resolver.model.recording import Recording, RecordingMetadata
+from troi.content_resolver.model.tag import Tag, RecordingTag
+from troi.content_resolver.model.unresolved_recording import UnresolvedRecording
+
+SyntheticCollection = namedtuple("SyntheticCollection", "db_file num_recordings num_artists num_tags num_unresolved")
+
+# The tables are filled in chunks of this many rows
+INSERT_CHUNK = 50000
+
+# Names are spelled from these, so that every artist, release and recording has its own name to match
+SYLLABLES = ("ba", "ko", "ri", "mel", "tan", "vo", "su", "len", "dra", "pi", "gor", "ne", "sha", "ul", "fen", "qua",
+             "do", "ma", "zir", "te", "bon", "ka", "ly", "ros", "che", "vin", "ga", "nu", "ter", "hal", "jo", "wex")
+
+
+def mbid(name):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, name))
+
+
+def name(index):
+    """ A made up word of a few syllables, different for every index. """
+
+    syllables = []
+    while True:
+        index, syllable = divmod(index, len(SYLLABLES))
+        syllables.append(SYLLABLES[syllable])
+        if index == 0:
+            return "".join(syllables).capitalize()
+        index -= 1
+
+
+def tag_name(rank):
+    """ The name of the rank-th most used tag, tag-0 is the most used one. """
+    return "tag-%d" % rank
+
+
+def artist_mbid(rank):
+    """ The MBID of the rank-th artist, artist 0 has the most recordings. """
+    return mbid("artist-%d" % rank)
+
+
+def recording_mbid(index):
+    return mbid("recording-%d" % index)
+
+
+def unresolved_mbid(index):
+    return mbid("unresolved-%d" % index)
+
+
+def skewed(rand, n, skew=3):
+    """ Pick a number below n, low numbers much more often than high ones. """
+    return int(n * rand.random() ** skew)
+
+
+def build_collection(db_file, num_recordings, seed=1):
+    """
+        Create the content tables in db_file and fill them with num_recordings recordings on releases of 6 to 14
+        tracks. Most recordings get a few tags with a count of how often they were applied, in the
+        recording_tag.count column of troi's multiple-subsonic-sources schema. Half of the unresolved recordings
+        were synced since they were looked up.
+    """
+
+    num_artists = max(100, num_recordings // 40)
+    num_tags = max(200, num_recordings // 100)
+    num_unresolved = max(100, num_recordings // 50)
+
+    setup_content_db(db_file)
+    content_db.connect()
+    content_db.create_tables((Recording, RecordingMetadata, Tag, RecordingTag, UnresolvedRecording))
+    content_db.close()
+
+    rand = random.Random(seed)
+    conn = sqlite3.connect(db_file)
+    conn.execute("PRAGMA journal_mode = WAL")
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(recording_tag)")]
+    if "count" not in columns:
+        conn.execute("ALTER TABLE recording_tag ADD COLUMN count INTEGER NOT NULL DEFAULT 1")
+    conn.executemany("INSERT INTO tag (id, name) VALUES (?, ?)", ((i + 1, tag_name(i)) for i in range(num_tags)))
+
+    def recordings():
+        index = 0
+        while index < num_recordings:
+            artist = skewed(rand, num_artists)
+            release = index
+            for track in range(rand.randint(6, 14)):
+                if index == num_recordings:
+                    return
+                yield (index + 1, "song-%d" % index, "%s %s" % (name(artist), name(artist + 7)), name(release),
+                       "%s %s" % (name(index), name(index * 31 + track)), artist_mbid(artist), mbid("release-%d" % release),
+                       recording_mbid(index), rand.randint(120, 420) * 1000, track + 1)
+                index += 1
+
+    def recording_tags():
+        for index in range(num_recordings):
+            for tag in {skewed(rand, num_tags) for i in range(rand.randint(0, 5))}:
+                yield index + 1, tag + 1, int(rand.paretovariate(1) * 3)
+
+    insert(conn, """INSERT INTO recording (id, file_id, file_id_type, mtime, artist_name, release_name,
+                                           recording_name, artist_mbid, release_mbid, recording_mbid, duration,
+                                           track_num, disc_num)
+                    VALUES (?, ?, 1, 0, ?, ?, ?, ?, ?, ?, ?, ?, 1)""", recordings())
+    insert(conn, "INSERT INTO recording_metadata (recording_id, popularity, last_updated) VALUES (?, ?, 0)",
+           ((index + 1, rand.random()) for index in range(num_recordings)))
+    insert(conn, """INSERT INTO recording_tag (recording_id, tag_id, count, last_updated, entity)
+                    VALUES (?, ?, ?, 0, 'recording')""", recording_tags())
+    insert(conn, "INSERT INTO unresolved_recording (recording_mbid, lookup_count, last_updated) VALUES (?, ?, 0)",
+           ((recording_mbid(rand.randrange(num_recordings)) if i % 2 else unresolved_mbid(i), rand.randint(1, 10))
+            for i in range(num_unresolved)), ignore=True)
+    conn.execute("ANALYZE")
+    conn.close()
+
+    return SyntheticCollection(db_file, num_recordings, num_artists, num_tags, num_unresolved)
+
+
+def insert(conn, query, rows, ignore=False):
+    if ignore:
+        query = query.replace("INSERT", "INSERT OR IGNORE", 1)
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == INSERT_CHUNK:
+            conn.executemany(query, chunk)
+            conn.commit()
+            chunk = []
+    conn.executemany(query, chunk)
+    conn.commit()
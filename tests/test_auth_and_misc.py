@@ -142,3 +142,74 @@ class TestCORSAndSecurity:
         assert b'secret' not in response.data.lower()
         assert b'password' not in response.data.lower()
         assert response.status_code == 200
+
+
+class TestUserCache:
+    """Test cases for the cached users of flask-login."""
+
+    def user_queries(self, call):
+        from lb_local.model.database import user_db
+
+        statements = []
+        conn = user_db.connection()
+        conn.set_trace_callback(statements.append)
+        try:
+            result = call()
+        finally:
+            conn.set_trace_callback(None)
+        return result, [s for s in statements if 'FROM "user"' in s]
+
+    def test_roles_are_sets(self, client):
+        config = client.application.config
+        assert config['ADMIN_USERS'] == frozenset(['adminuser'])
+        assert config['SERVICE_USERS'] == frozenset(['testuser', 'adminuser'])
+
+    def test_logged_in_user_is_not_read_again(self, authenticated_client):
+        from lb_local.login import load_user
+
+        user, statements = self.user_queries(lambda: load_user("test-login-id"))
+        assert user.name == "testuser"
+        user, statements = self.user_queries(lambda: load_user("test-login-id"))
+        assert user.name == "testuser"
+        assert statements == []
+
+    def test_expired_user_is_read_again(self, authenticated_client):
+        from lb_local.login import load_user
+
+        load_user("test-login-id")
+        with patch('lb_local.login.monotonic', return_value=10 ** 9):
+            user, statements = self.user_queries(lambda: load_user("test-login-id"))
+        assert user.name == "testuser"
+        assert len(statements) == 1
+
+    def test_users_are_not_cached_without_ttl(self, authenticated_client):
+        from lb_local.login import load_user, user_cache
+
+        user_cache.configure(0)
+        load_user("test-login-id")
+        user, statements = self.user_queries(lambda: load_user("test-login-id"))
+        assert len(statements) == 1
+
+    def test_deleted_user_is_dropped(self, admin_client):
+        from lb_local.login import user_cache
+        from lb_local.model.user import User
+
+        user = User.create(name="cache-victim")
+        assert user_cache.get(user.login_id).name == "cache-victim"
+
+        response = admin_client.post('/admin/user/delete/', data={'id': user.user_id})
+        assert response.status_code == 302
+        assert user_cache.get(user.login_id) is None
+
+    def test_edited_user_is_read_again(self, admin_client):
+        from lb_local.login import user_cache
+        from lb_local.model.user import User
+
+        user = User.create(name="cache-edit")
+        try:
+            assert user_cache.get(user.login_id).name == "cache-edit"
+            response = admin_client.post('/admin/user/edit/?id=%d' % user.user_id, data={'name': 'cache-edited'})
+            assert response.status_code == 302
+            assert user_cache.get(user.login_id).name == "cache-edited"
+        finally:
+            User.delete().where(User.user_id == user.user_id).execute()
@@ -0,0 +1,42 @@
+import json
+
+import pytest
+
+from tests import benchmark
+from tests.synthetic_collection import SyntheticCollection
+
+
+class TestBenchmark:
+
+    def test_percentile(self):
+        timings = [i / 100 for i in range(1, 101)]
+        assert benchmark.percentile(timings, 50) == .5
+        assert benchmark.percentile(timings, 99) == .99
+        assert benchmark.percentile([.1], 90) == .1
+
+    @pytest.mark.slow
+    def test_benchmark_writes_json(self, tmp_path, monkeypatch):
+        for key, value in benchmark.BENCHMARK_ENV.items():
+            monkeypatch.setenv(key, value)
+        monkeypatch.setenv("DATABASE_FILE", str(tmp_path / "lb-local.db"))
+        output = tmp_path / "benchmark.json"
+        benchmark.main(["--sizes", "2000", "--warmup", "1", "--requests", "3", "--workdir", str(tmp_path),
+                        "--output", str(output)])
+
+        results = json.loads(output.read_text())
+        assert results["requests"] == 3
+        collection, = results["collections"]
+        assert collection["recordings"] == 2000
+        synthetic = SyntheticCollection(None, 2000, 0, 0, 0)
+        endpoints = benchmark.endpoints(synthetic)
+        assert set(collection["endpoints"]) == {name for name, method, path, data in endpoints}
+        for name, stats in collection["endpoints"].items():
+            assert stats["requests"] == 3
+            assert stats["p50_ms"] <= stats["p90_ms"] <= stats["p99_ms"]
+        # The views that only read the collection don't depend on the troi version or the network
+        for name in ("top-tags", "tag", "tag-next-page", "unresolved"):
+            assert collection["endpoints"][name]["errors"] == 0
+        assert set(collection["queries"]) == {name for name, query in benchmark.queries(synthetic)}
+        for name, stats in collection["queries"].items():
+            assert stats["requests"] == 3
+            assert stats["p50_ms"] <= stats["p90_ms"] <= stats["p99_ms"]
@@ -1,7 +1,11 @@
 import pytest
 from unittest.mock import Mock, patch
 from lb_local.model.credential import Credential
+from lb_local.model.database import user_db
 from lb_local.model.service import Service
+from lb_local.model.user import User
+from lb_local.view.credential import load_credentials, invalidate_credentials, player_config, cors_origin, \
+    credential_cache
 
 
 class TestCredentialViews:
@@ -89,12 +93,10 @@ class TestCredentialViews:
 class TestCredentialAPI:
     """Test cases for credential-related functionality."""
 
-    @patch('lb_local.view.credential.load_credentials')
-    def test_load_credentials_mock(self, mock_load_credentials, authenticated_client):
-        """Test that credential loading works properly."""
-        mock_load_credentials.return_value = ({}, None)
-
-        # Create a service and credential to delete (which will trigger load_credentials)
+    @patch('lb_local.view.credential.invalidate_credentials')
+    def test_load_credentials_mock(self, mock_invalidate_credentials, authenticated_client):
+        """Test that deleting a credential drops the cached credential configs."""
+        # Create a service and credential to delete (which will trigger invalidate_credentials)
         service, created = Service.get_or_create(
             url='http://test-load-cred.com',
             defaults={
@@ -111,10 +113,10 @@ class TestCredentialAPI:
             owner_id=1
         )
 
-        # Delete the credential - this will trigger load_credentials
+        # Delete the credential - this will trigger invalidate_credentials
         response = authenticated_client.get(f'/credential/{credential.id}/delete')
         assert response.status_code == 302
-        mock_load_credentials.assert_called()
+        mock_invalidate_credentials.assert_called()
 
     def test_credential_add_post_with_auth(self, authenticated_client):
         """Test credential creation with authentication."""
@@ -127,3 +129,90 @@ class TestCredentialAPI:
         })
         # Should redirect on success or show form again if validation fails
         assert response.status_code in [200, 302]
+
+
+class TestCredentialCache:
+    """Test cases for the cached credential configs."""
+
+    @pytest.fixture
+    def credentials(self, authenticated_client):
+        user = User.get(User.name == "testuser")
+        other, created = User.get_or_create(name="cache-other")
+        services = [Service.create(owner=user, slug="cache-%d" % i, url="http://cache-%d.example:4533" % i)
+                    for i in range(3)]
+        credentials = [Credential.create(owner=user, service=services[0], user_name="mine", password="pw",
+                                         shared=False),
+                       Credential.create(owner=other, service=services[1], user_name="theirs", password="pw",
+                                         shared=True),
+                       Credential.create(owner=other, service=services[2], user_name="private", password="pw",
+                                         shared=False)]
+        yield user, other, credentials
+        for credential in credentials:
+            credential.delete_instance()
+        for service in services:
+            service.delete_instance()
+        other.delete_instance()
+
+    def queries(self, call):
+        statements = []
+        conn = user_db.connection()
+        conn.set_trace_callback(statements.append)
+        try:
+            result = call()
+        finally:
+            conn.set_trace_callback(None)
+        return result, [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+
+    def test_config_is_loaded_with_one_query(self, credentials):
+        user, other, creds = credentials
+        invalidate_credentials()
+
+        (config, msg), statements = self.queries(lambda: load_credentials(user.user_id))
+        servers = config["SUBSONIC_SERVERS"]
+        assert {"cache-0", "cache-1"} <= set(servers)
+        assert "cache-2" not in servers
+        assert servers["cache-1"]["owner_id"] == other.user_id
+        assert servers["cache-0"]["port"] == 4533
+        # The generation of the cache and the credentials with their services
+        assert len(statements) == 2
+
+        (config, msg), statements = self.queries(lambda: load_credentials(user.user_id))
+        assert {"cache-0", "cache-1"} <= set(config["SUBSONIC_SERVERS"])
+        assert len(statements) == 1
+
+    def test_changed_credentials_are_reloaded(self, authenticated_client, credentials):
+        user, other, creds = credentials
+        load_credentials(user.user_id)
+        response = authenticated_client.post('/credential/add', data={'id': creds[0].id,
+                                                                       'service': creds[0].service.id,
+                                                                       'user_name': 'renamed'})
+        assert response.status_code == 302
+
+        config, msg = load_credentials(user.user_id)
+        assert config["SUBSONIC_SERVERS"]["cache-0"]["username"] == "renamed"
+
+    def test_deleted_services_are_dropped(self, admin_client, credentials):
+        user, other, creds = credentials
+        load_credentials(user.user_id)
+        creds[1].delete_instance()
+        response = admin_client.get('/service/cache-1/delete')
+        assert response.status_code == 302
+
+        config, msg = load_credentials(user.user_id)
+        assert "cache-1" not in config["SUBSONIC_SERVERS"]
+
+    def test_tokens_are_minted_for_the_player_only(self, credentials):
+        user, other, creds = credentials
+        config, msg = load_credentials(user.user_id)
+        assert "token" not in config["SUBSONIC_SERVERS"]["cache-0"]
+
+        first = player_config(config["SUBSONIC_SERVERS"])["cache-0"]
+        second = player_config(config["SUBSONIC_SERVERS"])["cache-0"]
+        assert first["salt"] != second["salt"]
+        assert first["token"] != second["token"]
+        assert "token" not in credential_cache.get(user.user_id)["cache-0"]
+
+    def test_cors_origin(self):
+        assert cors_origin({"one": {"host": "http://one.example"}}) == "http://one.example"
+        assert cors_origin({"one": {"host": "http://one.example"}, "two": {"host": "http://two.example"}}) == "*"
+        assert cors_origin({}) == "*"
@@ -0,0 +1,133 @@
+from contextlib import contextmanager
+from threading import Thread
+from time import monotonic
+
+import peewee
+import pytest
+from troi.content_resolver.model.database import db as content_db
+from troi.content_resolver.model.tag import Tag
+from troi.content_resolver.subsonic import Database
+
+from lb_local.database import RECORDING_KEY_INDEX, add_file_source
+from lb_local.model.database import ContentConnectionPool
+import lb_local.model.database
+
+
+@pytest.fixture
+def pool(tmp_path):
+    db_file = str(tmp_path / "content.db")
+    Database(db_file, quiet=True).create()
+    content_db.close()
+
+    pool = ContentConnectionPool(content_db)
+    pool.init(db_file)
+    return pool
+
+
+class TestContentConnectionPool:
+
+    def test_connections_are_reused(self, pool):
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            assert second is first
+
+    def test_troi_queries_use_the_lent_connection(self, pool):
+        with pool.connection() as conn:
+            assert content_db.connection() is conn
+            assert content_db.execute_sql("SELECT count(*) FROM tag").fetchone() == (0,)
+        assert content_db.is_closed()
+
+    def test_read_only_connection_does_not_write(self, pool):
+        with pool.connection():
+            with pytest.raises(peewee.OperationalError):
+                Tag.create(name="rock")
+
+        with pool.connection(read_only=False):
+            Tag.create(name="rock")
+        with pool.connection():
+            assert Tag.select().count() == 1
+
+    def test_connection_is_passed_between_threads(self, pool):
+        lent = []
+
+        def query():
+            with pool.connection() as conn:
+                lent.append(conn)
+                content_db.execute_sql("SELECT count(*) FROM recording").fetchone()
+
+        for i in range(2):
+            thread = Thread(target=query)
+            thread.start()
+            thread.join()
+        assert len(lent) == 2 and lent[0] is lent[1]
+
+    def test_idle_connections_are_capped(self, pool):
+        pool.max_idle = 1
+        with pool.connection() as first, pool.connection() as second:
+            assert first is not second
+        assert len(pool.idle) == 1
+
+    @pytest.mark.slow
+    def test_top_tags_throughput_benchmark(self, authenticated_client, mock_credentials, monkeypatch):
+        """ Compare /top-tags with pooled connections to reopening the database for every request. """
+
+        db_file = authenticated_client.application.config["DATABASE_FILE"]
+
+        @contextmanager
+        def reopen(read_only=True):
+            db = Database(db_file, quiet=True)
+            db.open()
+            yield content_db.connection()
+
+        def requests_per_second(seconds=1):
+            requests = 0
+            start = monotonic()
+            while monotonic() - start < seconds:
+                assert authenticated_client.get("/top-tags").status_code == 200
+                requests += 1
+            return requests / (monotonic() - start)
+
+        with monkeypatch.context() as m:
+            m.setattr(lb_local.model.database.content_pool, "connection", reopen)
+            before = requests_per_second()
+        after = requests_per_second()
+
+        print("\n/top-tags: %.0f requests/s reopening the database, %.0f requests/s pooled" % (before, after))
+        assert after > before
+
+
+class TestFileSource:
+
+    def add_legacy_recordings(self, pool, services):
+        with pool.connection(read_only=False) as conn:
+            conn.execute("CREATE TABLE service (id INTEGER PRIMARY KEY, slug TEXT)")
+            conn.execute("CREATE TABLE subsonic_album (id INTEGER PRIMARY KEY, service_id INTEGER, song_ids TEXT)")
+            for i, slug in enumerate(services):
+                conn.execute("INSERT INTO service VALUES (?, ?)", (i + 1, slug))
+            conn.execute("""INSERT INTO subsonic_album VALUES (1, 1, '["listed"]')""")
+            for file_id in ("listed", "unlisted"):
+                conn.execute("INSERT INTO recording (file_id, file_id_type, mtime) VALUES (?, 1, 0)", (file_id,))
+
+    def sources(self, pool):
+        with pool.connection() as conn:
+            return dict(conn.execute("SELECT file_id, file_source FROM recording"))
+
+    def test_recordings_are_given_the_service_that_lists_them(self, pool):
+        self.add_legacy_recordings(pool, ["first", "second"])
+        with pool.connection(read_only=False) as conn:
+            add_file_source(conn)
+        # Recordings of no known service are dropped, their service adds them again when it syncs
+        assert self.sources(pool) == {"listed": "first"}
+
+    def test_recordings_are_given_the_only_service(self, pool):
+        self.add_legacy_recordings(pool, ["only"])
+        with pool.connection(read_only=False) as conn:
+            add_file_source(conn)
+            conn.execute(RECORDING_KEY_INDEX)
+            # Another service may have a song with the same id
+            conn.execute("INSERT INTO recording (file_id, file_id_type, mtime, file_source) "
+                         "VALUES ('listed', 1, 0, 'other')")
+        with pool.connection() as conn:
+            rows = set(conn.execute("SELECT file_id, file_source FROM recording"))
+        assert rows == {("listed", "only"), ("unlisted", "only"), ("listed", "other")}
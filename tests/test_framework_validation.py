@@ -70,6 +70,7 @@ class TestEndpointStructure:
             ('/service/<slug>/sync', 'GET'),
             ('/service/<slug>/sync/start', 'POST'),
             ('/service/<slug>/sync/start/metadata-only', 'POST'),
+            ('/service/<slug>/sync/start/incremental', 'POST'),
             ('/service/<slug>/sync/log', 'GET'),
             ('/service/<slug>/sync/full-log', 'GET'),
             
@@ -1,6 +1,43 @@
+import re
+import sqlite3
+
 import pytest
 from unittest.mock import Mock, patch
 
+from lb_local.database import create_content_indexes
+from lb_local.model.database import content_pool
+from lb_local.model.top_tag import TopTag
+
+
+@pytest.fixture
+def tagged_collection(client, tmp_path):
+    """Point the content views at a collection of 250 recordings tagged rock, with the tag counts of troi's
+    multiple-subsonic-sources schema."""
+    db_file = str(tmp_path / "content.db")
+    conn = sqlite3.connect(db_file)
+    conn.executescript("""
+        CREATE TABLE recording (id INTEGER PRIMARY KEY, artist_name TEXT, release_name TEXT, recording_name TEXT,
+                                artist_mbid TEXT, release_mbid TEXT, recording_mbid TEXT);
+        CREATE TABLE tag (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+        CREATE TABLE recording_tag (id INTEGER PRIMARY KEY, recording_id INTEGER, tag_id INTEGER, count INTEGER,
+                                    entity TEXT);
+        INSERT INTO tag (id, name) VALUES (1, 'rock');
+    """)
+    for i in range(250):
+        conn.execute("INSERT INTO recording VALUES (?, 'Artist', 'Release', ?, 'artist-mbid', 'release-mbid', ?)",
+                     (i + 1, "Recording %d" % i, "recording-mbid-%d" % i))
+        # Several recordings share each count, so the pages have to break ties on the recording id
+        conn.execute("INSERT INTO recording_tag (recording_id, tag_id, count, entity) VALUES (?, 1, ?, 'recording')",
+                     (i + 1, 5 + i // 10))
+    conn.commit()
+    conn.close()
+
+    original = content_pool.db_file
+    content_pool.init(db_file)
+    create_content_indexes()
+    yield
+    content_pool.init(original)
+
 
 class TestIndexViews:
     """Test cases for index view endpoints."""
@@ -73,29 +110,14 @@ class TestIndexViews:
         response = client.post('/weekly-jams', data={'user': 'test'})
         assert response.status_code == 302
 
-    @patch('lb_local.view.index.PeriodicJamsLocal')
-    @patch('lb_local.view.index.SubsonicDatabase')
-    def test_weekly_jams_post_valid(self, mock_db, mock_periodic_jams, authenticated_client, mock_credentials):
+    def test_weekly_jams_post_valid(self, authenticated_client, mock_credentials):
         """Test valid Weekly Jams POST request."""
-        # Mock periodic jams response
-        mock_periodic_instance = Mock()
-        mock_playlist = Mock()
-        mock_playlist.playlists = [Mock()]
-        mock_playlist.playlists[0].recordings = []
-        mock_playlist.playlists[0].name = "Weekly Jams"
-        mock_playlist.playlists[0].description = "Weekly playlist"
-        mock_playlist.get_jspf.return_value = {"playlist": {"track": []}}
-        mock_periodic_instance.generate.return_value = mock_playlist
-        mock_periodic_instance.patch.user_feedback.return_value = ["Test hint"]
-        mock_periodic_jams.return_value = mock_periodic_instance
-        
-        # Mock database
-        mock_db_instance = Mock()
-        mock_db_instance.metadata_sanity_check.return_value = ["No issues found"]
-        mock_db.return_value = mock_db_instance
-        
-        response = authenticated_client.post('/weekly-jams', data={'user_name': 'test'})
+        sync_client = Mock()
+        sync_client.refresh_weekly_jams.return_value = True
+        with patch('lb_local.view.index.get_sync_client', return_value=sync_client):
+            response = authenticated_client.post('/weekly-jams', data={'user_name': 'test'})
         assert response.status_code == 200
+        sync_client.refresh_weekly_jams.assert_called_once_with('test')
 
     def test_playlist_create_requires_authentication(self, client):
         """Test that playlist creation requires authentication."""
@@ -118,6 +140,17 @@ class TestIndexViews:
         response = authenticated_client.get('/top-tags')
         assert response.status_code == 200
 
+    def test_top_tags_are_read_from_the_counted_tags(self, authenticated_client, mock_credentials):
+        """Test that top tags shows the tags counted by the last sync."""
+        TopTag.rebuild([{"tag": "rock", "count": 12345}, {"tag": "jazz", "count": 10}])
+        try:
+            response = authenticated_client.get('/top-tags')
+        finally:
+            TopTag.rebuild([])
+        assert response.status_code == 200
+        assert b"12,345 tags" in response.data
+        assert response.data.index(b"rock") < response.data.index(b"jazz")
+
     def test_tag_page_requires_authentication(self, client):
         """Test that tag page requires authentication."""
         response = client.get('/tag/rock')
@@ -133,6 +166,34 @@ class TestIndexViews:
         response = authenticated_client.get('/tag/rock')
         assert response.status_code == 200
 
+    def test_tag_page_scrolls_through_all_recordings(self, authenticated_client, mock_credentials, tagged_collection):
+        """Test that the tag page shows a page of recordings and fetches the next ones as they are scrolled to."""
+        response = authenticated_client.get('/tag/rock')
+        assert response.status_code == 200
+        assert b"<h2>Tag <em>rock</em></h2>" in response.data
+
+        seen = []
+        pages = 0
+        page = response.data.decode("utf-8")
+        while True:
+            pages += 1
+            seen.extend(int(n) for n in re.findall(r"Recording (\d+)<", page))
+            next_page = re.search(r'hx-get="([^"]+)"', page)
+            if next_page is None:
+                break
+            response = authenticated_client.get(next_page.group(1).replace("&amp;", "&"))
+            assert response.status_code == 200
+            page = response.data.decode("utf-8")
+            assert "<h2>" not in page
+
+        assert pages == 3
+        assert seen == list(range(249, -1, -1))
+
+    def test_tag_page_rejects_bad_cursor(self, authenticated_client, mock_credentials):
+        """Test that the tag page cursor must be numeric."""
+        response = authenticated_client.get('/tag/rock?count=a&recording_id=1')
+        assert response.status_code == 400
+
     def test_unresolved_requires_authentication(self, client):
         """Test that unresolved page requires authentication."""
         response = client.get('/unresolved')
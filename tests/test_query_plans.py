@@ -0,0 +1,139 @@
+"""
+    Run the queries of the content views against a large synthetic collection and check that SQLite answers
+    them from the expected indexes. A schema or query change that makes one of them scan a large table fails
+    here. How long the queries take is measured by tests/benchmark.py.
+"""
+from contextlib import contextmanager
+
+import pytest
+from troi.content_resolver.model.unresolved_recording import UnresolvedRecording
+from troi.content_resolver.artist_search import LocalRecordingSearchByArtistService
+from troi.content_resolver.tag_search import LocalRecordingSearchByTagService
+from troi.content_resolver.top_tags import TopTags
+from troi.content_resolver.unresolved_recording import UnresolvedRecordingTracker
+
+from lb_local.database import create_content_indexes
+from lb_local.model.database import content_pool, user_db, setup_db
+from lb_local.model.top_tag import TopTag
+from lb_local.view.index import load_tag_page
+from tests.synthetic_collection import build_collection, artist_mbid, tag_name
+
+NUM_RECORDINGS = 100000
+
+# The tables that grow with the collection. Scanning any of them on a page view is a regression.
+LARGE_TABLES = ("recording", "recording_tag", "recording_metadata", "tag", "unresolved_recording")
+
+
+@pytest.fixture(scope="module")
+def collection(tmp_path_factory):
+    db_file = str(tmp_path_factory.mktemp("query-plans") / "lb-local.db")
+    collection = build_collection(db_file, NUM_RECORDINGS)
+
+    setup_db(db_file)
+    user_db.connect()
+    user_db.create_tables((TopTag,))
+    original = content_pool.db_file
+    content_pool.init(db_file)
+    create_content_indexes()
+    yield collection
+
+    content_pool.init(original)
+    user_db.close()
+
+
+@contextmanager
+def traced(read_only=True):
+    """ Lend a pooled connection and collect the statements run on it. """
+
+    statements = []
+    with content_pool.connection(read_only) as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            yield conn, statements
+        finally:
+            conn.set_trace_callback(None)
+
+
+def query_plan(conn, statement):
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + statement)]
+
+
+def assert_indexed(conn, statements, expected=(), allowed=()):
+    """ Check that the queries use the expected indexes and scan no large table, other than the ones allowed. """
+
+    queries = [s for s in statements if s.lstrip().upper().startswith(("SELECT", "WITH", "DELETE", "UPDATE"))]
+    assert queries, "no queries were run"
+    plans = []
+    for statement in queries:
+        plan = query_plan(conn, statement)
+        for step in plan:
+            if not step.startswith("SCAN "):
+                continue
+            table = step.split()[1]
+            assert table not in LARGE_TABLES or table in allowed, \
+                "query scans %s:\n%s\n%s" % (table, statement, "\n".join(plan))
+        plans.extend(plan)
+
+    used = {step.split(" INDEX ")[1].split()[0] for step in plans if " INDEX " in step}
+    assert set(expected) <= used, "indexes not used: %s\n%s" % (", ".join(set(expected) - used), "\n".join(plans))
+
+
+class TestQueryPlans:
+
+    def test_tag_page(self, collection):
+        with traced() as (conn, statements):
+            first = load_tag_page(conn, tag_name(0))
+            deep = load_tag_page(conn, tag_name(0), (10, NUM_RECORDINGS // 2))
+            assert len(first) == len(deep) == 100
+            assert_indexed(conn, statements, expected=("tag_name",))
+            # The pages are read in the order of the index, without sorting all recordings with the tag
+            for statement in statements:
+                plan = query_plan(conn, statement)
+                assert any("recording_tag_tag_id_count_recording_id" in step for step in plan)
+                assert "USE TEMP B-TREE FOR ORDER BY" not in plan
+
+    def test_top_tags_page(self, collection):
+        # Counting the tags scans the collection, so it is done once per sync instead of on every page view
+        with content_pool.connection():
+            top_tags = TopTags().get_top_tags(250)
+        TopTag.rebuild(top_tags)
+
+        statements = []
+        conn = user_db.connection()
+        conn.set_trace_callback(statements.append)
+        try:
+            assert TopTag.get_top_tags() == top_tags
+        finally:
+            conn.set_trace_callback(None)
+        # top_tag holds only the tags the page shows, reading it in order is all the page does
+        assert TopTag.select().count() == 250
+        # peewee names the top_tag table t1
+        assert query_plan(conn, statements[-1]) == ["SCAN t1"]
+
+    def test_lb_radio_tag_search(self, collection):
+        search = LocalRecordingSearchByTagService()
+        for operator in ("or", "and"):
+            with traced() as (conn, statements):
+                assert search.search([tag_name(2), tag_name(3)], operator, 0, 100, 50)
+                # The recordings are found through the tags, the scans are of the matches of the search
+                assert_indexed(conn, statements, expected=("tag_name", "recording_tag_tag_id_count_recording_id",
+                                                           "recordingmetadata_recording_id"))
+
+    def test_lb_radio_artist_search(self, collection, monkeypatch):
+        # Artists with about 2% of the collection between them, the most popular ones have a lot more
+        similar = [{"artist_mbid": artist_mbid(i), "score": 100 - i} for i in range(50, 60)]
+        monkeypatch.setattr(LocalRecordingSearchByArtistService, "get_similar_artists", lambda self, mbid: similar)
+        search = LocalRecordingSearchByArtistService()
+        with traced() as (conn, statements):
+            assert search.search("easy", similar[0]["artist_mbid"], 0, 100, 20, 10)
+            assert_indexed(conn, statements, expected=("recording_artist_mbid", "recordingmetadata_recording_id"))
+
+    def test_unresolved_cleanup(self, collection):
+        # Listing the unresolved recordings removes the ones that were synced since, going over all of them
+        with traced(read_only=False) as (conn, statements):
+            UnresolvedRecordingTracker().cleanup()
+            # The synced recordings are looked up by their MBID rather than going over the collection
+            assert_indexed(conn, statements, allowed=("unresolved_recording",),
+                           expected=("unresolvedrecording_recording_mbid", "recording_recording_mbid"))
+        with content_pool.connection():
+            assert UnresolvedRecording.select().count() == collection.num_unresolved // 2
@@ -0,0 +1,294 @@
+import multiprocessing
+from threading import Event, Lock
+from time import monotonic, sleep
+from unittest.mock import Mock, patch
+
+import pytest
+
+from troi.content_resolver.artist_search import LocalRecordingSearchByArtistService
+from troi.content_resolver.tag_search import LocalRecordingSearchByTagService
+
+from lb_local.radio import RadioWorker, RadioRequest, RadioResult, CandidateCache, \
+    CachedRecordingSearchByTagService, CachedRecordingSearchByArtistService
+import lb_local.radio
+from lb_local.model.user import User
+from lb_local.sync import SyncClient, SyncManager, SyncWorker
+from tests.test_sync import AUTHKEY, wait_for_socket, fake_sync_service, make_submit_message, wait_for_completion
+
+
+def fake_generate(self, request):
+    return RadioResult(True, request.user_id, request.mode, request.prompt, name="LB Radio for %s" % request.prompt,
+                       recordings=[], hints=[], jspf={"playlist": {"track": []}})
+
+
+def wait_for_result(get_result, job_id, timeout=5):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        result = get_result(job_id)
+        if result is not None and result.complete:
+            return result
+        sleep(.005)
+    raise AssertionError("playlist was not generated in time")
+
+
+@pytest.fixture
+def worker():
+    worker = RadioWorker("test.db", num_workers=2, max_pending=4)
+    yield worker
+    worker.shutdown()
+
+
+class TestRadioWorker:
+
+    def test_playlist_is_generated_in_the_background(self, worker, monkeypatch):
+        monkeypatch.setattr(RadioWorker, "generate", fake_generate)
+        job_id = worker.submit(RadioRequest(1, "easy", "artist:(U2)"))
+        result = wait_for_result(worker.result, job_id)
+        assert result.name == "LB Radio for artist:(U2)"
+        assert (result.user_id, result.mode, result.prompt) == (1, "easy", "artist:(U2)")
+
+    def test_unknown_job_has_no_result(self, worker):
+        assert worker.result("nonexistent") is None
+
+    def test_generations_are_capped(self, worker, monkeypatch):
+        lock = Lock()
+        running = [0, 0]
+
+        def generate(self, request):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            sleep(.05)
+            with lock:
+                running[0] -= 1
+            return fake_generate(self, request)
+
+        monkeypatch.setattr(RadioWorker, "generate", generate)
+        job_ids = [worker.submit(RadioRequest(1, "easy", "prompt %d" % i)) for i in range(4)]
+        for job_id in job_ids:
+            wait_for_result(worker.result, job_id)
+        assert running[1] == 2
+
+    def test_requests_beyond_the_pending_limit_are_refused(self, worker, monkeypatch):
+        release = Event()
+        monkeypatch.setattr(RadioWorker, "generate", lambda self, request: release.wait() and
+                            fake_generate(self, request))
+
+        job_ids = [worker.submit(RadioRequest(1, "easy", "prompt %d" % i)) for i in range(4)]
+        assert all(job_ids)
+        assert worker.submit(RadioRequest(1, "easy", "one too many")) is None
+
+        release.set()
+        for job_id in job_ids:
+            wait_for_result(worker.result, job_id)
+        assert worker.submit(RadioRequest(1, "easy", "room again")) is not None
+
+    def test_failed_generation_completes_with_an_error(self, worker, monkeypatch):
+        def generate(self, request):
+            raise SystemExit(-1)
+
+        monkeypatch.setattr(RadioWorker, "generate", generate)
+        result = wait_for_result(worker.result, worker.submit(RadioRequest(1, "easy", "#punk")))
+        assert result.errors
+
+    def test_results_expire(self, worker, monkeypatch):
+        monkeypatch.setattr(RadioWorker, "generate", fake_generate)
+        job_id = worker.submit(RadioRequest(1, "easy", "#punk"))
+        wait_for_result(worker.result, job_id)
+
+        monkeypatch.setattr(lb_local.radio, "RADIO_RESULT_TTL", 0)
+        worker.submit(RadioRequest(1, "easy", "#jazz"))
+        assert worker.result(job_id) is None
+
+
+class TestCandidateCache:
+
+    @pytest.fixture
+    def tag_searches(self, monkeypatch):
+        searches = []
+
+        def search(self, tags, operator, pop_begin, pop_end, num_recordings):
+            searches.append(tags)
+            return [{"recording_mbid": "mbid-%d" % len(searches), "tags": tags}]
+
+        monkeypatch.setattr(LocalRecordingSearchByTagService, "search", search)
+        return searches
+
+    def test_searches_are_answered_from_the_cache(self, tag_searches):
+        cache = CandidateCache()
+        search = CachedRecordingSearchByTagService(cache, cache.pool("#punk", "easy"))
+        first = search.search(["punk"], "or", 0, 100, 50)
+        assert search.search(["punk"], "or", 0, 100, 50) == first
+        # Another part of the prompt is another search
+        search.search(["punk"], "or", 50, 100, 50)
+
+        assert len(tag_searches) == 2
+        assert cache.stats() == {"hits": 1, "misses": 2, "entries": 1, "generation": 0}
+
+    def test_cached_candidates_are_copies(self, tag_searches):
+        cache = CandidateCache()
+        search = CachedRecordingSearchByTagService(cache, cache.pool("#punk", "easy"))
+        search.search(["punk"], "or", 0, 100, 50)[0]["recording_mbid"] = "changed"
+        assert search.search(["punk"], "or", 0, 100, 50)[0]["recording_mbid"] == "mbid-1"
+
+    def test_prompts_and_modes_have_their_own_pools(self, tag_searches):
+        cache = CandidateCache()
+        for prompt, mode in (("#punk", "easy"), ("#punk", "hard"), ("#rock", "easy")):
+            CachedRecordingSearchByTagService(cache, cache.pool(prompt, mode)).search(["punk"], "or", 0, 100, 50)
+        assert len(tag_searches) == 3
+        assert cache.pool("#punk", "hard") is cache.pool("#punk", "hard")
+
+    def test_similar_artists_are_cached_with_the_artist_search(self, monkeypatch):
+        lookups = []
+
+        def get_similar_artists(self, artist_mbid):
+            lookups.append(artist_mbid)
+            return []
+
+        monkeypatch.setattr(LocalRecordingSearchByArtistService, "get_similar_artists", get_similar_artists)
+        cache = CandidateCache()
+        search = CachedRecordingSearchByArtistService(cache, cache.pool("artist:(U2)", "easy"))
+        for i in range(2):
+            search.search("easy", "a3cb23fc-acd3-4ce0-8f36-1e5aa6a18432", 0, 100, 20, 10)
+        assert len(lookups) == 1
+
+    def test_finished_sync_invalidates_the_cache(self, tag_searches):
+        cache = CandidateCache()
+        pool = cache.pool("#punk", "easy")
+        cache.invalidate()
+        assert cache.pool("#punk", "easy") is not pool
+
+        CachedRecordingSearchByTagService(cache, cache.pool("#punk", "easy")).search(["punk"], "or", 0, 100, 50)
+        assert cache.stats() == {"hits": 0, "misses": 1, "entries": 1, "generation": 1}
+
+    def test_least_recently_used_pools_are_evicted(self):
+        cache = CandidateCache(max_entries=2)
+        punk = cache.pool("#punk", "easy")
+        cache.pool("#rock", "easy")
+        assert cache.pool("#punk", "easy") is punk
+        cache.pool("#jazz", "easy")
+        assert cache.pool("#punk", "easy") is punk
+        assert cache.stats()["entries"] == 2
+        assert ("#rock", "easy", 0) not in cache.pools
+
+    def test_pools_expire(self):
+        cache = CandidateCache(ttl=0)
+        pool = cache.pool("#punk", "easy")
+        sleep(.01)
+        assert cache.pool("#punk", "easy") is not pool
+
+    def test_sync_worker_reports_finished_syncs(self, monkeypatch):
+        monkeypatch.setattr(SyncWorker, "sync_service", fake_sync_service)
+        cache = CandidateCache()
+        worker = SyncWorker(":memory:", on_sync_finished=cache.invalidate)
+        worker.start()
+        try:
+            worker.job_queue.put(make_submit_message("radio-test"))
+            wait_for_completion(worker, ["radio-test"])
+            deadline = monotonic() + 5
+            while cache.generation == 0 and monotonic() < deadline:
+                sleep(.005)
+            assert cache.generation == 1
+        finally:
+            worker.exit()
+            worker.join(5)
+
+
+class TestRadioThroughSyncManager:
+
+    def test_playlist_is_fetched_by_job_id(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(RadioWorker, "generate", fake_generate)
+        stop_event = multiprocessing.Event()
+        address = str(tmp_path / "sync.sock")
+        manager = SyncManager(address, AUTHKEY, stop_event, str(tmp_path / "sync.db"), radio_max_pending=1)
+        manager.start()
+        try:
+            wait_for_socket(address, manager.is_alive)
+            client = SyncClient(address, AUTHKEY)
+
+            job_id = client.submit_radio(RadioRequest(1, "easy", "#punk"))
+            assert job_id
+            result = wait_for_result(client.radio_result, job_id)
+            assert result.name == "LB Radio for #punk"
+            assert client.radio_result("nonexistent") is None
+            assert client.radio_stats() == {"hits": 0, "misses": 0, "entries": 0, "generation": 0, "pending": 0}
+        finally:
+            stop_event.set()
+            manager.join(5)
+        assert not manager.is_alive()
+
+
+class TestRadioViews:
+
+    @pytest.fixture
+    def user_id(self, authenticated_client):
+        return User.get(User.name == "testuser").user_id
+
+    @pytest.fixture
+    def sync_client(self):
+        sync_client = Mock()
+        with patch('lb_local.view.index.get_sync_client', return_value=sync_client):
+            yield sync_client
+
+    def test_post_returns_a_placeholder_that_polls(self, authenticated_client, sync_client):
+        sync_client.submit_radio.return_value = "1234-abcd"
+        response = authenticated_client.post('/lb-radio', data={'prompt': '#punk', 'mode': 'easy'})
+        assert response.status_code == 200
+        assert b'hx-get="/lb-radio/job/1234-abcd"' in response.data
+
+        request = sync_client.submit_radio.call_args[0][0]
+        assert (request.mode, request.prompt) == ("easy", "#punk")
+
+    def test_unfinished_job_polls_again(self, authenticated_client, sync_client, user_id):
+        sync_client.radio_result.return_value = RadioResult(False, user_id, "easy", "#punk")
+        response = authenticated_client.get('/lb-radio/job/1234-abcd')
+        assert b'hx-get="/lb-radio/job/1234-abcd"' in response.data
+
+    def test_generation_errors_are_shown(self, authenticated_client, sync_client, user_id):
+        sync_client.radio_result.return_value = RadioResult(True, user_id, "easy", "#punk", errors="No tag punk found")
+        response = authenticated_client.get('/lb-radio/job/1234-abcd')
+        assert b"No tag punk found" in response.data
+
+    def test_playlist_is_streamed_without_its_jspf(self, authenticated_client, sync_client, user_id, mock_credentials):
+        sync_client.radio_result.return_value = fake_generate(None, RadioRequest(user_id, "easy", "#punk"))
+        response = authenticated_client.get('/lb-radio/job/1234-abcd')
+        assert response.is_streamed
+        assert b"LB Radio for #punk" in response.data
+        assert b'data-url="/lb-radio/job/1234-abcd/jspf"' in response.data
+        assert b'"track"' not in response.data
+
+    def test_jspf_is_fetched_separately(self, authenticated_client, sync_client, user_id):
+        sync_client.radio_result.return_value = fake_generate(None, RadioRequest(user_id, "easy", "#punk"))
+        response = authenticated_client.get('/lb-radio/job/1234-abcd/jspf')
+        assert response.status_code == 200
+        assert response.data == b'{"playlist":{"track":[]}}'
+
+    def test_jspf_of_other_users_is_not_served(self, authenticated_client, sync_client, user_id):
+        sync_client.radio_result.return_value = fake_generate(None, RadioRequest(user_id + 1, "easy", "#punk"))
+        assert authenticated_client.get('/lb-radio/job/1234-abcd/jspf').status_code == 404
+
+    def test_jobs_of_other_users_are_not_shown(self, authenticated_client, sync_client, user_id):
+        sync_client.radio_result.return_value = fake_generate(None, RadioRequest(user_id + 1, "easy", "#punk"))
+        response = authenticated_client.get('/lb-radio/job/1234-abcd')
+        assert b"not available any more" in response.data
+        assert b"LB Radio for #punk" not in response.data
+
+    def test_busy_service_is_reported(self, authenticated_client, sync_client):
+        sync_client.submit_radio.return_value = False
+        response = authenticated_client.post('/lb-radio', data={'prompt': '#punk', 'mode': 'easy'})
+        assert b"Too many playlists" in response.data
+
+    def test_unreachable_service_is_reported(self, authenticated_client, sync_client):
+        sync_client.submit_radio.return_value = None
+        response = authenticated_client.post('/lb-radio', data={'prompt': '#punk', 'mode': 'easy'})
+        assert b"not running" in response.data
+
+    def test_stats_are_for_admins_only(self, authenticated_client, sync_client):
+        response = authenticated_client.get('/lb-radio/stats')
+        assert response.status_code == 403
+
+    def test_stats(self, admin_client, sync_client):
+        sync_client.radio_stats.return_value = {"hits": 3, "misses": 1, "entries": 1, "generation": 2, "pending": 0}
+        response = admin_client.get('/lb-radio/stats')
+        assert response.status_code == 200
+        assert response.get_json()["hits"] == 3
@@ -0,0 +1,305 @@
+import sqlite3
+from statistics import quantiles
+from threading import Event, Thread
+from time import monotonic
+
+import pytest
+from peewee import SQL
+from troi.content_resolver.model.database import db, setup_db as setup_content_db
+from troi.content_resolver.model.recording import Recording, RecordingMetadata
+from troi.content_resolver.model.tag import Tag, RecordingTag
+
+from lb_local.database import RECORDING_KEY_INDEX, add_file_source
+from lb_local.model.database import user_db, setup_db
+from lb_local.model.service import Service
+from lb_local.model.subsonic_album import SubsonicAlbum
+from lb_local.model.user import User
+from lb_local.scan import IncrementalScan, SubsonicClient
+from tests.fake_subsonic import FakeSubsonic, make_album
+
+
+@pytest.fixture
+def subsonic():
+    fake = FakeSubsonic([make_album(i) for i in range(5)])
+    fake.start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def service(tmp_path):
+    """ A service in a user database that shares its file with the content database, like in a deployment. """
+
+    db_file = str(tmp_path / "lb-local.db")
+    setup_db(db_file)
+    user_db.connect()
+    user_db.create_tables((User, Service, SubsonicAlbum))
+    setup_content_db(db_file)
+    db.connect()
+    db.create_tables((Recording, RecordingMetadata, Tag, RecordingTag))
+    # The scans key recordings on their file source, which lb-local adds to troi's recording table
+    add_file_source(db.connection())
+    db.execute_sql(RECORDING_KEY_INDEX)
+
+    user = User.create(name="testuser")
+    yield Service.create(owner=user, slug="scan-test", url="http://localhost:4533")
+
+    db.close()
+    user_db.close()
+
+
+def scan(service, subsonic, concurrency=4):
+    client = SubsonicClient(subsonic.url, "test", "test", concurrency)
+    try:
+        scan = IncrementalScan(service.id, client, concurrency)
+        scan.run()
+        return scan
+    finally:
+        client.close()
+
+
+class InProcessSubsonic:
+    """ A client that serves albums without a server, to time the database side of a scan. """
+
+    def __init__(self, albums):
+        self.library = {album["entry"]["id"]: album for album in albums}
+
+    def albums(self):
+        return [album["entry"] for album in self.library.values()]
+
+    def album(self, album_id):
+        album = self.library[album_id]
+        return dict(album["entry"], song=album["songs"])
+
+    def artist_mbid(self, artist_id):
+        return "mbid-" + artist_id
+
+
+def song_ids():
+    return {r.file_id for r in Recording.select()}
+
+
+class TestIncrementalScan:
+
+    def test_first_scan_adds_everything(self, service, subsonic):
+        result = scan(service, subsonic)
+        assert result.added == 5
+        assert len(subsonic.methods("getAlbum")) == 5
+        assert len(song_ids()) == 15
+        assert SubsonicAlbum.select().count() == 5
+
+        recording = Recording.get(Recording.file_id == "al-0-1")
+        assert recording.recording_name == "Song 1 of album 0"
+        assert recording.duration == 180000
+        assert recording.track_num == 2
+
+    def test_unchanged_collection_fetches_no_albums(self, service, subsonic):
+        scan(service, subsonic)
+        subsonic.calls.clear()
+
+        result = scan(service, subsonic)
+        assert subsonic.methods("getAlbum") == []
+        assert (result.added, result.changed, result.deleted) == (0, 0, 0)
+        assert len(song_ids()) == 15
+
+    def test_only_changed_album_is_fetched(self, service, subsonic):
+        scan(service, subsonic)
+        subsonic.calls.clear()
+
+        album = subsonic.albums["al-2"]
+        album["entry"]["name"] = "Album 2 (Remastered)"
+        album["entry"]["songCount"] = 2
+        album["songs"] = album["songs"][:2]
+        for song in album["songs"]:
+            song["album"] = "Album 2 (Remastered)"
+
+        result = scan(service, subsonic)
+        assert [params["id"] for params in subsonic.methods("getAlbum")] == ["al-2"]
+        assert result.changed == 1
+        assert "al-2-2" not in song_ids()
+        assert Recording.get(Recording.file_id == "al-2-0").release_name == "Album 2 (Remastered)"
+
+    def test_deleted_album_is_removed(self, service, subsonic):
+        scan(service, subsonic)
+        recording = Recording.get(Recording.file_id == "al-4-0")
+        tag = Tag.create(name="rock")
+        RecordingTag.create(recording=recording, tag=tag, entity="recording")
+        del subsonic.albums["al-4"]
+        subsonic.calls.clear()
+
+        result = scan(service, subsonic)
+        assert subsonic.methods("getAlbum") == []
+        assert result.deleted == 1
+        assert not any(file_id.startswith("al-4-") for file_id in song_ids())
+        assert RecordingTag.select().count() == 0
+        assert SubsonicAlbum.select().where(SubsonicAlbum.album_id == "al-4").count() == 0
+
+    def test_new_album_is_added(self, service, subsonic):
+        scan(service, subsonic)
+        subsonic.albums["al-9"] = make_album(9)
+        subsonic.calls.clear()
+
+        result = scan(service, subsonic)
+        assert [params["id"] for params in subsonic.methods("getAlbum")] == ["al-9"]
+        assert result.added == 1
+        assert len(song_ids()) == 18
+
+    def test_concurrent_fetches_are_written_in_album_list_order(self, service, subsonic):
+        subsonic.albums.update({album["entry"]["id"]: album for album in (make_album(i) for i in range(5, 50))})
+        subsonic.latency = .002
+
+        scan(service, subsonic, concurrency=8)
+        album_ids = [a.album_id for a in SubsonicAlbum.select().order_by(SubsonicAlbum.id)]
+        assert album_ids == list(subsonic.albums)
+        file_ids = [r.file_id for r in Recording.select().order_by(Recording.id)]
+        assert file_ids == [song["id"] for album in subsonic.albums.values() for song in album["songs"]]
+
+    def test_small_batches_and_checkpoints(self, service, subsonic):
+        client = SubsonicClient(subsonic.url, "test", "test")
+        IncrementalScan(service.id, client, batch_size=1, checkpoint_batches=1).run()
+        assert len(song_ids()) == 15
+        assert SubsonicAlbum.select().count() == 5
+
+        del subsonic.albums["al-1"]
+        del subsonic.albums["al-3"]
+        scan = IncrementalScan(service.id, client, batch_size=1, checkpoint_batches=1)
+        scan.run()
+        client.close()
+        assert scan.deleted == 2
+        assert len(song_ids()) == 9
+        assert db.execute_sql("PRAGMA wal_autocheckpoint").fetchone()[0] == 1000
+
+    def test_album_that_cannot_be_fetched_is_skipped(self, service, subsonic):
+        subsonic.failing.add("al-2")
+
+        result = scan(service, subsonic)
+        assert (result.added, result.errors) == (4, 1)
+        assert len(song_ids()) == 12
+        assert SubsonicAlbum.select().where(SubsonicAlbum.album_id == "al-2").count() == 0
+
+        # The next scan tries the album again
+        subsonic.failing.clear()
+        subsonic.calls.clear()
+        result = scan(service, subsonic)
+        assert [params["id"] for params in subsonic.methods("getAlbum")] == ["al-2"]
+        assert result.added == 1
+        assert len(song_ids()) == 15
+
+    def test_services_with_the_same_song_ids_keep_their_own_recordings(self, service, subsonic):
+        other = Service.create(owner=service.owner, slug="scan-test-other", url="http://localhost:4534")
+        scan(service, subsonic)
+        scan(other, subsonic)
+        assert Recording.select().count() == 30
+
+        del subsonic.albums["al-4"]
+        scan(service, subsonic)
+        sources = Recording.select(SQL('"file_source"')).where(Recording.file_id == "al-4-0").tuples()
+        assert [source for source, in sources] == ["scan-test-other"]
+        assert Recording.select().count() == 27
+
+    def test_interrupted_incremental_scan_fetches_only_the_rest(self, service, subsonic):
+        client = SubsonicClient(subsonic.url, "test", "test")
+
+        def interrupt(album_id):
+            if album_id == "al-1":
+                raise KeyboardInterrupt
+        with pytest.raises(KeyboardInterrupt):
+            IncrementalScan(service.id, client, concurrency=1, batch_size=1, on_progress=interrupt).run()
+        subsonic.calls.clear()
+
+        IncrementalScan(service.id, client, concurrency=1, batch_size=1).run()
+        client.close()
+        assert [params["id"] for params in subsonic.methods("getAlbum")] == ["al-2", "al-3", "al-4"]
+        assert len(song_ids()) == 15
+
+    def test_full_scan_fetches_every_album(self, service, subsonic):
+        scan(service, subsonic)
+        subsonic.calls.clear()
+
+        client = SubsonicClient(subsonic.url, "test", "test")
+        result = IncrementalScan(service.id, client, full=True)
+        result.run()
+        client.close()
+        assert len(subsonic.methods("getAlbum")) == 5
+        assert result.changed == 5
+
+    def test_interrupted_full_scan_is_resumed(self, service, subsonic):
+        scan(service, subsonic)
+        subsonic.calls.clear()
+        client = SubsonicClient(subsonic.url, "test", "test")
+
+        progress = []
+        def interrupt(album_id):
+            progress.append(album_id)
+            if album_id == "al-1":
+                raise KeyboardInterrupt
+        with pytest.raises(KeyboardInterrupt):
+            IncrementalScan(service.id, client, concurrency=1, batch_size=1, full=True, on_progress=interrupt).run()
+        # An album that changed after the interrupted scan wrote it is fetched again all the same
+        subsonic.albums["al-0"]["entry"]["name"] = "Album 0 (Remastered)"
+        subsonic.calls.clear()
+
+        IncrementalScan(service.id, client, concurrency=1, batch_size=1, full=True, resume_after=progress[-1]).run()
+        client.close()
+        assert [params["id"] for params in subsonic.methods("getAlbum")] == ["al-0", "al-2", "al-3", "al-4"]
+        assert len(song_ids()) == 15
+
+    @pytest.mark.slow
+    def test_concurrent_scan_throughput_benchmark(self, service):
+        """ Scan a server with some network latency serially and with a pool of connections. """
+
+        albums = [make_album(i) for i in range(100)]
+        timings = {}
+        for concurrency in (1, 8):
+            subsonic = FakeSubsonic(albums, latency=.01)
+            subsonic.start()
+            try:
+                SubsonicAlbum.delete().execute()
+                start = monotonic()
+                scan(service, subsonic, concurrency)
+                timings[concurrency] = monotonic() - start
+            finally:
+                subsonic.stop()
+            assert SubsonicAlbum.select().count() == len(albums)
+
+        print("\nscan of %d albums: serial %.0f albums/s, %d connections %.0f albums/s" %
+              (len(albums), len(albums) / timings[1], 8, len(albums) / timings[8]))
+        assert timings[8] < timings[1] / 3
+
+    @pytest.mark.slow
+    def test_ingestion_benchmark(self, service, tmp_path):
+        """ Time writing a collection in small and large transactions while a web worker queries the database. """
+
+        albums = [make_album(i, songs=10) for i in range(2000)]
+        rows = sum(len(album["songs"]) for album in albums)
+        results = {}
+        for batch_size in (10, 1000):
+            Recording.delete().execute()
+            SubsonicAlbum.delete().execute()
+
+            latencies = []
+            stop = Event()
+
+            def read():
+                conn = sqlite3.connect(str(tmp_path / "lb-local.db"))
+                while not stop.is_set():
+                    start = monotonic()
+                    conn.execute("SELECT recording_name FROM recording WHERE artist_mbid = ? "
+                                 "ORDER BY recording_name LIMIT 50", ("mbid-ar-%d" % (len(latencies) % 10),)).fetchall()
+                    latencies.append(monotonic() - start)
+                conn.close()
+
+            reader = Thread(target=read)
+            reader.start()
+            start = monotonic()
+            IncrementalScan(service.id, InProcessSubsonic(albums), concurrency=1, batch_size=batch_size).run()
+            elapsed = monotonic() - start
+            stop.set()
+            reader.join()
+
+            assert Recording.select().count() == rows
+            results[batch_size] = (rows / elapsed, quantiles(latencies, n=100)[98] * 1000)
+
+        for batch_size, (rate, p99) in results.items():
+            print("\nbatch size %4d: %6.0f rows/s, p99 read latency %.2fms" % (batch_size, rate, p99))
+        assert results[1000][0] > results[10][0]
@@ -103,6 +103,11 @@ class TestServiceViews:
         response = client.post('/service/test-service/sync/start/metadata-only')
         assert response.status_code == 302
 
+    def test_service_sync_start_incremental_requires_authentication(self, client):
+        """Test that incremental sync start requires authentication."""
+        response = client.post('/service/test-service/sync/start/incremental')
+        assert response.status_code == 302
+
     def test_service_sync_log_requires_authentication(self, client):
         """Test that sync log requires authentication."""
         response = client.get('/service/test-service/sync/log')
@@ -167,3 +172,202 @@ class TestServiceAPI:
         
         # Clean up
         service.delete_instance()
+
+
+class TestListQueries:
+    """The service and credential lists query a constant number of times, however many rows they show."""
+
+    @pytest.fixture
+    def add_rows(self, admin_client):
+        from lb_local.model.credential import Credential
+        from lb_local.model.user import User
+
+        owners = [User.get_or_create(name="list-owner-%d" % i)[0] for i in range(3)]
+        added = []
+
+        def add_rows(count):
+            start = len(added)
+            for i in range(start, start + count):
+                service = Service.create(owner=owners[i % 3], slug="list-%d" % i, url="http://list-%d.example" % i,
+                                         last_synched=1700000000 + i, scan_log="x" * 1000)
+                Credential.create(owner=owners[i % 3], service=service, user_name="user-%d" % i, password="pw",
+                                  shared=False)
+                added.append(service)
+
+        yield add_rows
+        Credential.delete().where(Credential.service.in_([s.id for s in added])).execute()
+        Service.delete().where(Service.id.in_([s.id for s in added])).execute()
+        for owner in owners:
+            owner.delete_instance()
+
+    def queries(self, client, path):
+        from lb_local.model.database import user_db
+
+        statements = []
+        conn = user_db.connection()
+        conn.set_trace_callback(statements.append)
+        try:
+            response = client.get(path)
+        finally:
+            conn.set_trace_callback(None)
+        assert response.status_code == 200
+        return response, len(statements)
+
+    @pytest.mark.parametrize("path, row", [("/service/list", b"list-%d"), ("/credential/list", b"user-%d")])
+    def test_query_count_does_not_grow_with_the_rows(self, admin_client, add_rows, path, row):
+        add_rows(5)
+        # Logging in and the user's session are read by the first request
+        admin_client.get(path)
+        response, few = self.queries(admin_client, path)
+        assert row % 4 in response.data
+
+        add_rows(300)
+        response, many = self.queries(admin_client, path)
+        assert row % 304 in response.data
+        assert many == few
+
+    def test_sync_age_is_rendered_by_the_page(self, admin_client, add_rows):
+        add_rows(1)
+        response = admin_client.get("/service/list")
+        assert b'<time data-timestamp="1700000000"></time>' in response.data
+
+
+class TestSyncEvents:
+    """The sync page is updated by a stream of server-sent events."""
+
+    @pytest.fixture
+    def service(self, authenticated_client):
+        import uuid
+        from lb_local.model.user import User
+
+        slug = "events-%s" % uuid.uuid4().hex[:8]
+        service = Service.create(owner=User.get(User.name == "testuser"), slug=slug, url="http://%s.example" % slug)
+        yield service
+        service.delete_instance()
+
+    @pytest.fixture
+    def sync_client(self, authenticated_client, monkeypatch):
+        import lb_local.view.service
+        from lb_local.sync import SyncClient, SyncLog
+
+        monkeypatch.setattr(lb_local.view.service, "SYNC_EVENTS_POLL_INTERVAL", .01)
+        client = SyncClient(None, None, authenticated_client.application.config["STATUS_BOARD"])
+        client.log = SyncLog()
+        client.log.job_id = "job-1"
+        client.call = lambda req: client.log.chunk(req.chunk) if req.job_id in (None, "job-1") else None
+        with patch('lb_local.view.service.get_sync_client', return_value=client):
+            yield client
+
+    def publish(self, client, slug, complete, log_offset, stats=None):
+        client.status_board.publish(slug, {"complete": complete, "error_msg": "", "stats": stats,
+                                           "log_offset": log_offset})
+
+    def events(self, response):
+        assert response.status_code == 200
+        assert response.mimetype == "text/event-stream"
+        events = []
+        for block in response.get_data(as_text=True).split("\n\n"):
+            lines = block.split("\n")
+            if lines[0].startswith("event: "):
+                data = "\n".join(line[len("data: "):] for line in lines[1:] if line.startswith("data: "))
+                events.append((lines[0][len("event: "):], data))
+        return events
+
+    def test_events_require_authentication(self, client):
+        assert client.get('/service/some-service/sync/events').status_code == 302
+
+    def test_unknown_service_is_not_found(self, authenticated_client):
+        assert authenticated_client.get('/service/no-such-service/sync/events').status_code == 404
+
+    def test_service_that_never_synced_is_idle(self, authenticated_client, sync_client, service):
+        events = self.events(authenticated_client.get('/service/%s/sync/events' % service.slug))
+        assert [name for name, data in events] == ["status", "complete"]
+        assert "( idle )" in events[0][1]
+
+    def test_finished_sync_is_shown_without_its_log(self, authenticated_client, sync_client, service):
+        sync_client.log.append("scanned")
+        self.publish(sync_client, service.slug, True, 1, [["Tracks", 12]])
+
+        events = self.events(authenticated_client.get('/service/%s/sync/events' % service.slug))
+        assert [name for name, data in events] == ["status", "complete"]
+        assert "Tracks" in events[0][1] and "12" in events[0][1]
+
+    def test_running_sync_streams_stats_and_log(self, authenticated_client, sync_client, service):
+        from threading import Thread
+        from time import sleep
+
+        sync_client.log.append("first <line>")
+        self.publish(sync_client, service.slug, False, 1, [["Progress", 10]])
+
+        def finish():
+            sleep(.1)
+            sync_client.log.append("last line")
+            self.publish(sync_client, service.slug, True, 2, [["Progress", 100]])
+
+        thread = Thread(target=finish)
+        thread.start()
+        events = self.events(authenticated_client.get('/service/%s/sync/events' % service.slug))
+        thread.join()
+
+        assert [name for name, data in events] == ["status", "log", "status", "log", "complete"]
+        assert 'aria-valuenow="10"' in events[0][1]
+        assert events[1][1] == "first &lt;line&gt;\n"
+        assert 'aria-valuenow="100"' in events[2][1]
+        assert events[3][1] == "last line\n"
+
+    def test_started_sync_skips_the_previous_status(self, authenticated_client, sync_client, service):
+        from threading import Thread
+        from time import sleep
+
+        self.publish(sync_client, service.slug, True, 0, [["Tracks", 1]])
+        after = sync_client.status_board.sequence(service.slug)
+
+        def run_sync():
+            sleep(.1)
+            sync_client.log.append("new sync")
+            self.publish(sync_client, service.slug, True, 1, [["Tracks", 2]])
+
+        thread = Thread(target=run_sync)
+        thread.start()
+        events = self.events(authenticated_client.get('/service/%s/sync/events?after=%d' % (service.slug, after)))
+        thread.join()
+
+        assert [name for name, data in events] == ["status", "log", "complete"]
+        assert '<td style="width: 70%">2</td>' in events[0][1]
+        assert events[1][1] == "new sync\n"
+
+    def test_unreadable_status_is_no_news(self, authenticated_client, sync_client, service):
+        self.publish(sync_client, service.slug, True, 0, [["Tracks", 12]])
+        sync_status = sync_client.sync_status
+        # The first read of the slot gives up, as it does while the daemon keeps writing to it
+        reads = []
+        sync_client.sync_status = lambda slug: sync_status(slug) if reads or reads.append(slug) else None
+
+        events = self.events(authenticated_client.get('/service/%s/sync/events' % service.slug))
+        assert [name for name, data in events] == ["status", "complete"]
+        assert "Tracks" in events[0][1]
+
+    def test_stream_ends_in_time_and_goes_on_after_the_last_event(self, authenticated_client, sync_client,
+                                                                   service, monkeypatch):
+        import lb_local.view.service
+
+        monkeypatch.setattr(lb_local.view.service, "SYNC_EVENTS_MAX_AGE", .05)
+        sync_client.log.append("first line")
+        self.publish(sync_client, service.slug, False, 1, [["Progress", 10]])
+        response = authenticated_client.get('/service/%s/sync/events' % service.slug)
+        assert [name for name, data in self.events(response)] == ["status", "log"]
+        last_event_id = [line[len("id: "):] for line in response.get_data(as_text=True).split("\n")
+                         if line.startswith("id: ")][-1]
+
+        sync_client.log.append("second line")
+        self.publish(sync_client, service.slug, True, 2, [["Progress", 100]])
+        response = authenticated_client.get('/service/%s/sync/events' % service.slug,
+                                            headers={"Last-Event-ID": last_event_id})
+        events = self.events(response)
+        assert [name for name, data in events] == ["status", "log", "complete"]
+        assert events[1][1] == "second line\n"
+
+    def test_sync_page_connects_to_the_events(self, authenticated_client, sync_client, service):
+        response = authenticated_client.get('/service/%s/sync' % service.slug)
+        assert response.status_code == 200
+        assert b'sse-connect="/service/%s/sync/events"' % service.slug.encode() in response.data
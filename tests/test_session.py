@@ -0,0 +1,243 @@
+from time import time
+
+import pytest
+from flask import g, session
+from flask_login import current_user, login_required, login_user, logout_user
+
+from lb_local.model.database import user_db
+from lb_local.model.session import SessionRecord
+from lb_local.model.user import User
+from lb_local.session import ServerSideSessionInterface, session_cache
+
+
+@pytest.fixture
+def session_client(client):
+    app = client.application
+
+    @app.route("/session-test/set/<value>")
+    def session_set(value):
+        session["value"] = value
+        return "set"
+
+    @app.route("/session-test/get")
+    def session_get():
+        return session.get("value", "none")
+
+    @app.route("/session-test/clear")
+    def session_clear():
+        session.clear()
+        return "cleared"
+
+    @app.route("/session-test/unused")
+    def session_unused():
+        return "unused"
+
+    @app.route("/session-test/login")
+    def session_login():
+        user, created = User.get_or_create(name="testuser", defaults={"login_id": "test-login-id"})
+        login_user(user)
+        return "logged in"
+
+    @app.route("/session-test/private")
+    @login_required
+    def session_private():
+        return current_user.name
+
+    @app.route("/session-test/logout")
+    def session_logout():
+        logout_user()
+        return "logged out"
+
+    # No sweeping unless a test asks for it
+    app.session_interface.next_sweep = time() + 3600
+    yield client
+
+
+def session_cookie(client):
+    cookie = client.get_cookie("session")
+    return cookie.value if cookie is not None else None
+
+
+def session_queries(call, tables=('"session"',)):
+    statements = []
+    conn = user_db.connection()
+    conn.set_trace_callback(statements.append)
+    try:
+        result = call()
+    finally:
+        conn.set_trace_callback(None)
+    return result, [s for s in statements if any(table in s for table in tables)]
+
+
+def fresh_request(client, path):
+    # The test client keeps one app context across requests, so flask-login would reuse the user it loaded
+    g.pop("_login_user", None)
+    return client.get(path)
+
+
+def test_app_uses_server_side_sessions(client):
+    assert isinstance(client.application.session_interface, ServerSideSessionInterface)
+
+
+def test_cookie_only_carries_the_session_id(session_client):
+    session_client.get("/session-test/set/" + "x" * 1000)
+    sid = session_cookie(session_client)
+    assert sid is not None and len(sid) < 64
+    assert "x" * 10 not in sid
+    assert SessionRecord.get(SessionRecord.sid == sid).expires > time()
+
+
+def test_session_data_survives_requests(session_client):
+    session_client.get("/session-test/set/punk")
+    assert session_client.get("/session-test/get").data == b"punk"
+
+
+def test_unused_session_is_not_loaded(session_client):
+    session_client.get("/session-test/set/punk")
+    response, statements = session_queries(lambda: session_client.get("/session-test/unused"))
+    assert response.data == b"unused"
+    assert statements == []
+    assert "Cookie" not in response.vary
+
+
+def test_read_session_is_not_written(session_client):
+    session_client.get("/session-test/set/punk")
+    response, statements = session_queries(lambda: session_client.get("/session-test/get"))
+    assert response.data == b"punk"
+    assert len(statements) == 1 and statements[0].lstrip().upper().startswith("SELECT")
+    assert "Cookie" in response.vary
+
+
+def test_unknown_session_id_is_replaced(session_client):
+    session_client.set_cookie("session", "chosen-by-the-client")
+    assert session_client.get("/session-test/get").data == b"none"
+
+    session_client.get("/session-test/set/punk")
+    sid = session_cookie(session_client)
+    assert sid != "chosen-by-the-client"
+    assert SessionRecord.get_or_none(SessionRecord.sid == "chosen-by-the-client") is None
+
+
+def test_expired_session_is_not_used(session_client):
+    session_client.get("/session-test/set/punk")
+    sid = session_cookie(session_client)
+    SessionRecord.update(expires=int(time()) - 1).where(SessionRecord.sid == sid).execute()
+
+    assert session_client.get("/session-test/get").data == b"none"
+
+
+def test_expiry_is_renewed_after_half_the_lifetime(session_client):
+    session_client.get("/session-test/set/punk")
+    sid = session_cookie(session_client)
+    soon = int(time()) + 60
+    SessionRecord.update(expires=soon).where(SessionRecord.sid == sid).execute()
+
+    session_client.get("/session-test/get")
+    assert SessionRecord.get(SessionRecord.sid == sid).expires > soon
+
+
+def test_cleared_session_is_deleted(session_client):
+    session_client.get("/session-test/set/punk")
+    sid = session_cookie(session_client)
+
+    session_client.get("/session-test/clear")
+    assert SessionRecord.get_or_none(SessionRecord.sid == sid) is None
+    assert session_cookie(session_client) is None
+
+
+def test_expired_sessions_are_swept(session_client):
+    SessionRecord.create(sid="expired-session", data="{}", expires=int(time()) - 1)
+    session_client.application.session_interface.next_sweep = 0
+
+    session_client.get("/session-test/unused")
+    assert SessionRecord.get_or_none(SessionRecord.sid == "expired-session") is None
+
+
+def test_login_survives_requests(authenticated_client):
+    response = authenticated_client.get("/credential/list")
+    assert response.status_code == 200
+    assert authenticated_client.get("/credential/list").status_code == 200
+
+
+def test_login_moves_the_session_to_a_new_id(session_client):
+    session_client.get("/session-test/set/punk")
+    before = session_cookie(session_client)
+
+    session_client.get("/session-test/login")
+    after = session_cookie(session_client)
+    assert after != before
+    assert SessionRecord.get_or_none(SessionRecord.sid == before) is None
+    assert SessionRecord.get(SessionRecord.sid == after).login_id == "test-login-id"
+    # The data of the session moves along
+    assert session_client.get("/session-test/get").data == b"punk"
+
+
+def test_logout_moves_the_session_to_a_new_id(session_client):
+    session_client.get("/session-test/set/punk")
+    session_client.get("/session-test/login")
+    logged_in = session_cookie(session_client)
+
+    session_client.get("/session-test/logout")
+    assert SessionRecord.get_or_none(SessionRecord.sid == logged_in) is None
+    assert session_cookie(session_client) not in (None, logged_in)
+    assert session_client.get("/session-test/get").data == b"punk"
+
+
+def test_logout_of_an_empty_session_deletes_it(session_client):
+    session_client.get("/session-test/login")
+    logged_in = session_cookie(session_client)
+
+    session_client.get("/session-test/logout")
+    assert SessionRecord.get_or_none(SessionRecord.sid == logged_in) is None
+    assert session_cookie(session_client) is None
+
+
+def test_sessions_of_deleted_users_are_revoked(admin_client):
+    user = User.create(name="session-victim")
+    SessionRecord.create(sid="victim-session", data="{}", expires=int(time()) + 3600, login_id=user.login_id)
+
+    response = admin_client.post('/admin/user/delete/', data={'id': user.user_id})
+    assert response.status_code == 302
+    assert SessionRecord.get_or_none(SessionRecord.sid == "victim-session") is None
+    # Deleting a user leaves the admin logged in
+    assert admin_client.get('/admin/user/').status_code == 200
+
+
+def test_warm_request_does_not_read_the_database_for_auth(session_client):
+    session_client.get("/session-test/login")
+    fresh_request(session_client, "/session-test/private")
+
+    response, statements = session_queries(lambda: fresh_request(session_client, "/session-test/private"),
+                                           tables=('"session"', '"user"'))
+    assert response.data == b"testuser"
+    assert statements == []
+    assert "Cookie" in response.vary
+
+
+def test_other_session_keys_are_read_from_the_database(session_client):
+    session_client.get("/session-test/set/punk")
+    session_client.get("/session-test/login")
+
+    response, statements = session_queries(lambda: fresh_request(session_client, "/session-test/get"))
+    assert response.data == b"punk"
+    assert len(statements) == 1
+
+
+def test_logged_out_session_is_not_answered_from_the_cache(session_client):
+    session_client.get("/session-test/login")
+    logged_in = session_cookie(session_client)
+    session_client.get("/session-test/logout")
+    assert session_cache.get(logged_in) is None
+
+    # Replaying the logged in id doesn't authenticate
+    session_client.set_cookie("session", logged_in)
+    assert fresh_request(session_client, "/session-test/private").status_code != 200
+
+
+def test_session_cache_can_be_turned_off(session_client):
+    session_cache.configure(0)
+    session_client.get("/session-test/login")
+
+    response, statements = session_queries(lambda: fresh_request(session_client, "/session-test/private"))
+    assert response.data == b"testuser"
+    assert len(statements) == 1
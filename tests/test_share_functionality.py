@@ -6,9 +6,9 @@ import json
 class TestShareFunctionality:
     """Test cases for the share functionality added to LB Radio."""
 
-    @patch('lb_local.view.index.ListenBrainzRadioLocal')
-    @patch('lb_local.view.index.SubsonicDatabase')
-    def test_lb_radio_post_includes_share_parameters(self, mock_db, mock_radio, authenticated_client, mock_credentials):
+    @patch('lb_local.radio.CachedListenBrainzRadioLocal')
+    @patch('lb_local.radio.SubsonicDatabase')
+    def test_lb_radio_post_includes_share_parameters(self, mock_db, mock_radio, generate_lb_radio, mock_credentials):
         """Test that LB Radio POST response includes parameters for sharing."""
         # Mock database
         mock_db_instance = Mock()
@@ -44,7 +44,7 @@ class TestShareFunctionality:
         mock_radio.return_value = mock_radio_instance
         
         # Make a POST request with specific parameters
-        response = authenticated_client.post('/lb-radio', data={
+        response = generate_lb_radio({
             'prompt': 'Amy Winehouse',
             'mode': 'easy'
         })
@@ -56,9 +56,9 @@ class TestShareFunctionality:
         assert 'Amy%20Winehouse' in response_data  # prompt should be URL-encoded in template
         assert 'easy' in response_data  # mode should be in template
 
-    @patch('lb_local.view.index.ListenBrainzRadioLocal')
-    @patch('lb_local.view.index.SubsonicDatabase')
-    def test_lb_radio_post_with_special_characters_in_prompt(self, mock_db, mock_radio, authenticated_client, mock_credentials):
+    @patch('lb_local.radio.CachedListenBrainzRadioLocal')
+    @patch('lb_local.radio.SubsonicDatabase')
+    def test_lb_radio_post_with_special_characters_in_prompt(self, mock_db, mock_radio, generate_lb_radio, mock_credentials):
         """Test that special characters in prompts are handled correctly for sharing."""
         # Mock database
         mock_db_instance = Mock()
@@ -95,7 +95,7 @@ class TestShareFunctionality:
         
         # Test with prompt containing special characters
         special_prompt = 'tag:(hip hop, jazz)::or'
-        response = authenticated_client.post('/lb-radio', data={
+        response = generate_lb_radio({
             'prompt': special_prompt,
             'mode': 'medium'
         })
@@ -108,10 +108,10 @@ class TestShareFunctionality:
         assert 'tag%3A' in response_data  # 'tag:' URL-encoded
         assert 'medium' in response_data
 
-    def test_share_button_in_playlist_template(self, authenticated_client, mock_credentials, mock_troi):
+    def test_share_button_in_playlist_template(self, generate_lb_radio, mock_credentials, mock_troi):
         """Test that the share button is present in the playlist template."""
-        with patch('lb_local.view.index.SubsonicDatabase') as mock_db:
-            with patch('lb_local.view.index.ListenBrainzRadioLocal') as mock_radio:
+        with patch('lb_local.radio.SubsonicDatabase') as mock_db:
+            with patch('lb_local.radio.CachedListenBrainzRadioLocal') as mock_radio:
                 mock_db_instance = Mock()
                 mock_db_instance.metadata_sanity_check.return_value = []
                 mock_db.return_value = mock_db_instance
@@ -144,7 +144,7 @@ class TestShareFunctionality:
                 mock_radio_instance.patch.user_feedback.return_value = []
                 mock_radio.return_value = mock_radio_instance
                 
-                response = authenticated_client.post('/lb-radio', data={
+                response = generate_lb_radio({
                     'prompt': 'test prompt',
                     'mode': 'easy'
                 })
@@ -157,10 +157,10 @@ class TestShareFunctionality:
                 assert 'sharePlaylist()' in response_data
                 assert 'Share this playlist' in response_data
 
-    def test_share_javascript_function_present(self, authenticated_client, mock_credentials, mock_troi):
+    def test_share_javascript_function_present(self, generate_lb_radio, mock_credentials, mock_troi):
         """Test that the share JavaScript function is included in the response."""
-        with patch('lb_local.view.index.SubsonicDatabase') as mock_db:
-            with patch('lb_local.view.index.ListenBrainzRadioLocal') as mock_radio:
+        with patch('lb_local.radio.SubsonicDatabase') as mock_db:
+            with patch('lb_local.radio.CachedListenBrainzRadioLocal') as mock_radio:
                 mock_db_instance = Mock()
                 mock_db_instance.metadata_sanity_check.return_value = []
                 mock_db.return_value = mock_db_instance
@@ -193,7 +193,7 @@ class TestShareFunctionality:
                 mock_radio_instance.patch.user_feedback.return_value = []
                 mock_radio.return_value = mock_radio_instance
                 
-                response = authenticated_client.post('/lb-radio', data={
+                response = generate_lb_radio({
                     'prompt': 'test',
                     'mode': 'hard'
                 })
@@ -206,9 +206,9 @@ class TestShareFunctionality:
             assert 'navigator.clipboard' in response_data
             assert 'Share link copied to clipboard!' in response_data
 
-    @patch('lb_local.view.index.ListenBrainzRadioLocal')
-    @patch('lb_local.view.index.SubsonicDatabase')
-    def test_different_modes_in_share_functionality(self, mock_db, mock_radio, authenticated_client, mock_credentials, mock_troi):
+    @patch('lb_local.radio.CachedListenBrainzRadioLocal')
+    @patch('lb_local.radio.SubsonicDatabase')
+    def test_different_modes_in_share_functionality(self, mock_db, mock_radio, generate_lb_radio, mock_credentials, mock_troi):
         """Test that different modes are correctly handled in share functionality."""
         mock_db_instance = Mock()
         mock_db_instance.metadata_sanity_check.return_value = []
@@ -245,7 +245,7 @@ class TestShareFunctionality:
         modes = ['easy', 'medium', 'hard']
         
         for mode in modes:
-            response = authenticated_client.post('/lb-radio', data={
+            response = generate_lb_radio({
                 'prompt': 'test artist',
                 'mode': mode
             })
@@ -254,10 +254,10 @@ class TestShareFunctionality:
             response_data = response.data.decode('utf-8')
             assert mode in response_data
 
-    def test_share_url_construction_in_template(self, authenticated_client, mock_credentials, mock_troi):
+    def test_share_url_construction_in_template(self, generate_lb_radio, mock_credentials, mock_troi):
         """Test that the share URL construction logic is present in the template."""
-        with patch('lb_local.view.index.SubsonicDatabase') as mock_db:
-            with patch('lb_local.view.index.ListenBrainzRadioLocal') as mock_radio:
+        with patch('lb_local.radio.SubsonicDatabase') as mock_db:
+            with patch('lb_local.radio.CachedListenBrainzRadioLocal') as mock_radio:
                 mock_db_instance = Mock()
                 mock_db_instance.metadata_sanity_check.return_value = []
                 mock_db.return_value = mock_db_instance
@@ -290,7 +290,7 @@ class TestShareFunctionality:
                 mock_radio_instance.patch.user_feedback.return_value = []
                 mock_radio.return_value = mock_radio_instance
                 
-                response = authenticated_client.post('/lb-radio', data={
+                response = generate_lb_radio({
                     'prompt': 'artist:(test)',
                     'mode': 'easy'
                 })
@@ -304,10 +304,10 @@ class TestShareFunctionality:
             assert 'prompt=' in response_data
             assert 'mode=' in response_data
 
-    def test_share_error_handling_in_template(self, authenticated_client, mock_credentials, mock_troi):
+    def test_share_error_handling_in_template(self, generate_lb_radio, mock_credentials, mock_troi):
         """Test that share functionality includes error handling."""
-        with patch('lb_local.view.index.SubsonicDatabase') as mock_db:
-            with patch('lb_local.view.index.ListenBrainzRadioLocal') as mock_radio:
+        with patch('lb_local.radio.SubsonicDatabase') as mock_db:
+            with patch('lb_local.radio.CachedListenBrainzRadioLocal') as mock_radio:
                 mock_db_instance = Mock()
                 mock_db_instance.metadata_sanity_check.return_value = []
                 mock_db.return_value = mock_db_instance
@@ -340,7 +340,7 @@ class TestShareFunctionality:
                 mock_radio_instance.patch.user_feedback.return_value = []
                 mock_radio.return_value = mock_radio_instance
                 
-                response = authenticated_client.post('/lb-radio', data={
+                response = generate_lb_radio({
                     'prompt': 'test',
                     'mode': 'easy'
                 })
@@ -352,14 +352,14 @@ class TestShareFunctionality:
                 assert '.catch(' in response_data
                 assert 'showShareUrl' in response_data  # fallback function
 
-    @patch('lb_local.view.index.SubsonicDatabase')
-    def test_share_with_empty_prompt_handling(self, mock_db, authenticated_client, mock_credentials):
+    @patch('lb_local.radio.SubsonicDatabase')
+    def test_share_with_empty_prompt_handling(self, mock_db, generate_lb_radio, mock_credentials):
         """Test that share functionality handles edge cases properly."""
         mock_db_instance = Mock()
         mock_db.return_value = mock_db_instance
         
         # Mock troi to return empty playlist
-        with patch('lb_local.view.index.ListenBrainzRadioLocal') as mock_radio:
+        with patch('lb_local.radio.CachedListenBrainzRadioLocal') as mock_radio:
             mock_playlist = Mock()
             mock_playlist.playlists = [Mock()]
             mock_playlist.playlists[0].recordings = []
@@ -372,7 +372,7 @@ class TestShareFunctionality:
             mock_radio_instance.patch.user_feedback.return_value = ["No recordings found"]
             mock_radio.return_value = mock_radio_instance
             
-            response = authenticated_client.post('/lb-radio', data={
+            response = generate_lb_radio({
                 'prompt': '',  # Empty prompt
                 'mode': 'easy'
             })
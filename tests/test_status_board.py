@@ -0,0 +1,144 @@
+import multiprocessing
+from time import perf_counter
+
+import pytest
+
+from lb_local.status_board import StatusBoard, NUM_SLOTS, MAX_PAYLOAD, SEQ
+from lb_local.sync import SyncClient, SyncJob, SubmitMessage, StatusMessage
+
+
+@pytest.fixture
+def board(tmp_path):
+    board_file = str(tmp_path / "sync-status")
+    StatusBoard.create(board_file)
+    board = StatusBoard(board_file)
+    board.open()
+    yield board
+    board.close()
+
+
+def make_status(**kwargs):
+    status = {"complete": False, "error_msg": "", "stats": None, "log_offset": 0}
+    status.update(kwargs)
+    return status
+
+
+def publish_statuses(board_file, count):
+    board = StatusBoard(board_file)
+    board.open()
+    for i in range(count):
+        board.publish("service", make_status(log_offset=i))
+    board.publish("service", make_status(complete=True, log_offset=count))
+    board.close()
+
+
+class TestStatusBoard:
+    """Test cases for the shared sync status board."""
+
+    def test_unknown_slug(self, board):
+        assert board.read("nonexistent") is None
+
+    def test_publish_and_read(self, board):
+        status = make_status(stats=[["Progress", 50]], log_offset=10)
+        board.publish("service", status)
+        assert board.read("service") == status
+
+    def test_update_replaces_previous_status(self, board):
+        board.publish("service", make_status(log_offset=1))
+        board.publish("service", make_status(log_offset=2, complete=True))
+        assert board.read("service") == make_status(log_offset=2, complete=True)
+
+    def test_statuses_are_kept_per_slug(self, board):
+        board.publish("service-a", make_status(log_offset=1))
+        board.publish("service-b", make_status(log_offset=2))
+        assert board.read("service-a")["log_offset"] == 1
+        assert board.read("service-b")["log_offset"] == 2
+
+    def test_full_board_reuses_oldest_slot(self, board):
+        for i in range(NUM_SLOTS + 1):
+            board.publish("service-%d" % i, make_status(log_offset=i))
+        assert board.read("service-0") is None
+        assert board.read("service-1")["log_offset"] == 1
+        assert board.read("service-%d" % NUM_SLOTS)["log_offset"] == NUM_SLOTS
+
+    def test_full_board_reuses_least_recently_published_slot(self, board):
+        for i in range(NUM_SLOTS):
+            board.publish("service-%d" % i, make_status(log_offset=i))
+        board.publish("service-0", make_status(log_offset=-1))
+        board.publish("service-new", make_status(log_offset=NUM_SLOTS))
+        assert board.read("service-0")["log_offset"] == -1
+        assert board.read("service-1") is None
+        assert board.read("service-new")["log_offset"] == NUM_SLOTS
+
+    def test_read_gives_up_on_a_slot_that_stays_locked(self, board):
+        board.publish("service", make_status())
+        offset = board.find_slot(board.key("service"))
+        seq, = SEQ.unpack_from(board.mm, offset)
+        # A writer that died halfway through an update leaves the sequence number odd
+        SEQ.pack_into(board.mm, offset, seq + 1)
+        assert board.read("service") is None
+
+    def test_status_too_large(self, board):
+        with pytest.raises(ValueError):
+            board.publish("service", make_status(error_msg="x" * MAX_PAYLOAD))
+
+    def test_read_from_another_process(self, board):
+        process = multiprocessing.Process(target=publish_statuses, args=(board.board_file, 1000))
+        process.start()
+        while True:
+            status = board.read("service")
+            if status is not None and status["complete"]:
+                break
+        process.join()
+        assert status["log_offset"] == 1000
+
+    def test_job_publishes_to_board(self, board):
+        submit_msg = SubmitMessage(service={"slug": "service"}, credential={}, user_id=1, expire_at=0, type="full")
+        job = SyncJob(submit_msg, status_board=board)
+        job.publish()
+        assert board.read("service")["complete"] is False
+
+        job.add_log_message('json-[["Progress", 10]]')
+        assert board.read("service")["stats"] == [["Progress", 10]]
+
+        job.finish("E" * 10000)
+        status = board.read("service")
+        assert status["complete"] is True
+        assert 0 < len(status["error_msg"]) < MAX_PAYLOAD
+
+    def test_sequence_grows_with_each_status(self, board):
+        assert board.sequence("service") == 0
+        board.publish("service", make_status(log_offset=1))
+        first = board.sequence("service")
+        assert first > 0
+        board.publish("service", make_status(log_offset=2))
+        assert board.sequence("service") > first
+        assert board.sequence("nonexistent") == 0
+
+    def test_client_reads_from_board(self, board):
+        board.publish("service", make_status(log_offset=5))
+        client = SyncClient(None, None, board)
+        assert client.sync_status("service") == StatusMessage(complete=False, error_msg="", stats=None, log_offset=5)
+        assert client.sync_status("nonexistent") is None
+
+    @pytest.mark.slow
+    def test_read_latency_benchmark(self, board):
+        """Benchmark status reads of services that are and are not on a half full board."""
+        services = NUM_SLOTS // 2
+        for i in range(services):
+            board.publish("service-%d" % i, make_status(stats=[["Progress", i]], log_offset=i))
+
+        reads = 10000
+        t0 = perf_counter()
+        for i in range(reads):
+            assert board.read("service-%d" % (i % services)) is not None
+        per_hit = (perf_counter() - t0) / reads
+
+        t0 = perf_counter()
+        for i in range(reads):
+            assert board.read("missing-%d" % (i % services)) is None
+        per_miss = (perf_counter() - t0) / reads
+
+        print("\nstatus board read: hit %.1fus miss %.1fus" % (per_hit * 1000000, per_miss * 1000000))
+        assert per_hit < .0001
+        assert per_miss < .0001
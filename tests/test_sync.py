@@ -0,0 +1,834 @@
+import multiprocessing
+from multiprocessing.connection import Listener
+import os
+import random
+import signal
+import subprocess
+import sys
+from statistics import median
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+
+import pytest
+from playhouse.shortcuts import model_to_dict
+from troi.content_resolver.model.database import db as content_db, setup_db as setup_content_db
+from troi.content_resolver.model.recording import Recording, FileIdType
+from troi.content_resolver.model.tag import Tag, RecordingTag
+
+from lb_local.sync import SyncClient, SyncManager, SyncWorker, SyncJob, SyncLog, SubmitMessage, current_job, logger, \
+    LOG_CHUNK_LINES
+import lb_local.sync
+from lb_local.model.credential import Credential
+from lb_local.model.database import user_db, setup_db
+from lb_local.model.service import Service
+from lb_local.model.sync_job import SyncJobRecord
+from lb_local.model.top_tag import TopTag
+from lb_local.model.user import User
+from lb_local.status_board import StatusBoard
+
+AUTHKEY = b"test-secret-key"
+
+
+def fake_sync_service(self, submit_msg):
+    """ Stand-in for SyncWorker.sync_service that records when the job started and finishes at once. """
+    job = SyncJob(submit_msg)
+    job.stats = {"slug": submit_msg.service["slug"], "started_at": monotonic()}
+    for i in range(LOG_CHUNK_LINES + 10):
+        job.add_log_message("line %d" % i)
+    job.complete = True
+    with self.lock:
+        self.job_data[submit_msg.service["slug"]] = job
+
+
+def make_submit_message(slug):
+    return SubmitMessage(service={"slug": slug, "url": "http://localhost:4533"},
+                         credential={"user_name": "test", "password": "test"},
+                         user_id=1,
+                         expire_at=monotonic() + 60,
+                         type="full")
+
+
+def wait_for_completion(worker, slugs, timeout=5):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        statuses = [worker.current_status(slug) for slug in slugs]
+        if all(status is not None and status.complete for status in statuses):
+            return statuses
+        sleep(.005)
+    raise AssertionError("sync jobs did not complete in time")
+
+
+def iter_chunks(worker, slug):
+    index = 0
+    while True:
+        chunk = worker.log_chunk(slug, index)
+        if chunk is None:
+            return
+        yield chunk
+        index = chunk.next_chunk
+
+
+def wait_for_socket(address, is_running, timeout=10):
+    deadline = monotonic() + timeout
+    while not os.path.exists(address):
+        assert is_running()
+        assert monotonic() < deadline, "sync manager did not start listening"
+        sleep(.01)
+
+
+@pytest.fixture
+def sync_manager(monkeypatch, tmp_path):
+    """ Run a real SyncManager process whose worker uses fake_sync_service. """
+    monkeypatch.setattr(SyncWorker, "sync_service", fake_sync_service)
+
+    stop_event = multiprocessing.Event()
+    address = str(tmp_path / "sync.sock")
+    manager = SyncManager(address, AUTHKEY, stop_event, str(tmp_path / "sync.db"))
+    manager.start()
+    wait_for_socket(address, manager.is_alive)
+
+    yield SyncClient(address, AUTHKEY)
+
+    stop_event.set()
+    manager.join(5)
+    assert not manager.is_alive()
+
+
+class TestSyncWorker:
+    """Test cases for the SyncWorker thread."""
+
+    def test_worker_starts_job_without_polling_delay(self, monkeypatch):
+        monkeypatch.setattr(SyncWorker, "sync_service", fake_sync_service)
+        worker = SyncWorker(":memory:")
+        worker.start()
+        try:
+            submitted = monotonic()
+            worker.job_queue.put(make_submit_message("worker-test"))
+            while worker.current_status("worker-test") is None:
+                sleep(.001)
+            assert worker.job_data["worker-test"].stats["started_at"] - submitted < .1
+        finally:
+            worker.exit()
+            worker.join(5)
+        assert not worker.is_alive()
+
+    def test_worker_exits_while_idle(self):
+        worker = SyncWorker(":memory:")
+        worker.start()
+        worker.exit()
+        worker.join(5)
+        assert not worker.is_alive()
+
+    def test_different_services_sync_in_parallel(self, monkeypatch):
+        both_running = Event()
+        running = set()
+        lock = Lock()
+
+        def sync(self, submit_msg):
+            fake_sync_service(self, submit_msg)
+            with lock:
+                running.add(submit_msg.service["slug"])
+                if len(running) == 2:
+                    both_running.set()
+            assert both_running.wait(2)
+
+        monkeypatch.setattr(SyncWorker, "sync_service", sync)
+        worker = SyncWorker(":memory:", num_workers=2)
+        worker.start()
+        try:
+            worker.job_queue.put(make_submit_message("service-a"))
+            worker.job_queue.put(make_submit_message("service-b"))
+            assert both_running.wait(2)
+        finally:
+            worker.exit()
+            worker.join(5)
+
+    def test_jobs_for_one_service_never_overlap(self, monkeypatch):
+        active = []
+        overlaps = []
+        finished = []
+
+        def sync(self, submit_msg):
+            slug = submit_msg.service["slug"]
+            if slug in active:
+                overlaps.append(slug)
+            active.append(slug)
+            sleep(.02)
+            active.remove(slug)
+            finished.append(slug)
+
+        monkeypatch.setattr(SyncWorker, "sync_service", sync)
+        worker = SyncWorker(":memory:", num_workers=4)
+        worker.start()
+        try:
+            for i in range(3):
+                worker.job_queue.put(make_submit_message("service-a"))
+                worker.job_queue.put(make_submit_message("service-b"))
+            deadline = monotonic() + 5
+            while len(finished) < 6 and monotonic() < deadline:
+                sleep(.01)
+        finally:
+            worker.exit()
+            worker.join(5)
+
+        assert len(finished) == 6
+        assert overlaps == []
+
+    def test_exiting_job_does_not_block_the_service(self, monkeypatch):
+        opened = []
+
+        class ExitingDatabase:
+            def __init__(self, *args, **kwargs):
+                pass
+
+            def open(self):
+                # troi's Database.open calls sys.exit() when it cannot open the database
+                opened.append(True)
+                raise SystemExit(-1)
+
+        monkeypatch.setattr("lb_local.sync.SubsonicDatabase", ExitingDatabase)
+        worker = SyncWorker(":memory:", num_workers=1)
+        worker.start()
+        try:
+            worker.job_queue.put(make_submit_message("service-a"))
+            worker.job_queue.put(make_submit_message("service-a"))
+            deadline = monotonic() + 5
+            while (len(opened) < 2 or "service-a" in worker.slug_queues) and monotonic() < deadline:
+                sleep(.01)
+            status = worker.current_status("service-a")
+        finally:
+            worker.exit()
+            worker.join(5)
+
+        assert len(opened) == 2
+        assert "service-a" not in worker.slug_queues
+        assert status.complete
+        assert "SystemExit" in status.error_msg
+
+    def test_logs_and_stats_stay_with_their_job(self, monkeypatch):
+        both_logged = Event()
+        logged = []
+        lock = Lock()
+
+        def sync(self, submit_msg):
+            slug = submit_msg.service["slug"]
+            job = SyncJob(submit_msg)
+            with self.lock:
+                self.job_data[slug] = job
+            token = current_job.set(job)
+            for i in range(50):
+                logger.info("%s line %d" % (slug, i))
+            logger.info('json-{"slug": "%s"}' % slug)
+            current_job.reset(token)
+            with lock:
+                logged.append(slug)
+                if len(logged) == 2:
+                    both_logged.set()
+            both_logged.wait(2)
+            job.complete = True
+
+        # Records from outside a sync job must not end up in any job's log
+        logger.info("unrelated message")
+
+        monkeypatch.setattr(SyncWorker, "sync_service", sync)
+        worker = SyncWorker(":memory:", num_workers=2)
+        worker.start()
+        try:
+            worker.job_queue.put(make_submit_message("service-a"))
+            worker.job_queue.put(make_submit_message("service-b"))
+            statuses = wait_for_completion(worker, ["service-a", "service-b"])
+            job_logs = {slug: "".join(chunk.text for chunk in iter_chunks(worker, slug))
+                    for slug in ("service-a", "service-b")}
+        finally:
+            worker.exit()
+            worker.join(5)
+
+        for slug, other, status in (("service-a", "service-b", statuses[0]), ("service-b", "service-a", statuses[1])):
+            assert status.stats == {"slug": slug}
+            logs = job_logs[slug]
+            assert status.log_offset == 50
+            assert logs.count("%s line" % slug) == 50
+            assert other not in logs
+            assert "unrelated" not in logs
+
+    @pytest.mark.slow
+    def test_log_routing_throughput_benchmark(self):
+        """Benchmark log records routed per second while several jobs log at the same time."""
+        num_jobs = 8
+        num_lines = 5000
+        jobs = [SyncJob(make_submit_message("service-%d" % i)) for i in range(num_jobs)]
+
+        def log_lines(job):
+            current_job.set(job)
+            for i in range(num_lines):
+                logger.info("%d" % i)
+
+        threads = [Thread(target=log_lines, args=(job,)) for job in jobs]
+        t0 = monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = monotonic() - t0
+
+        rate = num_jobs * num_lines / duration
+        print("\nlog routing: %d lines/s across %d jobs" % (rate, num_jobs))
+        for job in jobs:
+            assert job.log.lines == num_lines
+        assert rate > 10000
+
+    def test_log_chunks_are_only_served_for_the_requested_job(self):
+        worker = SyncWorker(":memory:")
+        job = SyncJob(make_submit_message("service-a"))
+        job.add_log_message("line")
+        worker.job_data["service-a"] = job
+        assert worker.log_chunk("service-a", 0).job_id == job.id
+        assert worker.log_chunk("service-a", 0, job.id).text == "line\n"
+        assert worker.log_chunk("service-a", 0, "another job") is None
+
+    def test_unknown_slug_has_no_status(self):
+        worker = SyncWorker(":memory:")
+        assert worker.current_status("nonexistent") is None
+
+
+class FakeDatabase:
+    """ Stand-in for SubsonicDatabase, the scan writes to the content tables of the test. """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def open(self):
+        pass
+
+
+class FakeScan:
+    """ Stand-in for IncrementalScan that reports some stats instead of scanning a service. """
+
+    scanned = []
+    fail = False
+
+    def __init__(self, service_id, client, *args, full=False, resume_after=None, on_progress=None):
+        self.service_id = service_id
+        self.full = full
+        self.resume_after = resume_after
+        self.on_progress = on_progress
+
+    def run(self):
+        logger.info('json-{"albums": 10}')
+        FakeScan.scanned.append((self.service_id, self.full, self.resume_after))
+        if FakeScan.fail:
+            raise RuntimeError("cannot reach the service")
+
+
+class FakeLookup:
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def lookup(self, slug):
+        pass
+
+
+@pytest.fixture
+def history_db(tmp_path, monkeypatch):
+    """
+        A user database with one service to sync and stand-ins for the scan and the metadata lookup. The content
+        tables are in the same file, like in a deployment.
+    """
+
+    monkeypatch.setattr("lb_local.sync.SubsonicDatabase", FakeDatabase)
+    monkeypatch.setattr("lb_local.sync.IncrementalScan", FakeScan)
+    monkeypatch.setattr("lb_local.sync.MetadataLookup", FakeLookup)
+    monkeypatch.setattr(FakeScan, "scanned", [])
+    setup_db(str(tmp_path / "lb-local.db"))
+    user_db.connect()
+    user_db.create_tables((User, Service, Credential, SyncJobRecord, TopTag))
+    setup_content_db(str(tmp_path / "lb-local.db"))
+    content_db.create_tables((Recording, Tag, RecordingTag))
+
+    user = User.create(name="testuser")
+    service = Service.create(owner=user, slug="history-test", url="http://localhost:4533")
+    credential = Credential.create(owner=user, service=service, user_name="test", password="test", shared=False)
+    yield service, credential
+
+    content_db.close()
+    user_db.close()
+
+
+def make_recorded_message(service, credential, type="full"):
+    return SubmitMessage(service=model_to_dict(service),
+                         credential=model_to_dict(credential),
+                         user_id=service.owner.user_id,
+                         expire_at=monotonic() + 60,
+                         type=type)
+
+
+def run_worker(worker, slugs):
+    worker.start()
+    try:
+        wait_for_completion(worker, slugs)
+    finally:
+        worker.exit()
+        worker.join(5)
+
+
+class TestJobHistory:
+    """Test cases for recording sync jobs in the sync_job table."""
+
+    def test_job_is_recorded(self, history_db):
+        service, credential = history_db
+        worker = SyncWorker(":memory:", record_jobs=True)
+        worker.job_queue.put(make_recorded_message(service, credential))
+        run_worker(worker, ["history-test"])
+
+        record = SyncJobRecord.get()
+        assert record.state == "complete"
+        assert record.type == "full"
+        assert record.started is not None
+        assert record.finished >= record.started
+        assert record.stats == '{"albums": 10}'
+        assert record.error is None
+
+        service = Service.get_by_id(service.id)
+        assert service.last_synched == record.finished
+        assert service.status == "synced ok"
+
+    def test_top_tags_are_counted_after_sync(self, history_db):
+        service, credential = history_db
+        TopTag.rebuild([{"tag": "stale", "count": 1}])
+        tags = {name: Tag.create(name=name) for name in ("rock", "jazz")}
+        for i in range(3):
+            recording = Recording.create(file_id="song-%d" % i, file_id_type=FileIdType.SUBSONIC_ID, mtime=0)
+            RecordingTag.create(recording=recording, tag=tags["rock"], entity="recording")
+            if i == 0:
+                RecordingTag.create(recording=recording, tag=tags["jazz"], entity="recording")
+
+        worker = SyncWorker(":memory:", record_jobs=True)
+        worker.job_queue.put(make_recorded_message(service, credential))
+        run_worker(worker, ["history-test"])
+
+        assert TopTag.get_top_tags() == [{"tag": "rock", "count": 3}, {"tag": "jazz", "count": 1}]
+
+    def test_failed_job_is_recorded(self, history_db, monkeypatch):
+        monkeypatch.setattr(FakeScan, "fail", True)
+        service, credential = history_db
+        worker = SyncWorker(":memory:", record_jobs=True)
+        worker.job_queue.put(make_recorded_message(service, credential))
+        run_worker(worker, ["history-test"])
+
+        record = SyncJobRecord.get()
+        assert record.state == "failed"
+        assert "cannot reach the service" in record.error
+        assert Service.get_by_id(service.id).status == "sync failed"
+
+    def test_interrupted_jobs_are_resumed(self, history_db):
+        service, credential = history_db
+        scanning = SyncJobRecord.create(service=service, credential=credential, user=service.owner, type="full",
+                                        state="scanning", created=1, started=1, scan_progress="al-7")
+        looking_up = SyncJobRecord.create(service=service, credential=credential, user=service.owner, type="full",
+                                          state="looking_up", created=2, started=2)
+        done = SyncJobRecord.create(service=service, credential=credential, user=service.owner, type="full",
+                                    state="complete", created=3, started=3, finished=3)
+
+        worker = SyncWorker(":memory:", record_jobs=True)
+        assert worker.resume_interrupted_jobs() == 2
+        worker.start()
+        try:
+            deadline = monotonic() + 5
+            while SyncJobRecord.select().where(SyncJobRecord.state == "complete").count() < 3:
+                assert monotonic() < deadline, "resumed jobs did not complete"
+                sleep(.01)
+        finally:
+            worker.exit()
+            worker.join(5)
+
+        assert SyncJobRecord.get_by_id(scanning.id).state == "interrupted"
+        assert SyncJobRecord.get_by_id(looking_up.id).state == "interrupted"
+        assert SyncJobRecord.get_by_id(done.id).state == "complete"
+        resumed = {r.resumed_from_id: r for r in SyncJobRecord.select().where(SyncJobRecord.resumed_from.is_null(False))}
+        assert resumed[scanning.id].type == "full"
+        # The scan of this job was done, only the metadata lookup is run again
+        assert resumed[looking_up.id].type == "metadata_only"
+        # The full scan continues after the last album it wrote
+        assert resumed[scanning.id].scan_progress == "al-7"
+        assert FakeScan.scanned == [(service.id, True, "al-7")]
+
+    def test_scan_progress_is_recorded(self, history_db, monkeypatch):
+        service, credential = history_db
+
+        def run(scan):
+            scan.on_progress("al-1")
+            scan.on_progress("al-2")
+        monkeypatch.setattr(FakeScan, "run", run)
+
+        worker = SyncWorker(":memory:", record_jobs=True)
+        worker.job_queue.put(make_recorded_message(service, credential))
+        run_worker(worker, ["history-test"])
+
+        assert SyncJobRecord.get().scan_progress == "al-2"
+
+    def test_status_survives_a_restart(self, history_db, tmp_path):
+        service, credential = history_db
+        SyncJobRecord.create(service=service, credential=credential, user=service.owner, type="full",
+                             state="failed", created=1, started=1, finished=2, stats='{"albums": 10}', log_lines=5,
+                             error="it went wrong")
+
+        worker = SyncWorker(":memory:", record_jobs=True)
+        status = worker.current_status("history-test")
+        assert status.complete
+        assert status.stats == {"albums": 10}
+        assert status.log_offset == 5
+        assert status.error_msg == "it went wrong"
+        assert worker.current_status("nonexistent") is None
+
+        board_file = str(tmp_path / "sync-status")
+        StatusBoard.create(board_file)
+        board = StatusBoard(board_file)
+        board.open()
+        worker.status_board = board
+        worker.restore_statuses()
+        assert board.read("history-test")["error_msg"] == "it went wrong"
+        board.close()
+
+    def test_long_multibyte_error_is_published(self, tmp_path):
+        board_file = str(tmp_path / "sync-status")
+        StatusBoard.create(board_file)
+        board = StatusBoard(board_file)
+        board.open()
+        job = SyncJob(make_submit_message("error-test"), status_board=board)
+        job.stats = [["Albums", 10]]
+
+        # Each of these takes 12 bytes of JSON, the error would fill the slot several times over
+        error_msg = "Traceback:\n" + "\U0001f3b5" * 3000 + "\nthe end"
+        job.finish(error_msg)
+        status = board.read("error-test")
+        board.close()
+
+        assert status["complete"]
+        assert status["stats"] == [["Albums", 10]]
+        assert 0 < len(status["error_msg"]) < len(error_msg)
+        assert error_msg.endswith(status["error_msg"])
+
+
+class TestSyncLog:
+    """Test cases for the bounded sync log."""
+
+    def read_all(self, log):
+        text = ""
+        index = 0
+        while (chunk := log.chunk(index)) is not None:
+            text += chunk.text
+            index = chunk.next_chunk
+        return text
+
+    def test_short_log_is_kept_in_full(self):
+        log = SyncLog(max_lines=LOG_CHUNK_LINES * 2)
+        for i in range(10):
+            log.append("line %d" % i)
+        assert log.lines == 10
+        assert self.read_all(log) == "".join("line %d\n" % i for i in range(10))
+
+    def test_memory_is_bounded(self):
+        log = SyncLog(max_lines=LOG_CHUNK_LINES * 2)
+        for i in range(LOG_CHUNK_LINES * 10):
+            log.append("line %d" % i)
+
+        assert log.lines == LOG_CHUNK_LINES * 10
+        assert len(log.chunks) == 2
+        text = self.read_all(log)
+        assert text.startswith("[ %d earlier log lines were dropped ]\n" % (LOG_CHUNK_LINES * 8))
+        assert text.endswith("line %d\n" % (LOG_CHUNK_LINES * 10 - 1))
+        assert "line %d\n" % (LOG_CHUNK_LINES * 8 - 1) not in text
+
+    def test_spilled_lines_are_read_back_from_disk(self, tmp_path):
+        spill_file = tmp_path / "sync.log"
+        log = SyncLog(max_lines=LOG_CHUNK_LINES, spill_file=str(spill_file))
+        for i in range(LOG_CHUNK_LINES * 3 + 5):
+            log.append("line %d" % i)
+
+        assert len(log.chunks) == 1
+        assert self.read_all(log) == "".join("line %d\n" % i for i in range(LOG_CHUNK_LINES * 3 + 5))
+
+        log.close()
+        assert not spill_file.exists()
+
+    def test_small_limit_is_honoured(self):
+        log = SyncLog(max_lines=10)
+        for i in range(25):
+            log.append("line %d" % i)
+        assert self.read_all(log) == "[ 20 earlier log lines were dropped ]\n" + \
+            "".join("line %d\n" % i for i in range(20, 25))
+        assert sum(len(chunk) for chunk in log.chunks) <= 10
+
+    def test_limit_is_rounded_up_to_whole_chunks(self):
+        log = SyncLog(max_lines=LOG_CHUNK_LINES + 1)
+        for i in range(LOG_CHUNK_LINES * 2):
+            log.append("line %d" % i)
+        assert self.read_all(log) == "".join("line %d\n" % i for i in range(LOG_CHUNK_LINES * 2))
+
+    def test_limit_must_be_positive(self):
+        with pytest.raises(ValueError):
+            SyncLog(max_lines=0)
+
+    def test_closed_log_has_no_chunks(self):
+        log = SyncLog()
+        log.append("line")
+        log.close()
+        assert log.chunk(0) is None
+
+    def test_reading_past_the_end(self):
+        log = SyncLog()
+        assert log.chunk(0) is None
+        log.append("line")
+        assert log.chunk(1) is None
+
+
+def wait_for_status(client, slug, timeout=3):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        status = client.sync_status(slug)
+        if status is not None:
+            return status
+        sleep(.001)
+    raise AssertionError("no status for %s" % slug)
+
+
+class TestSyncClient:
+    """Test cases for the request/reply protocol between SyncClient and the sync manager."""
+
+    def serve(self, address, answer, connections=1):
+        """ Accept clients one after the other and reply to their requests with whatever answer() sends. """
+
+        listener = Listener(address, family="AF_UNIX", authkey=AUTHKEY)
+
+        def run():
+            for _ in range(connections):
+                with listener.accept() as conn:
+                    try:
+                        while True:
+                            request_id, request = conn.recv()
+                            answer(conn, request_id, request)
+                    except (EOFError, OSError):
+                        pass
+            listener.close()
+
+        thread = Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_replies_to_other_requests_are_skipped(self, tmp_path):
+        def answer(conn, request_id, request):
+            conn.send((request_id - 1, "stale reply"))
+            conn.send((request_id, "reply to %s" % request))
+
+        address = str(tmp_path / "sync.sock")
+        thread = self.serve(address, answer)
+        client = SyncClient(address, AUTHKEY)
+        assert client.call("a") == "reply to a"
+        assert client.call("b") == "reply to b"
+        lb_local.sync.client_connections.connections.pop((os.getpid(), address))[0].close()
+        thread.join(5)
+
+    def test_late_reply_is_not_taken_for_the_next_one(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(lb_local.sync, "REPLY_TIMEOUT", .05)
+
+        def answer(conn, request_id, request):
+            if request == "slow":
+                sleep(.2)
+            conn.send((request_id, "reply to %s" % request))
+
+        address = str(tmp_path / "sync.sock")
+        thread = self.serve(address, answer, connections=2)
+        client = SyncClient(address, AUTHKEY)
+        assert client.call("slow") is None
+        # The timed out connection was dropped, the next request goes out on a new one
+        assert client.call("fast") == "reply to fast"
+        lb_local.sync.client_connections.connections.pop((os.getpid(), address))[0].close()
+        thread.join(5)
+
+    def test_unreachable_manager(self, tmp_path):
+        client = SyncClient(str(tmp_path / "missing.sock"), AUTHKEY)
+        assert client.sync_status("service") is None
+
+    def test_log_tail_returns_the_new_lines(self):
+        log = SyncLog(max_lines=LOG_CHUNK_LINES * 3)
+        log.job_id = "job-1"
+        client = SyncClient(None, None)
+        client.call = lambda req: log.chunk(req.chunk) if req.job_id in (None, log.job_id) else None
+
+        assert client.log_tail("service") == ("", None)
+        for i in range(LOG_CHUNK_LINES - 2):
+            log.append("line %d" % i)
+        text, position = client.log_tail("service")
+        assert text == "".join("line %d\n" % i for i in range(LOG_CHUNK_LINES - 2))
+
+        # The lines continue in the chunk that was read last and go on in the next one
+        for i in range(LOG_CHUNK_LINES - 2, LOG_CHUNK_LINES + 5):
+            log.append("line %d" % i)
+        text, position = client.log_tail("service", position)
+        assert text == "".join("line %d\n" % i for i in range(LOG_CHUNK_LINES - 2, LOG_CHUNK_LINES + 5))
+        assert client.log_tail("service", position) == ("", position)
+
+        # The log of a new job is not mixed into the old one
+        log.job_id = "job-2"
+        log.append("new job")
+        assert client.log_tail("service", position) == ("", position)
+
+
+class TestSyncManager:
+    """Test cases for the SyncManager process."""
+
+    def test_status_for_unknown_slug(self, sync_manager):
+        assert sync_manager.sync_status("nonexistent") is None
+
+    def test_submitted_job_completes(self, sync_manager):
+        sync_manager.submit(make_submit_message("manager-test"))
+        deadline = monotonic() + 3
+        status = None
+        while monotonic() < deadline:
+            status = sync_manager.sync_status("manager-test")
+            if status is not None:
+                break
+        assert status is not None
+        assert status.complete
+
+    def test_full_log_is_streamed_in_chunks(self, sync_manager):
+        assert list(sync_manager.sync_log("nonexistent")) == []
+
+        sync_manager.submit(make_submit_message("log-test"))
+        while sync_manager.sync_status("log-test") is None:
+            sleep(.001)
+
+        chunks = list(sync_manager.sync_log("log-test"))
+        assert len(chunks) == 2
+        assert "".join(chunks) == "".join("line %d\n" % i for i in range(LOG_CHUNK_LINES + 10))
+
+    def test_log_stream_ends_when_a_new_sync_starts(self, sync_manager):
+        sync_manager.submit(make_submit_message("log-test"))
+        first = wait_for_status(sync_manager, "log-test")
+
+        chunks = sync_manager.sync_log("log-test")
+        assert next(chunks).startswith("line 0\n")
+
+        sync_manager.submit(make_submit_message("log-test"))
+        while sync_manager.sync_status("log-test").stats["started_at"] == first.stats["started_at"]:
+            sleep(.001)
+
+        # The rest of the new job's log must not be joined onto the start of the old one
+        assert list(chunks) == []
+
+    def test_concurrent_pollers_get_their_own_replies(self, sync_manager):
+        slugs = ["poll-%d" % i for i in range(8)]
+        for slug in slugs:
+            sync_manager.submit(make_submit_message(slug))
+        for slug in slugs:
+            wait_for_status(sync_manager, slug)
+
+        wrong = []
+        missing = []
+
+        def poll():
+            for i in range(100):
+                slug = random.choice(slugs)
+                status = sync_manager.sync_status(slug)
+                if status is None:
+                    missing.append(slug)
+                elif status.stats["slug"] != slug:
+                    wrong.append((slug, status.stats["slug"]))
+
+        threads = [Thread(target=poll) for _ in range(32)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert wrong == []
+        assert missing == []
+
+    @pytest.mark.slow
+    def test_dispatch_latency_benchmark(self, sync_manager):
+        """Benchmark submit-to-start and status round-trip latency through the manager process."""
+        start_latencies = []
+        for i in range(20):
+            slug = "bench-%d" % i
+            submitted = monotonic()
+            sync_manager.submit(make_submit_message(slug))
+            while True:
+                status = sync_manager.sync_status(slug)
+                if status is not None:
+                    break
+            start_latencies.append(status.stats["started_at"] - submitted)
+
+        round_trips = []
+        for i in range(200):
+            t0 = monotonic()
+            assert sync_manager.sync_status("bench-0") is not None
+            round_trips.append(monotonic() - t0)
+
+        start_latencies.sort()
+        round_trips.sort()
+        print("\nsubmit-to-start: median %.2fms max %.2fms" %
+              (median(start_latencies) * 1000, start_latencies[-1] * 1000))
+        print("status round-trip: median %.2fms p95 %.2fms" %
+              (median(round_trips) * 1000, round_trips[int(len(round_trips) * .95)] * 1000))
+
+        # The old polling loops added up to one second to each of these
+        assert median(start_latencies) < .1
+        assert round_trips[int(len(round_trips) * .95)] < .1
+
+
+def read_status(address, slug):
+    return SyncClient(address, AUTHKEY).sync_status(slug)
+
+
+class TestSyncDaemon:
+    """Test cases for the sync daemon that all web workers share."""
+
+    @pytest.fixture
+    def daemon(self, tmp_path):
+        db_file = str(tmp_path / "sync.db")
+        env = dict(os.environ,
+                   PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                   DATABASE_FILE=db_file,
+                   SECRET_KEY=AUTHKEY.decode("utf-8"),
+                   DOMAIN="127.0.0.1",
+                   PORT="5000",
+                   AUTHORIZED_USERS="testuser",
+                   ADMIN_USERS="adminuser",
+                   SERVICE_USERS="testuser",
+                   MUSICBRAINZ_CLIENT_ID="test-client-id",
+                   MUSICBRAINZ_CLIENT_SECRET="test-client-secret")
+        # Run in tmp_path so no .env file is picked up
+        process = subprocess.Popen([sys.executable, "-m", "lb_local.sync_daemon"], cwd=str(tmp_path), env=env)
+        address = db_file + "-sync.sock"
+        wait_for_socket(address, lambda: process.poll() is None)
+
+        yield process, address
+
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+    def test_jobs_are_seen_by_every_web_worker(self, daemon):
+        process, address = daemon
+        assert SyncClient(address, AUTHKEY).submit(make_submit_message("daemon-test"))
+
+        # There is no subsonic server to sync with, the job ends with an error
+        deadline = monotonic() + 10
+        while True:
+            status = read_status(address, "daemon-test")
+            if status is not None and status.complete:
+                break
+            assert monotonic() < deadline, "sync job did not complete"
+            sleep(.01)
+        assert status.error_msg
+
+        with multiprocessing.Pool(4) as pool:
+            statuses = pool.starmap(read_status, [(address, "daemon-test")] * 8)
+        assert statuses == [status] * 8
+
+    def test_daemon_stops_on_sigterm(self, daemon):
+        process, address = daemon
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(5) == 0
+        assert not os.path.exists(address)
@@ -0,0 +1,242 @@
+import datetime
+import json
+from threading import Event
+from time import monotonic, sleep, time
+from unittest.mock import Mock, patch
+
+import pytest
+from troi import Recording, Release, ArtistCredit, Artist
+
+from lb_local.model.database import user_db, setup_db
+from lb_local.model.weekly_jams import WeeklyJams
+from lb_local.weekly_jams import WeeklyJamsWorker, current_period, serialize_recordings, deserialize_recordings, \
+    WEEKLY_JAMS_GENERATE_TIMEOUT, WEEKLY_JAMS_REFRESH_MAX_AGE
+
+
+def make_recording(index):
+    return Recording(name="Song %d" % index,
+                     mbid="00000000-0000-0000-0000-%012d" % index,
+                     release=Release(name="Album", mbid="10000000-0000-0000-0000-000000000000"),
+                     artist_credit=ArtistCredit(name="Artist & Friend",
+                                                artists=[Artist(name="Artist", mbid="a1", join_phrase=" & "),
+                                                         Artist(name="Friend", mbid="a2")]),
+                     musicbrainz={"subsonic_id": "id-%d" % index, "file_source": "navidrome"},
+                     listenbrainz={"file_source": "navidrome"})
+
+
+def fake_generate(self, user_name):
+    recordings = [make_recording(i) for i in range(3)]
+    return {"name": "Weekly Jams for %s" % user_name,
+            "description": "Your weekly jams",
+            "recordings": serialize_recordings(recordings),
+            "hints": json.dumps(["A hint"]),
+            "jspf": json.dumps({"playlist": {"track": []}})}
+
+
+def wait_for_jams(user_name, timeout=5):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        jams = WeeklyJams.get_or_none(WeeklyJams.user_name == user_name)
+        if jams is not None and jams.state == "complete" and jams.generated is not None:
+            return jams
+        sleep(.005)
+    raise AssertionError("weekly jams were not generated in time")
+
+
+@pytest.fixture
+def jams_db(tmp_path):
+    setup_db(str(tmp_path / "lb-local.db"))
+    user_db.connect()
+    user_db.create_tables((WeeklyJams,))
+    yield
+    user_db.close()
+
+
+@pytest.fixture
+def worker(jams_db, tmp_path):
+    worker = WeeklyJamsWorker(str(tmp_path / "lb-local.db"))
+    yield worker
+    worker.executor.shutdown(wait=True)
+
+
+def test_period_is_the_iso_week():
+    assert current_period(datetime.date(2026, 10, 17)) == "2026-W42"
+    # The last days of a year can be in the first week of the next one
+    assert current_period(datetime.date(2024, 12, 30)) == "2025-W01"
+
+
+def test_recordings_survive_storage():
+    recordings = deserialize_recordings(serialize_recordings([make_recording(1)]))
+    rec = recordings[0]
+    assert (rec.name, rec.mbid) == ("Song 1", "00000000-0000-0000-0000-000000000001")
+    assert (rec.release.name, rec.release.mbid) == ("Album", "10000000-0000-0000-0000-000000000000")
+    assert [(a.name, a.mbid, a.join_phrase) for a in rec.artist_credit.artists] == \
+        [("Artist", "a1", " & "), ("Friend", "a2", None)]
+    assert rec.musicbrainz["subsonic_id"] == "id-1"
+    assert rec.listenbrainz["file_source"] == "navidrome"
+
+
+class TestWeeklyJamsWorker:
+
+    def test_jams_are_generated_and_stored(self, worker, monkeypatch):
+        monkeypatch.setattr(WeeklyJamsWorker, "generate", fake_generate)
+        worker.refresh("rob")
+        jams = wait_for_jams("rob")
+        assert jams.is_current(current_period())
+        assert jams.name == "Weekly Jams for rob"
+        assert [r.name for r in deserialize_recordings(jams.recordings)] == ["Song 0", "Song 1", "Song 2"]
+
+    def test_jams_are_marked_before_they_are_generated(self, worker, monkeypatch):
+        release = Event()
+        monkeypatch.setattr(WeeklyJamsWorker, "generate", lambda self, user_name: release.wait() and
+                            fake_generate(self, user_name))
+        worker.refresh("rob")
+        assert WeeklyJams.get(WeeklyJams.user_name == "rob").state == "generating"
+        release.set()
+        wait_for_jams("rob")
+
+    def test_pending_jams_are_generated_once(self, worker, monkeypatch):
+        release = Event()
+        calls = []
+
+        def generate(self, user_name):
+            calls.append(user_name)
+            release.wait()
+            return fake_generate(self, user_name)
+
+        monkeypatch.setattr(WeeklyJamsWorker, "generate", generate)
+        for i in range(3):
+            worker.refresh("rob")
+        release.set()
+        wait_for_jams("rob")
+        assert calls == ["rob"]
+
+    def test_failed_generation_is_stored_as_an_error(self, worker, monkeypatch):
+        monkeypatch.setattr(WeeklyJamsWorker, "generate", lambda self, user_name: {"errors": "No such user"})
+        worker.refresh("rob")
+        jams = wait_for_jams("rob")
+        assert jams.errors == "No such user"
+        assert not jams.is_current(current_period())
+
+    def test_crashed_generation_is_stored_as_an_error(self, worker, monkeypatch):
+        def generate(self, user_name):
+            raise SystemExit(-1)
+
+        monkeypatch.setattr(WeeklyJamsWorker, "generate", generate)
+        worker.refresh("rob")
+        assert wait_for_jams("rob").errors
+
+    def test_jams_of_past_weeks_are_generated_again(self, worker, monkeypatch):
+        monkeypatch.setattr(WeeklyJamsWorker, "generate", fake_generate)
+        now = int(time())
+        WeeklyJams.create(user_name="old", period="2020-W01", state="complete", requested=now, errors=None)
+        WeeklyJams.create(user_name="current", period=current_period(), state="complete", requested=now, name="kept")
+        # Jams that were being generated when the daemon stopped
+        WeeklyJams.create(user_name="interrupted", period=current_period(), state="generating", requested=now)
+
+        worker.refresh_stale()
+        assert wait_for_jams("old").period == current_period()
+        assert wait_for_jams("interrupted").name == "Weekly Jams for interrupted"
+        assert WeeklyJams.get(WeeklyJams.user_name == "current").name == "kept"
+        # Generating them again does not count as the page asking for them
+        assert WeeklyJams.get(WeeklyJams.user_name == "old").requested == now
+
+    def test_jams_nobody_asked_for_lately_are_not_generated_again(self, worker, monkeypatch):
+        calls = []
+        monkeypatch.setattr(WeeklyJamsWorker, "generate", lambda self, user_name: calls.append(user_name) or {})
+        long_ago = int(time()) - WEEKLY_JAMS_REFRESH_MAX_AGE - 1
+        WeeklyJams.create(user_name="forgotten", period="2020-W01", state="complete", requested=long_ago)
+        WeeklyJams.create(user_name="stuck", period="2020-W01", state="generating", requested=long_ago)
+
+        worker.refresh_stale()
+        worker.executor.shutdown(wait=True)
+        assert calls == []
+
+    def test_scheduler_exits(self, worker):
+        worker.refresh_interval = 60
+        worker.start()
+        worker.exit()
+        worker.join(5)
+        assert not worker.is_alive()
+
+
+class TestWeeklyJamsViews:
+
+    @pytest.fixture
+    def sync_client(self):
+        sync_client = Mock()
+        sync_client.refresh_weekly_jams.return_value = True
+        with patch('lb_local.view.index.get_sync_client', return_value=sync_client):
+            yield sync_client
+
+    @pytest.fixture
+    def stored_jams(self, authenticated_client):
+        fields = fake_generate(None, "view-test")
+        jams = WeeklyJams.create(user_name="view-test", period=current_period(), state="complete", requested=0,
+                                 **fields)
+        yield jams
+        WeeklyJams.delete().where(WeeklyJams.user_name == "view-test").execute()
+
+    def test_stored_jams_are_served_without_generating(self, authenticated_client, sync_client, stored_jams):
+        response = authenticated_client.post('/weekly-jams', data={'user_name': 'view-test'})
+        assert response.status_code == 200
+        assert b"Weekly Jams for view-test" in response.data
+        assert b"Song 2" in response.data
+        assert b"A hint" in response.data
+        sync_client.refresh_weekly_jams.assert_not_called()
+
+    def test_jams_are_streamed_without_their_jspf(self, authenticated_client, sync_client, stored_jams):
+        response = authenticated_client.post('/weekly-jams', data={'user_name': 'view-test'})
+        assert response.is_streamed
+        assert b'data-url="/weekly-jams/view-test/jspf"' in response.data
+        assert b'"track"' not in response.data
+
+        response = authenticated_client.get('/weekly-jams/view-test/jspf')
+        assert response.status_code == 200
+        assert response.get_json() == {"playlist": {"track": []}}
+
+    def test_jspf_of_unknown_jams_is_not_found(self, authenticated_client):
+        assert authenticated_client.get('/weekly-jams/nobody-at-all/jspf').status_code == 404
+
+    def test_refresh_generates_the_jams_again(self, authenticated_client, sync_client, stored_jams):
+        response = authenticated_client.post('/weekly-jams', data={'user_name': 'view-test', 'refresh': '1'})
+        assert b'hx-get="/weekly-jams/view-test/playlist"' in response.data
+        sync_client.refresh_weekly_jams.assert_called_once_with("view-test")
+
+    def test_jams_of_a_past_week_are_generated_again(self, authenticated_client, sync_client, stored_jams):
+        WeeklyJams.update(period="2020-W01").where(WeeklyJams.user_name == "view-test").execute()
+        response = authenticated_client.post('/weekly-jams', data={'user_name': 'view-test'})
+        assert b'hx-get="/weekly-jams/view-test/playlist"' in response.data
+        sync_client.refresh_weekly_jams.assert_called_once_with("view-test")
+
+    def test_jams_being_generated_poll_again(self, authenticated_client, stored_jams):
+        WeeklyJams.update(state="generating", requested=int(time())) \
+                  .where(WeeklyJams.user_name == "view-test").execute()
+        response = authenticated_client.get('/weekly-jams/view-test/playlist')
+        assert b'hx-get="/weekly-jams/view-test/playlist"' in response.data
+
+    def test_jams_stuck_generating_are_given_up_on(self, authenticated_client, stored_jams):
+        requested = int(time()) - WEEKLY_JAMS_GENERATE_TIMEOUT - 1
+        WeeklyJams.update(state="generating", requested=requested) \
+                  .where(WeeklyJams.user_name == "view-test").execute()
+        response = authenticated_client.get('/weekly-jams/view-test/playlist')
+        assert b'hx-get' not in response.data
+        assert b"took too long" in response.data
+
+    def test_generated_jams_are_shown(self, authenticated_client, stored_jams):
+        response = authenticated_client.get('/weekly-jams/view-test/playlist')
+        assert b"Weekly Jams for view-test" in response.data
+
+    def test_generation_errors_are_shown(self, authenticated_client, stored_jams):
+        WeeklyJams.update(errors="No such user").where(WeeklyJams.user_name == "view-test").execute()
+        response = authenticated_client.get('/weekly-jams/view-test/playlist')
+        assert b"No such user" in response.data
+
+    def test_unknown_jams_are_not_available(self, authenticated_client):
+        response = authenticated_client.get('/weekly-jams/nobody-at-all/playlist')
+        assert b"not available" in response.data
+
+    def test_unreachable_service_is_reported(self, authenticated_client, sync_client):
+        sync_client.refresh_weekly_jams.return_value = None
+        response = authenticated_client.post('/weekly-jams', data={'user_name': 'nobody-at-all'})
+        assert b"not running" in response.data